@@ -0,0 +1,538 @@
+#!/usr/bin/python3
+"""Benchmark the Tipi Tricks subsystems against a synthetic runtipi install.
+
+A throwaway tree with apps, app data, media, fstab shares, hwmon sensors and
+config files is generated under a temporary directory, and every script is
+pointed at it through the TIPI_* environment variables read by
+bin/tipi_paths.py. The stand-in executables in bench/fakes (runtipi-cli,
+docker, smartctl, lsblk, sensors, gotify, mount, umount) are put first on
+PATH, so nothing on the host is touched. stub_docker.py stands in for the
+Docker daemon on the socket TIPI_DOCKER_SOCKET points to, and stub_s3.py
+for an S3-compatible backup target.
+
+Each subsystem runs in its own worker process so CPU time, peak memory and
+process spawns are attributed to it alone. Results can be saved with --json
+and compared against a saved run with --baseline.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BIN_DIR = os.path.join(REPO_DIR, "bin")
+FAKES_DIR = os.path.join(BENCH_DIR, "fakes")
+
+SUBSYSTEMS = ("startup", "monitors", "timeseries", "notify", "disk_usage", "docker_prune", "prefetch", "backup", "update_apps", "jobs")
+DEFAULT_TOLERANCE = 0.25  # Allowed slowdown against a baseline before it counts as a regression
+NOISE_FLOOR_MS = 2  # Slowdowns smaller than this per op are scheduling noise, not regressions
+STARTUP_BUDGET_MS = 100  # Median time for tipi-tricks to print its help, baseline or not
+# Commands that must start without looking for runtipi-cli or loading the monitors, backups or updates
+STARTUP_COMMANDS = (["--help"], ["monitors", "--help"], ["backup", "--help"], ["updates", "--help"])
+
+def write_file(path, content, mode="w"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode) as f:
+        f.write(content)
+
+def make_tree(tree, args):
+    """Generate a runtipi install and its surroundings under tree."""
+    rng = random.Random(42)
+    root = os.path.join(tree, "runtipi")
+    etc = os.path.join(tree, "etc")
+    shares = [os.path.join(tree, "mnt", f"share{i}") for i in range(args.shares)]
+
+    for share in shares:
+        os.makedirs(share, exist_ok=True)
+    write_file(os.path.join(tree, "fstab"), "".join(f"server:/export{i} {share} nfs defaults 0 0\n"
+                                                    for i, share in enumerate(shares)))
+    write_file(os.path.join(tree, "mountinfo"), "".join(f"{40 + i} 25 0:{50 + i} / {share} rw,relatime - nfs server:/export{i} rw\n"
+                                                        for i, share in enumerate(shares)))
+
+    for chip, temps in (("coretemp", args.sensors), ("nvme", 1)):
+        chip_dir = os.path.join(tree, "hwmon", f"hwmon{0 if chip == 'coretemp' else 1}")
+        write_file(os.path.join(chip_dir, "name"), f"{chip}\n")
+        for i in range(1, temps + 1):
+            write_file(os.path.join(chip_dir, f"temp{i}_input"), f"{40000 + i * 500}\n")
+            write_file(os.path.join(chip_dir, f"temp{i}_label"), f"Core {i - 1}\n" if chip == "coretemp" else "Composite\n")
+
+    payload = os.urandom(args.file_size * 1024)
+    for i in range(args.apps):
+        app = f"app{i:03d}"
+        share = shares[i % len(shares)] if shares else "/srv"
+        write_file(os.path.join(root, "apps", app, "config.json"), json.dumps({"id": app, "tipi_version": 1}))
+        # Every other app has an update waiting in the app store repo
+        write_file(os.path.join(root, "repos", "main", "apps", app, "config.json"),
+                   json.dumps({"id": app, "tipi_version": 1 + i % 2}))
+        if i % 2:
+            write_file(os.path.join(root, "repos", "main", "apps", app, "docker-compose.yml"),
+                       f"services:\n  {app}:\n    image: bench/{app}:2\n")
+        write_file(os.path.join(root, "apps", app, "docker-compose.yml"),
+                   f"services:\n  {app}:\n    image: bench/{app}:latest\n    volumes:\n"
+                   f"      - ${{APP_DATA_DIR}}/data:/data\n      - {share}/{app}:/media\n")
+        for j in range(args.files):
+            # Half of the files compress well, half are incompressible
+            content = payload if j % 2 else bytes(rng.randrange(4) for _ in range(64)) * (args.file_size * 16)
+            write_file(os.path.join(root, "app-data", app, "data", f"sub{j % 4}", f"file{j:04d}"), content, "wb")
+    for folder in ("movies", "music", "downloads"):
+        for j in range(args.files):
+            write_file(os.path.join(root, "media", folder, f"item{j:04d}"), payload, "wb")
+    for name in ("data", "logs", "traefik", "user-config"):
+        os.makedirs(os.path.join(root, name), exist_ok=True)
+    write_file(os.path.join(root, "docker-compose.yml"), "services: {}\n")
+    write_file(os.path.join(root, "VERSION"), "v3.0.0\n")
+    write_file(os.path.join(root, ".env"), f"ROOT_FOLDER_HOST={root}\nSTORAGE_PATH={root}\n")
+    shutil.copy(os.path.join(FAKES_DIR, "runtipi-cli"), os.path.join(root, "runtipi-cli"))
+    os.chmod(os.path.join(root, "runtipi-cli"), 0o755)
+
+    write_file(os.path.join(etc, "monitor_space.conf"),
+               f"[thresholds]\ndrive_usage = 101\ncritical_usage = 101\n\n[filesystems]\npaths = {root}\n")
+    write_file(os.path.join(etc, "monitor_shares.conf"), "")
+    write_file(os.path.join(etc, "monitor_sensor.conf"), "[SETTINGS]\nsensor = coretemp\nthreshold_temp = 200\n")
+    write_file(os.path.join(etc, "scheduled_tipi_backup.conf"),
+               "[settings]\nmax_backups = 2\nmode = archive\n\n[compression]\ncodec = gzip\nlevel = 6\nworkers = 0\n")
+    # Every job, with the limits loose enough that the bench machine never waits
+    write_file(os.path.join(etc, "tipi_jobs.conf"),
+               "[tipi_update]\nenabled = true\n\n[app_update]\nenabled = true\n\n"
+               "[system_update]\nenabled = true\nreboot = false\n\n[backup]\nenabled = true\nstaged = true\n\n"
+               f"[admission]\nmax_load = 1000\nmax_io_pressure = 100\nmin_free_percent = 0\npaths = {root}\n"
+               "max_temperature = 200\nmax_wait_minutes = 0\n")
+    write_file(os.path.join(tree, "pressure", "io"), "some avg10=1.50 avg60=0.80 avg300=0.40 total=123456\n"
+                                                     "full avg10=0.50 avg60=0.20 avg300=0.10 total=45678\n")
+    write_file(os.path.join(etc, "metrics.conf"), f"[textfile]\ndirectory = {os.path.join(tree, 'metrics')}\n\n[http]\nport = 0\n")
+    os.makedirs(os.path.join(tree, "metrics"), exist_ok=True)
+    os.makedirs(os.path.join(tree, "state"), exist_ok=True)
+
+    fakes = os.path.join(tree, "fakes")
+    os.makedirs(fakes, exist_ok=True)
+    for name in os.listdir(FAKES_DIR):
+        shutil.copy(os.path.join(FAKES_DIR, name), os.path.join(fakes, name))
+        os.chmod(os.path.join(fakes, name), 0o755)
+
+def bench_env(tree, args):
+    env = dict(os.environ)
+    env.update({
+        "TIPI_ROOT": os.path.join(tree, "runtipi"),
+        "TIPI_CONFIG_DIR": os.path.join(tree, "etc"),
+        "TIPI_STATE_DIR": os.path.join(tree, "state"),
+        "TIPI_FSTAB": os.path.join(tree, "fstab"),
+        "TIPI_MOUNTINFO": os.path.join(tree, "mountinfo"),
+        "TIPI_HWMON_DIR": os.path.join(tree, "hwmon"),
+        "TIPI_DOCKER_SOCKET": os.path.join(tree, "docker.sock"),
+        "TIPI_PRESSURE_DIR": os.path.join(tree, "pressure"),
+        "TIPI_BENCH_DRIVES": str(args.drives),
+        "TIPI_BENCH_CLI_DELAY": str(args.cli_delay),
+        "PATH": os.path.join(tree, "fakes") + os.pathsep + os.environ.get("PATH", ""),
+    })
+    return env
+
+class Measure:
+    """Wall time, CPU time (including waited-for children) and fake process spawns of a block."""
+
+    def __init__(self, spawn_log):
+        self.spawn_log = spawn_log
+
+    def spawns(self):
+        try:
+            with open(self.spawn_log) as f:
+                return sum(1 for _ in f)
+        except OSError:
+            return 0
+
+    def cpu(self):
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return self_usage.ru_utime + self_usage.ru_stime + children.ru_utime + children.ru_stime
+
+    def __enter__(self):
+        self.start_spawns = self.spawns()
+        self.start_cpu = self.cpu()
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.monotonic() - self.start
+        self.cpu_seconds = self.cpu() - self.start_cpu
+        self.spawn_count = self.spawns() - self.start_spawns
+
+def result(name, measure, ops, unit, latencies=None, interval=None, volume=None, volume_unit=None):
+    """Build one result row. interval is the tick interval used to scale spawns to a rate per minute."""
+    row = {
+        "name": name,
+        "ops": ops,
+        "unit": unit,
+        "seconds": round(measure.seconds, 4),
+        "throughput": round(ops / measure.seconds, 2) if measure.seconds else None,
+        "cpu_ms_per_op": round(measure.cpu_seconds * 1000 / ops, 3) if ops else None,
+        "spawns_per_op": round(measure.spawn_count / ops, 2) if ops else None,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if latencies:
+        ordered = sorted(latencies)
+        row["p50_ms"] = round(statistics.median(ordered) * 1000, 3)
+        row["p95_ms"] = round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3)
+    if interval:
+        row["spawns_per_min"] = round(measure.spawn_count / ops * 60 / interval, 2)
+    if volume is not None:
+        row["volume_throughput"] = f"{volume / measure.seconds:.1f} {volume_unit}/s"
+    return row
+
+def timed_ops(func, count):
+    latencies = []
+    for _ in range(count):
+        start = time.monotonic()
+        func()
+        latencies.append(time.monotonic() - start)
+    return latencies
+
+def bench_startup(args, spawn_log):
+    import tipi_paths
+
+    cli_config = os.path.join(tipi_paths.CONFIG_DIR, "runtipi_config.json")
+    rows = []
+    for command in STARTUP_COMMANDS:
+        if os.path.exists(cli_config):
+            os.remove(cli_config)
+        # No terminal on stdin, so a runtipi-cli prompt fails the run instead of hanging it
+        run = lambda: subprocess.run([sys.executable, os.path.join(REPO_DIR, "tipi-tricks")] + command,
+                                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+        with Measure(spawn_log) as measure:
+            latencies = timed_ops(run, args.startup_runs)
+        if os.path.exists(cli_config):
+            raise RuntimeError(f"tipi-tricks {' '.join(command)} looked for runtipi-cli")
+        name = "startup.help" if command == ["--help"] else f"startup.{command[0]}"
+        rows.append(result(name, measure, args.startup_runs, "runs", latencies))
+    return rows
+
+def bench_monitors(args, spawn_log):
+    import monitor_drive_health
+    import monitor_sensor
+    import monitor_shares
+    import monitor_space
+
+    checks = [
+        ("monitor.drive_space", lambda: monitor_space.SpaceCheck()),
+        ("monitor.temp_sensor", lambda: monitor_sensor.load_check()),
+        ("monitor.mount_points", lambda: monitor_shares.MountCheck()),
+        ("monitor.drive_health", lambda: monitor_drive_health.DriveHealthCheck()),
+    ]
+    rows = []
+    for name, factory in checks:
+        check = factory()
+        check.tick()  # Warm caches (app mount index, hwmon fds) like a long-running daemon
+        # Checks may pick their own delay until the next tick, like the temperature monitor does
+        delays = []
+        with Measure(spawn_log) as measure:
+            latencies = timed_ops(lambda: delays.append(check.tick() or check.interval), args.ticks)
+        rows.append(result(name, measure, args.ticks, "ticks", latencies, interval=statistics.mean(delays)))
+    return rows
+
+def bench_timeseries(args, spawn_log):
+    import tipi_timeseries
+
+    if os.path.exists(tipi_timeseries.STORE_FILE):
+        os.remove(tipi_timeseries.STORE_FILE)
+    store = tipi_timeseries.TimeSeriesStore()
+    names = [f"temperature:sensor {i}" for i in range(8)]
+    # One sample per minute and series, going back far enough to wrap every tier but the hourly one
+    now = time.time()
+    start = now - args.samples * 60
+    with Measure(spawn_log) as measure:
+        for i in range(args.samples):
+            for name in names:
+                store.record(name, 40 + i % 20, start + i * 60)
+    rows = [result("timeseries.record", measure, args.samples * len(names), "samples")]
+
+    periods = [3600, 86400, 7 * 86400, args.samples * 60]
+    with Measure(spawn_log) as measure:
+        latencies = timed_ops(lambda: [store.query(names[0], now - period) for period in periods], args.ticks)
+    rows.append(result("timeseries.query", measure, args.ticks * len(periods), "queries", latencies))
+    store.close()
+    if os.path.getsize(tipi_timeseries.STORE_FILE) != tipi_timeseries.file_size(tipi_timeseries.SERIES_CHUNK):
+        raise RuntimeError("The time-series store grew beyond its preallocated size")
+    return rows
+
+def bench_notify(args, spawn_log):
+    import tipi_notify
+
+    server = tipi_notify.serve_stub()
+    notifier = tipi_notify.Notifier(url=f"http://127.0.0.1:{server.server_port}", token="bench",
+                                    window=0, batch_delay=0)
+    with Measure(spawn_log) as measure:
+        for i in range(args.notifications):
+            # Distinct titles so no two messages are coalesced into one request
+            notifier.notify(f"bench {i}", f"message {i}")
+        notifier.flush()
+    server.shutdown()
+    return [result("notify.gotify_api", measure, notifier.sent, "messages")]
+
+def bench_disk_usage(args, spawn_log):
+    import disk_usage
+    import tipi_paths
+
+    cache_file = os.path.join(tipi_paths.STATE_DIR, "disk_usage_bench.json")
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+    rows = []
+    for name in ("disk_usage.cold", "disk_usage.warm"):
+        with Measure(spawn_log) as measure:
+            _, _, _, _, stats = disk_usage.scan(tipi_paths.RUNTIPI_DIR, cache_file)
+        rows.append(result(name, measure, stats["dirs"], "dirs"))
+    return rows
+
+def bench_docker_prune(args, spawn_log):
+    import docker_prune
+    import stub_docker
+
+    rows = []
+    for name, dry_run in (("docker_prune.plan", True), ("docker_prune.remove", False)):
+        # A fresh daemon each time, with as many unused images as installed apps
+        server = stub_docker.serve(orphans=args.apps)
+        images = len(server.state["images"]) + len(server.state["build_cache"])
+        with Measure(spawn_log) as measure:
+            docker_prune.prune(min_age=0, dry_run=dry_run)
+        server.shutdown()
+        server.server_close()
+        rows.append(result(name, measure, images, "images"))
+    return rows
+
+def bench_prefetch(args, spawn_log):
+    import image_prefetch
+    import stub_docker
+
+    rows = []
+    for name, dry_run in (("prefetch.plan", True), ("prefetch.pull", False)):
+        # A fresh daemon each time, holding the current images but none of the updates'
+        server = stub_docker.serve(orphans=0)
+        with Measure(spawn_log) as measure:
+            report = image_prefetch.prefetch(dry_run=dry_run)
+        server.shutdown()
+        server.server_close()
+        if dry_run:
+            rows.append(result(name, measure, args.apps, "apps"))
+        else:
+            nbytes = sum(image["Size"] for image in server.state["images"].values()
+                         if any(tag.endswith(":2") for tag in image["RepoTags"]))
+            rows.append(result(name, measure, len(report["apps"]), "apps", volume=nbytes / 1000 ** 2, volume_unit="MB"))
+    return rows
+
+def bench_backup(args, spawn_log):
+    import scheduled_tipi_backup as backup
+
+    # Start from an empty backup dir so the first snapshot is really cold
+    shutil.rmtree(backup.BACKUP_DIR, ignore_errors=True)
+    rows = []
+    with Measure(spawn_log) as measure:
+        backup.create_backup()
+    read = backup.BACKUP_BYTES_READ.values.get(("archive",), 0)
+    rows.append(result("backup.archive", measure, 1, "runs", volume=read / 1e6, volume_unit="MB"))
+
+    name = backup.list_archives()[-1]
+    with Measure(spawn_log) as measure:
+        backup.verify_archive(name, full=True)
+    rows.append(result("backup.verify_full", measure, 1, "runs"))
+
+    # Restoring one app only reads the blocks holding its members
+    app_name = sorted(os.listdir(os.path.join(backup.BASE_DIR, backup.APP_DATA_ITEM)))[0]
+    target = os.path.join(args.tree, "restore")
+    with Measure(spawn_log) as measure:
+        backup.restore(app_name, target=target)
+    shutil.rmtree(target, ignore_errors=True)
+    rows.append(result("backup.restore_app", measure, 1, "runs"))
+
+    # The same archive streamed to the stand-in S3 server, one part in four failing once
+    import backup_targets
+    import stub_s3
+
+    server = stub_s3.serve(os.path.join(args.tree, "s3"), fail_every=4)
+    backup._target = backup_targets.S3Target(f"http://127.0.0.1:{server.server_port}", "backups", "tipi/",
+                                             access_key=stub_s3.ACCESS_KEY, secret_key=stub_s3.SECRET_KEY,
+                                             part_size=5 * 1024 * 1024)
+    try:
+        with Measure(spawn_log) as measure:
+            if not backup.create_backup():
+                raise RuntimeError("Backup to the stand-in S3 server failed")
+        written = backup.BACKUP_BYTES_WRITTEN.values.get(("archive",), 0)
+        rows.append(result("backup.s3_upload", measure, 1, "runs", volume=written / 1e6, volume_unit="MB uploaded"))
+        with Measure(spawn_log) as measure:
+            backup.restore(app_name, target=target)
+        shutil.rmtree(target, ignore_errors=True)
+        rows.append(result("backup.s3_restore_app", measure, 1, "runs"))
+    finally:
+        backup._target = None
+        server.shutdown()
+        server.server_close()
+
+    for name in ("backup.dedup_cold", "backup.dedup_incremental"):
+        with Measure(spawn_log) as measure:
+            backup.create_snapshot()
+        read = backup.BACKUP_BYTES_READ.values.get(("dedup",), 0)
+        rows.append(result(name, measure, 1, "runs", volume=read / 1e6, volume_unit="MB hashed"))
+    shutil.rmtree(backup.BACKUP_DIR, ignore_errors=True)
+    return rows
+
+def bench_update_apps(args, spawn_log):
+    import tipi_paths
+
+    with Measure(spawn_log) as measure:
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, "tipi-tricks"), "--update-apps"],
+                       cwd=tipi_paths.RUNTIPI_DIR, stdout=subprocess.DEVNULL, check=True)
+    return [result("update_apps", measure, args.apps, "apps")]
+
+def bench_jobs(args, spawn_log):
+    import scheduled_tipi_backup as backup
+    import tipi_jobs
+
+    shutil.rmtree(backup.BACKUP_DIR, ignore_errors=True)
+    # The jobs are child processes writing to the inherited stdout, point it at /dev/null too
+    stdout = os.dup(1)
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+    try:
+        with Measure(spawn_log) as measure:
+            run = tipi_jobs.run_chain()
+    finally:
+        os.dup2(stdout, 1)
+        os.close(stdout)
+    failed = [entry["name"] for entry in run["jobs"] if entry["outcome"] != "succeeded"]
+    if failed:
+        raise RuntimeError(f"Jobs did not succeed: {', '.join(failed)}")
+    shutil.rmtree(backup.BACKUP_DIR, ignore_errors=True)
+    rows = [result("jobs.chain", measure, len(run["jobs"]), "jobs")]
+
+    # Reading load, I/O pressure, free space and every sensor before each job
+    _, admission, paths = tipi_jobs.read_settings()
+    with Measure(spawn_log) as measure:
+        latencies = timed_ops(lambda: tipi_jobs.admission_problems(tipi_jobs.read_resources(paths), admission), args.ticks)
+    rows.append(result("jobs.admission", measure, args.ticks, "checks", latencies))
+    return rows
+
+def run_worker(subsystem, args):
+    """Run one subsystem in this process and write its result rows to args.result."""
+    sys.path.insert(0, BIN_DIR)
+    spawn_log = os.path.join(args.tree, f"spawns_{subsystem}.log")
+    os.environ["TIPI_BENCH_SPAWN_LOG"] = spawn_log
+    bench = globals()[f"bench_{subsystem}"]
+    # The scripts report progress on stdout, keep it out of the results
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        rows = bench(args, spawn_log)
+    with open(args.result, "w") as f:
+        json.dump(rows, f)
+
+def print_rows(rows):
+    print(f"{'Subsystem':<26} {'Ops':>6} {'Wall s':>8} {'Ops/s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'CPU ms/op':>10} {'Spawns/op':>9} {'Spawns/min':>10} {'RSS MB':>7}  Volume")
+    for row in rows:
+        def col(key, width):
+            value = row.get(key)
+            return f"{'-' if value is None else value:>{width}}"
+        print(f"{row['name']:<26} {row['ops']:>6} {row['seconds']:>8.2f} {col('throughput', 9)} {col('p50_ms', 8)} "
+              f"{col('p95_ms', 8)} {col('cpu_ms_per_op', 10)} {col('spawns_per_op', 9)} {col('spawns_per_min', 10)} "
+              f"{col('max_rss_mb', 7)}  {row.get('volume_throughput', '')}")
+
+def compare(rows, baseline, tolerance):
+    """Return regression messages for rows that got slower than the baseline by more than tolerance."""
+    previous = {row["name"]: row for row in baseline}
+    regressions = []
+    for row in rows:
+        old = previous.get(row["name"])
+        if old is None:
+            continue
+        # Higher is worse for latency, CPU and spawns, lower is worse for throughput
+        for key, floor in (("p95_ms", NOISE_FLOOR_MS), ("cpu_ms_per_op", NOISE_FLOOR_MS), ("spawns_per_op", 0)):
+            if old.get(key) is None or row.get(key) is None:
+                continue
+            if row[key] > old[key] * (1 + tolerance) and row[key] - old[key] > floor:
+                regressions.append(f"{row['name']}: {key} {old[key]} -> {row[key]}")
+        if old.get("throughput") and row.get("throughput"):
+            slower_ms = (1 / row["throughput"] - 1 / old["throughput"]) * 1000
+            if row["throughput"] < old["throughput"] / (1 + tolerance) and slower_ms > NOISE_FLOOR_MS:
+                regressions.append(f"{row['name']}: throughput {old['throughput']} -> {row['throughput']}")
+    return regressions
+
+def over_budget(rows):
+    """Return messages for startup rows whose median exceeds STARTUP_BUDGET_MS."""
+    return [f"{row['name']}: p50_ms {row['p50_ms']} > {STARTUP_BUDGET_MS}" for row in rows
+            if row["name"].startswith("startup.") and row.get("p50_ms", 0) > STARTUP_BUDGET_MS]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Tipi Tricks against a synthetic runtipi install.")
+    parser.add_argument("--only", nargs="+", choices=SUBSYSTEMS, help="Subsystems to run (default: all)")
+    parser.add_argument("--apps", type=int, default=20, help="Installed apps (default: 20)")
+    parser.add_argument("--files", type=int, default=40, help="Files per app and per media folder (default: 40)")
+    parser.add_argument("--file-size", type=int, default=64, help="File size in KB (default: 64)")
+    parser.add_argument("--shares", type=int, default=4, help="Network shares in fstab (default: 4)")
+    parser.add_argument("--drives", type=int, default=4, help="Drives reported by lsblk (default: 4)")
+    parser.add_argument("--sensors", type=int, default=4, help="Temperature inputs on the fake CPU (default: 4)")
+    parser.add_argument("--ticks", type=int, default=20, help="Ticks per monitor (default: 20)")
+    parser.add_argument("--startup-runs", type=int, default=20, help="Runs per startup command (default: 20)")
+    parser.add_argument("--samples", type=int, default=20000, help="Samples per time series (default: 20000)")
+    parser.add_argument("--notifications", type=int, default=200, help="Notifications to send (default: 200)")
+    parser.add_argument("--cli-delay", type=float, default=0.05, help="Seconds each fake runtipi-cli call takes (default: 0.05)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per subsystem, the fastest is reported (default: 3)")
+    parser.add_argument("--json", metavar="FILE", help="Save the results as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare against saved results, exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Allowed slowdown against the baseline (default: {DEFAULT_TOLERANCE})")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated tree and print its location")
+    parser.add_argument("--worker", choices=SUBSYSTEMS, help=argparse.SUPPRESS)
+    parser.add_argument("--tree", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args)
+        return
+
+    tree = tempfile.mkdtemp(prefix="tipi-bench-")
+    try:
+        start = time.monotonic()
+        make_tree(tree, args)
+        print(f"Generated {args.apps} apps x {args.files} files of {args.file_size}KB in {time.monotonic() - start:.1f}s")
+        env = bench_env(tree, args)
+        best = {}
+        for _ in range(args.repeat):
+            for subsystem in args.only or SUBSYSTEMS:
+                result_file = os.path.join(tree, f"result_{subsystem}.json")
+                command = [sys.executable, os.path.abspath(__file__), "--worker", subsystem, "--tree", tree, "--result", result_file]
+                command += [arg for arg in sys.argv[1:] if arg not in ("--keep",)]
+                subprocess.run(command, env=env, check=True)
+                with open(result_file) as f:
+                    for row in json.load(f):
+                        # Keep the fastest run of each row, the others mostly measure interference
+                        if row["name"] not in best or row["seconds"] < best[row["name"]]["seconds"]:
+                            best[row["name"]] = row
+        rows = list(best.values())
+        print_rows(rows)
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(rows, f, indent=2)
+        regressions = over_budget(rows)
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions += compare(rows, json.load(f), args.tolerance)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            sys.exit(1)
+        if args.baseline:
+            print("No regressions against the baseline.")
+    finally:
+        if args.keep:
+            print(f"Tree kept at {tree}")
+        else:
+            shutil.rmtree(tree, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+"""Stand-in Docker daemon for the benchmarks and for trying out bin/docker_prune.py.
+
+It serves the parts of the Engine API that prune() and image_prefetch use
+on a unix socket, from a made-up state with an image for every image the
+installed apps reference, orphaned and untagged images, build cache, and
+pulls that "download" at a fixed rate. run_bench.py starts it with serve();
+run it directly to point the scripts at it through TIPI_DOCKER_SOCKET.
+"""
+
+import argparse
+import http.server
+import json
+import os
+import random
+import re
+import socketserver
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, unquote, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bin"))
+
+from docker_prune import DOCKER_SOCKET, RUNTIPI_DIR, referenced_images
+
+PULL_RATE = 200 * 1000 ** 2  # Bytes per second the stand-in daemon "downloads" at
+
+class StubDockerHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for the parts of the Engine API used by prune() and image_prefetch, backed by self.server.state."""
+
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def find_image(self, name):
+        state = self.server.state
+        if name in state["images"]:
+            return state["images"][name], None
+        for image in state["images"].values():
+            if name in image["RepoTags"]:
+                return image, name
+        return None, None
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        path = re.sub(r"^/v[\d.]+", "", parts.path)
+        state = self.server.state
+        with self.server.lock:
+            if path == "/system/df":
+                images = list(state["images"].values())
+                self.reply(200, {"LayersSize": sum(image["Size"] for image in images),
+                                 "Images": images, "BuildCache": state["build_cache"]})
+            elif path == "/containers/json":
+                self.reply(200, state["containers"])
+            elif path.startswith("/images/") and path.endswith("/json"):
+                image, _ = self.find_image(unquote(path[len("/images/"):-len("/json")]))
+                if image is None:
+                    self.reply(404, {"message": "No such image"})
+                else:
+                    self.reply(200, {"Id": image["Id"], "RepoTags": image["RepoTags"], "Size": image["Size"],
+                                     "Metadata": {"LastTagTime": image["LastTagTime"]}})
+            else:
+                self.reply(404, {"message": "page not found"})
+
+    def do_DELETE(self):
+        path = re.sub(r"^/v[\d.]+", "", urlsplit(self.path).path)
+        state = self.server.state
+        with self.server.lock:
+            image, tag = self.find_image(unquote(path[len("/images/"):])) if path.startswith("/images/") else (None, None)
+            if image is None:
+                self.reply(404, {"message": "No such image"})
+            elif tag is None and len(image["RepoTags"]) > 1:
+                self.reply(409, {"message": "image is referenced in multiple repositories"})
+            elif any(container["ImageID"] == image["Id"] for container in state["containers"]) and len(image["RepoTags"]) <= 1:
+                self.reply(409, {"message": "image is being used by a container"})
+            else:
+                result = []
+                if tag:
+                    image["RepoTags"].remove(tag)
+                    result.append({"Untagged": tag})
+                if not image["RepoTags"]:
+                    del state["images"][image["Id"]]
+                    result.append({"Deleted": image["Id"]})
+                self.reply(200, result)
+
+    def send_chunk(self, payload):
+        data = json.dumps(payload).encode() + b"\r\n"
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def pull(self, query):
+        """Stream the progress of a pull like the daemon does, downloading at state["pull_rate"] bytes/s."""
+        state = self.server.state
+        name = query.get("fromImage", [""])[0]
+        reference = f"{name}:{query.get('tag', ['latest'])[0]}"
+        rng = random.Random(reference)
+        layers = [("%012x" % rng.getrandbits(48), rng.randint(5, 50) * 1000 ** 2) for _ in range(rng.randint(1, 3))]
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.send_chunk({"status": f"Pulling from {name}", "id": reference.rsplit(":", 1)[1]})
+        if name.startswith("missing/"):
+            self.send_chunk({"errorDetail": {"message": "manifest unknown"}, "error": "manifest unknown"})
+            # Clients stop reading at the error
+            self.close_connection = True
+            return
+        for layer, size in layers:
+            for step in range(1, 5):
+                time.sleep(size / 4 / state["pull_rate"])
+                self.send_chunk({"status": "Downloading", "id": layer,
+                                 "progressDetail": {"current": size * step // 4, "total": size}})
+            self.send_chunk({"status": "Pull complete", "id": layer})
+        with self.server.lock:
+            image, _ = self.find_image(reference)
+            if image is None:
+                image_id = "sha256:" + "%064x" % rng.getrandbits(256)
+                state["images"][image_id] = {"Id": image_id, "RepoTags": [reference], "RepoDigests": [],
+                                             "Size": sum(size for _, size in layers), "SharedSize": 0,
+                                             "Created": int(time.time()), "Containers": 0,
+                                             "LastTagTime": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")}
+        self.send_chunk({"status": f"Status: Downloaded newer image for {reference}"})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        state = self.server.state
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = re.sub(r"^/v[\d.]+", "", parts.path)
+        if path == "/images/create":
+            self.pull(parse_qs(parts.query))
+            return
+        with self.server.lock:
+            if path != "/build/prune":
+                self.reply(404, {"message": "page not found"})
+                return
+            filters = json.loads(parse_qs(parts.query).get("filters", ["{}"])[0])
+            ids = set(filters.get("id", []))
+            removed = [r for r in state["build_cache"] if not r["InUse"] and (not ids or r["ID"] in ids)]
+            state["build_cache"] = [r for r in state["build_cache"] if r not in removed]
+            self.reply(200, {"CachesDeleted": [r["ID"] for r in removed],
+                             "SpaceReclaimed": sum(r["Size"] for r in removed)})
+
+    def log_message(self, format, *args):
+        pass
+
+class StubDockerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def make_state(runtipi_dir=RUNTIPI_DIR, orphans=20, seed=0, pull_rate=PULL_RATE):
+    """Build a fake daemon state: an image for every referenced image, orphaned and untagged images and build cache.
+
+    Every other app has a container, the rest look like stopped apps.
+    """
+    rng = random.Random(seed)
+    now = time.time()
+    stamp = lambda age: datetime.fromtimestamp(now - age, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    images = {}
+    containers = []
+
+    def add_image(tags, size, age):
+        image_id = "sha256:" + "%064x" % rng.getrandbits(256)
+        images[image_id] = {"Id": image_id, "RepoTags": tags, "RepoDigests": [], "Size": size, "SharedSize": 0,
+                            "Created": int(now - age - 86400), "Containers": 0, "LastTagTime": stamp(age)}
+        return image_id
+
+    keys, _ = referenced_images(runtipi_dir)
+    for i, key in enumerate(sorted(key for key in keys if "@" not in key)):
+        # Tags that are variables in the compose file get a made-up version
+        key = re.sub(r"\$\{[^}]*\}|\$\w+", "1.0", key)
+        image_id = add_image([key], rng.randint(50, 1500) * 1000 ** 2, rng.randint(1, 90) * 86400)
+        if i % 2 == 0:
+            containers.append({"Id": "%064x" % rng.getrandbits(256), "ImageID": image_id, "Image": key})
+    for i in range(orphans):
+        age = rng.randint(0, 365) * 86400
+        size = rng.randint(20, 2000) * 1000 ** 2
+        add_image([f"orphan/app-{i}:1.{rng.randint(0, 9)}"] if i % 4 else [], size, age)
+    build_cache = [{"ID": "%025x" % rng.getrandbits(100), "Type": "regular", "Size": rng.randint(1, 500) * 1000 ** 2,
+                    "InUse": i == 0, "Shared": False, "CreatedAt": stamp(90 * 86400),
+                    "LastUsedAt": stamp(rng.randint(0, 90) * 86400)} for i in range(orphans // 2)]
+    return {"images": images, "containers": containers, "build_cache": build_cache, "pull_rate": pull_rate}
+
+def serve(socket_path=DOCKER_SOCKET, runtipi_dir=RUNTIPI_DIR, orphans=20, pull_rate=PULL_RATE):
+    """Start a stand-in Docker daemon on socket_path in a background thread and return it."""
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = StubDockerServer(socket_path, StubDockerHandler)
+    server.state = make_state(runtipi_dir, orphans, pull_rate=pull_rate)
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, name="docker stub", daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a stand-in Docker daemon for testing.")
+    parser.add_argument("--socket", default=DOCKER_SOCKET, help=f"Socket to listen on (default: {DOCKER_SOCKET})")
+    parser.add_argument("--orphans", type=int, default=20, help="Images no app uses (default: 20)")
+    args = parser.parse_args()
+
+    server = serve(args.socket, orphans=args.orphans)
+    print(f"Stand-in Docker daemon listening on {args.socket}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+"""Stand-in S3 server for the benchmarks and for trying out an s3 backup target.
+
+It serves the parts of the S3 API that bin/backup_targets.py uses
+(listing, PUT/GET/HEAD/DELETE with ranges, multipart uploads), checks
+every request's signature and can let every n-th part upload fail.
+run_bench.py starts it with serve(); run it directly and set the [target]
+of scheduled_tipi_backup.conf to the printed endpoint and keys.
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import http.server
+import os
+import shutil
+import sys
+import threading
+import uuid
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bin"))
+
+from backup_targets import S3_NAMESPACE, canonical_query, signature_v4, xml_children, xml_text
+
+ACCESS_KEY = "tipi"
+SECRET_KEY = "tipi-secret"
+
+class StubS3Handler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for the parts of the S3 API the S3 target uses.
+
+    Objects are kept as files under server.directory/<bucket>/<key> and
+    every request's signature is checked against ACCESS_KEY and SECRET_KEY.
+    With server.fail_every set, every n-th part upload fails.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if "Content-Length" not in (headers or {}):
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_xml(self, status, root, content):
+        self.send(status, f'<?xml version="1.0" encoding="UTF-8"?><{root} xmlns="{S3_NAMESPACE}">{content}</{root}>'.encode(),
+                  {"Content-Type": "application/xml"})
+
+    def error(self, status, code):
+        self.send(status, f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code></Error>'.encode(),
+                  {"Content-Type": "application/xml"})
+
+    def authorized(self, path, query, body):
+        authorization = self.headers.get("Authorization", "")
+        fields = dict(field.strip().split("=", 1) for field in authorization.partition(" ")[2].split(",") if "=" in field)
+        access_key, _, scope = fields.get("Credential", "").partition("/")
+        signed_headers = fields.get("SignedHeaders", "").split(";")
+        payload_hash = self.headers.get("x-amz-content-sha256", "")
+        if access_key != ACCESS_KEY or "host" not in signed_headers or payload_hash != hashlib.sha256(body).hexdigest():
+            return False
+        headers = {name: self.headers.get(name, "") for name in signed_headers}
+        expected_scope, signature = signature_v4(SECRET_KEY, scope.split("/")[1] if scope.count("/") >= 3 else "",
+                                                 self.command, path, canonical_query(parse_qsl(query, keep_blank_values=True)),
+                                                 headers, signed_headers, payload_hash, self.headers.get("x-amz-date", ""))
+        return scope == expected_scope and hmac.compare_digest(signature, fields.get("Signature", ""))
+
+    def handle_request(self):
+        parts = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+        if not self.authorized(parts.path, parts.query, body):
+            self.error(403, "SignatureDoesNotMatch")
+            return
+        params = dict(parse_qsl(parts.query, keep_blank_values=True))
+        bucket, _, key = unquote(parts.path).lstrip("/").partition("/")
+        bucket_dir = os.path.join(self.server.directory, bucket)
+        path = os.path.normpath(os.path.join(bucket_dir, key))
+        if not bucket or bucket.startswith(".") or not (path + "/").startswith(bucket_dir + "/"):
+            self.error(400, "InvalidRequest")
+            return
+        uploads_dir = os.path.join(self.server.directory, ".uploads")
+
+        if not key and self.command == "GET":
+            if "uploads" in params:
+                self.list_uploads(uploads_dir, bucket, params.get("prefix", ""))
+            else:
+                self.list_objects(bucket_dir, params)
+        elif "uploadId" in params:
+            self.multipart(uploads_dir, bucket, key, path, params, body)
+        elif self.command == "POST" and "uploads" in params:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(os.path.join(uploads_dir, upload_id))
+            with open(os.path.join(uploads_dir, upload_id, "key"), "w") as f:
+                f.write(f"{bucket}/{key}")
+            self.send_xml(200, "InitiateMultipartUploadResult",
+                          f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId>")
+        elif self.command == "PUT":
+            if not self.md5_matches(body):
+                self.error(400, "BadDigest")
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+            self.send(200, headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+        elif self.command in ("GET", "HEAD"):
+            self.get_object(path)
+        elif self.command == "DELETE":
+            if os.path.isfile(path):
+                os.remove(path)
+            self.send(204)
+        else:
+            self.error(405, "MethodNotAllowed")
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = handle_request
+
+    def md5_matches(self, body):
+        md5 = self.headers.get("Content-MD5")
+        return md5 is None or md5 == base64.b64encode(hashlib.md5(body).digest()).decode()
+
+    def list_objects(self, bucket_dir, params):
+        prefix = params.get("prefix", "")
+        keys = []
+        for directory, _, files in os.walk(bucket_dir):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), bucket_dir)
+                if key.startswith(prefix) and not name.endswith(".tmp"):
+                    keys.append(key)
+        keys.sort()
+        token = params.get("continuation-token", "")
+        keys = [key for key in keys if key > token]
+        page = keys[:int(params.get("max-keys", 1000))]
+        contents = ""
+        for key in page:
+            st = os.stat(os.path.join(bucket_dir, key))
+            modified = datetime.fromtimestamp(st.st_mtime, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+            contents += f"<Contents><Key>{escape(key)}</Key><LastModified>{modified}</LastModified><Size>{st.st_size}</Size></Contents>"
+        truncated = len(keys) > len(page)
+        next_token = f"<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>" if truncated else ""
+        self.send_xml(200, "ListBucketResult", f"<Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>"
+                                               f"<IsTruncated>{str(truncated).lower()}</IsTruncated>{next_token}{contents}")
+
+    def list_uploads(self, uploads_dir, bucket, prefix):
+        uploads = ""
+        for upload_id in sorted(os.listdir(uploads_dir)) if os.path.isdir(uploads_dir) else []:
+            with open(os.path.join(uploads_dir, upload_id, "key")) as f:
+                upload_bucket, _, key = f.read().partition("/")
+            if upload_bucket == bucket and key.startswith(prefix):
+                uploads += f"<Upload><Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId></Upload>"
+        self.send_xml(200, "ListMultipartUploadsResult", f"<Bucket>{escape(bucket)}</Bucket>{uploads}")
+
+    def multipart(self, uploads_dir, bucket, key, path, params, body):
+        upload_dir = os.path.join(uploads_dir, os.path.basename(params["uploadId"]))
+        if not os.path.isdir(upload_dir):
+            self.error(404, "NoSuchUpload")
+        elif self.command == "PUT":
+            with self.server.lock:
+                self.server.part_uploads += 1
+                fail = self.server.fail_every and self.server.part_uploads % self.server.fail_every == 0
+            if fail:
+                self.error(500, "InternalError")
+            elif not self.md5_matches(body):
+                self.error(400, "BadDigest")
+            else:
+                with open(os.path.join(upload_dir, f"{int(params['partNumber']):05d}"), "wb") as f:
+                    f.write(body)
+                self.send(200, headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+        elif self.command == "POST":
+            md5s = []
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as out:
+                for part in xml_children(ET.fromstring(body), "Part"):
+                    part_path = os.path.join(upload_dir, f"{int(xml_text(part, 'PartNumber')):05d}")
+                    data = b""
+                    if os.path.exists(part_path):
+                        with open(part_path, "rb") as f:
+                            data = f.read()
+                    # Every listed part must have been uploaded with that ETag
+                    if not os.path.exists(part_path) or f'"{hashlib.md5(data).hexdigest()}"' != xml_text(part, "ETag"):
+                        md5s = []
+                        break
+                    md5s.append(hashlib.md5(data).digest())
+                    out.write(data)
+            if not md5s:
+                os.remove(tmp_path)
+                self.error(400, "InvalidPart")
+                return
+            os.replace(tmp_path, path)
+            shutil.rmtree(upload_dir)
+            etag = f"{hashlib.md5(b''.join(md5s)).hexdigest()}-{len(md5s)}"
+            self.send_xml(200, "CompleteMultipartUploadResult",
+                          f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key><ETag>\"{etag}\"</ETag>")
+        elif self.command == "DELETE":
+            shutil.rmtree(upload_dir)
+            self.send(204)
+        else:
+            self.error(405, "MethodNotAllowed")
+
+    def get_object(self, path):
+        if not os.path.isfile(path):
+            self.error(404, "NoSuchKey")
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        status = 200
+        byte_range = self.headers.get("Range", "")
+        if byte_range.startswith("bytes="):
+            first, _, last = byte_range[len("bytes="):].partition("-")
+            start, end = int(first), min(int(last) if last else size - 1, size - 1)
+            if start >= size:
+                self.error(416, "InvalidRange")
+                return
+            status = 206
+        headers = {"Content-Length": str(end - start + 1), "Content-Type": "application/octet-stream"}
+        if status == 206:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        with open(path, "rb") as f:
+            f.seek(start)
+            self.send(status, f.read(end - start + 1) if self.command == "GET" else b"", headers)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(directory, port=0, fail_every=0):
+    """Start a stand-in S3 server keeping its objects in directory, in a background thread, and return it."""
+    os.makedirs(directory, exist_ok=True)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), StubS3Handler)
+    server.daemon_threads = True
+    server.directory = os.path.abspath(directory)
+    server.fail_every = fail_every
+    server.part_uploads = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, name="s3 stub", daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a stand-in S3 server for testing.")
+    parser.add_argument("directory", help="Directory the objects are kept in")
+    parser.add_argument("--port", type=int, default=9000, help="Port to listen on (default: 9000)")
+    parser.add_argument("--fail-every", type=int, default=0, help="Let every n-th part upload fail")
+    args = parser.parse_args()
+
+    server = serve(args.directory, args.port, args.fail_every)
+    print(f"Stand-in S3 server listening on http://127.0.0.1:{server.server_port}, "
+          f"access_key = {ACCESS_KEY}, secret_key = {SECRET_KEY}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,705 @@
+#!/usr/bin/python3
+"""Where archive backups are kept: a local directory, a host over ssh or S3-compatible storage.
+
+Every target takes an archive as a stream while it is being compressed, so
+a backup to another disk, host or bucket is never staged on the install
+drive, and offers what retention, verification and restores need: a
+listing, small sidecar files and reads of (parts of) an archive.
+"""
+
+import argparse
+import base64
+import configparser
+import hashlib
+import hmac
+import http.client
+import os
+import posixpath
+import shlex
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.parse import quote, urlsplit
+from xml.sax.saxutils import escape
+
+import tipi_metrics
+import tipi_paths
+
+CONFIG_FILE = os.path.join(tipi_paths.CONFIG_DIR, "scheduled_tipi_backup.conf")
+DEFAULT_DIR = os.path.join(tipi_paths.RUNTIPI_DIR, "backup")
+TARGET_TYPES = ("local", "ssh", "s3")
+PART_SUFFIX = ".part"  # Archives being written, renamed once complete
+DEFAULT_PART_SIZE_MB = 16
+MIN_PART_SIZE_MB = 5  # S3's smallest part, only the last one may be smaller
+DEFAULT_UPLOAD_WORKERS = 4
+PART_RETRIES = 5  # Attempts per upload part before the backup fails
+REQUEST_TIMEOUT = 120  # Seconds per S3 request
+READ_AHEAD = 8 * 1024 * 1024  # Bytes fetched per ranged GET when reading an archive from S3
+SKIP_LIMIT = 64 * 1024 * 1024  # Seeking further ahead over ssh starts a new read instead of skipping
+S3_NAMESPACE = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+class TargetError(Exception):
+    """Writing an archive to the target failed.
+
+    Not an OSError, so it isn't mistaken for a source file that can't be
+    read and skipped: the backup has to stop.
+    """
+
+PART_RETRY_COUNT = tipi_metrics.counter("tipi_backup_upload_part_retries_total", "Upload parts sent again after a failed attempt.")
+
+class LocalTarget:
+    """Archives in a directory: backup/ in the runtipi directory, or e.g. a mount of another disk."""
+
+    kind = "local"
+    random_access = True
+
+    def __init__(self, directory=DEFAULT_DIR):
+        self.directory = directory
+
+    def __str__(self):
+        return self.directory
+
+    def local_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def location(self, name):
+        return self.local_path(name)
+
+    def list(self):
+        """Return [(name, size)] of every file, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            try:
+                st = os.stat(self.local_path(name))
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                entries.append((st.st_mtime, name, st.st_size))
+        return [(name, size) for _, name, size in sorted(entries)]
+
+    def open_write(self, name):
+        os.makedirs(self.directory, exist_ok=True)
+        return LocalWriter(self.local_path(name))
+
+    def put(self, name, data):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.local_path(name)}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.local_path(name))
+
+    def get(self, name):
+        """Return the content of a file, or None if there is no such file."""
+        try:
+            with open(self.local_path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def open_read(self, name):
+        return open(self.local_path(name), "rb")
+
+    @contextmanager
+    def open_ranges(self, name):
+        """Yield read(offset, length) for reading parts of a file from several threads."""
+        fd = os.open(self.local_path(name), os.O_RDONLY)
+        try:
+            # pread doesn't move a shared file position, so the threads can share one descriptor
+            yield lambda offset, length: os.pread(fd, length, offset)
+        finally:
+            os.close(fd)
+
+    def delete(self, name):
+        try:
+            os.remove(self.local_path(name))
+        except FileNotFoundError:
+            pass
+
+    def cleanup(self):
+        """Remove archives a crashed run left half written."""
+        for name, _ in self.list():
+            if name.endswith(PART_SUFFIX):
+                self.delete(name)
+                print(f"Removed incomplete backup: {name}")
+
+class LocalWriter:
+    """Writes an archive under a temporary name and renames it into place on close()."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path + PART_SUFFIX, "wb")
+
+    def write(self, data):
+        try:
+            return self.file.write(data)
+        except OSError as e:
+            raise TargetError(f"Error writing {self.path}: {e}") from e
+
+    def close(self):
+        self.file.close()
+        os.replace(self.path + PART_SUFFIX, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.path + PART_SUFFIX):
+            os.remove(self.path + PART_SUFFIX)
+
+class SshTarget:
+    """Archives in a directory on another host, piped through ssh.
+
+    The remote host only needs a POSIX shell with cat, mv, rm, tail and
+    GNU find. Authentication must not prompt, so use a key (identity_file).
+    """
+
+    kind = "ssh"
+    random_access = False
+
+    def __init__(self, host, directory, port=22, identity_file=None):
+        self.host = host
+        self.directory = directory
+        self.port = port
+        self.identity_file = identity_file
+
+    def __str__(self):
+        return f"{self.host}:{self.directory}"
+
+    def local_path(self, name):
+        return None
+
+    def location(self, name):
+        return f"{self.host}:{posixpath.join(self.directory, name)}"
+
+    def remote_path(self, name):
+        return shlex.quote(posixpath.join(self.directory, name))
+
+    def command(self, remote_command):
+        command = ["ssh", "-o", "BatchMode=yes", "-p", str(self.port)]
+        if self.identity_file:
+            command += ["-i", self.identity_file]
+        return command + [self.host, remote_command]
+
+    def run(self, remote_command, data=None):
+        """Run a command on the remote host and return its output, raising OSError if it fails."""
+        result = tipi_metrics.run(self.command(remote_command), input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise OSError(f"ssh {self.host}: {result.stderr.decode(errors='replace').strip() or f'exit status {result.returncode}'}")
+        return result.stdout
+
+    def list(self):
+        directory = shlex.quote(self.directory)
+        output = self.run(f"[ -d {directory} ] || exit 0; find {directory} -maxdepth 1 -type f -printf '%T@ %s %f\\n'")
+        entries = []
+        for line in output.decode(errors="replace").splitlines():
+            mtime, size, name = line.split(" ", 2)
+            entries.append((float(mtime), name, int(size)))
+        return [(name, size) for _, name, size in sorted(entries)]
+
+    def open_write(self, name):
+        return SshWriter(self, name)
+
+    def put(self, name, data):
+        tmp_path = self.remote_path(name + ".tmp")
+        self.run(f"mkdir -p {shlex.quote(self.directory)} && cat > {tmp_path} && mv {tmp_path} {self.remote_path(name)}", data)
+
+    def get(self, name):
+        path = self.remote_path(name)
+        output = self.run(f"if [ -e {path} ]; then echo y; cat {path}; else echo n; fi")
+        # The first line tells a missing file from an empty one
+        found, _, data = output.partition(b"\n")
+        return data if found == b"y" else None
+
+    def open_read(self, name):
+        return SshReader(self, name)
+
+    def delete(self, name):
+        self.run(f"rm -f {self.remote_path(name)}")
+
+    def cleanup(self):
+        names = [name for name, _ in self.list() if name.endswith(PART_SUFFIX)]
+        if names:
+            self.run("rm -f " + " ".join(self.remote_path(name) for name in names))
+            for name in names:
+                print(f"Removed incomplete backup: {name}")
+
+class SshWriter:
+    """Pipes an archive into `cat` on the remote host and renames it into place on close()."""
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self.part_path = target.remote_path(name + PART_SUFFIX)
+        self.failure = None
+        # Nothing reads a pipe while the archive streams, and a chatty remote would fill it and stall the upload
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(target.command(f"mkdir -p {shlex.quote(target.directory)} && cat > {self.part_path}"),
+                                        stdin=subprocess.PIPE, stderr=self.stderr)
+
+    def error(self):
+        # Closing the compressor writes again after a failed write, keep the first message
+        if self.failure is None:
+            self.process.wait()
+            self.stderr.seek(0)
+            # The error is at the end, after any banner or warnings
+            lines = self.stderr.read().decode(errors="replace").strip().splitlines()[-3:]
+            message = "\n".join(lines) or f"exit status {self.process.returncode}"
+            self.failure = OSError(f"ssh {self.target.host}: {message}")
+        return self.failure
+
+    def write(self, data):
+        try:
+            # A full pipe blocks, so memory use is bounded by how fast the remote side takes the data
+            self.process.stdin.write(data)
+        except BrokenPipeError:
+            raise TargetError(self.error()) from None
+        return len(data)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self.process.wait() != 0:
+            raise self.error()
+        self.stderr.close()
+        self.target.run(f"mv {self.part_path} {self.target.remote_path(self.name)}")
+
+    def abort(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.stderr.close()
+        try:
+            self.target.run(f"rm -f {self.part_path}")
+        except OSError as e:
+            print(f"Error removing incomplete backup {self.name}: {e}")
+
+class SshReader:
+    """Read-only file object over `tail -c +N` on the remote host.
+
+    Reads are sequential; seeking backwards, or far ahead, starts a new
+    read at that offset.
+    """
+
+    def __init__(self, target, name):
+        self.target = target
+        self.path = target.remote_path(name)
+        self.process = None
+        self.position = 0
+
+    def _start(self, offset):
+        self.close()
+        self.process = subprocess.Popen(self.target.command(f"tail -c +{offset + 1} {self.path}"), stdout=subprocess.PIPE)
+        self.position = offset
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence != os.SEEK_SET:
+            raise OSError("seeking from the end is not supported over ssh")
+        if self.process is None or offset < self.position or offset - self.position > SKIP_LIMIT:
+            self._start(offset)
+        while self.position < offset:
+            if not self.read(min(offset - self.position, 1024 * 1024)):
+                break
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, n=-1):
+        if self.process is None:
+            self._start(self.position)
+        data = self.process.stdout.read(n if n >= 0 else None)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdout.close()
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def canonical_query(params):
+    """Encode query parameters the way AWS Signature V4 expects them, which also serves as the URL query."""
+    return "&".join(f"{quote(str(key), safe='-_.~')}={quote(str(value), safe='-_.~')}" for key, value in sorted(params))
+
+def signature_v4(secret_key, region, method, path, query, headers, signed_headers, payload_hash, amz_date):
+    """Return (credential scope, signature) of a request; headers maps lower-case names to values."""
+    canonical_headers = "".join(f"{name}:{' '.join(str(headers[name]).split())}\n" for name in signed_headers)
+    canonical_request = "\n".join([method, path, query, canonical_headers, ";".join(signed_headers), payload_hash])
+    scope = f"{amz_date[:8]}/{region}/s3/aws4_request"
+    string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()])
+    key = f"AWS4{secret_key}".encode()
+    for part in (amz_date[:8], region, "s3", "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return scope, hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+def xml_children(element, name):
+    return [child for child in element if child.tag in (name, f"{{{S3_NAMESPACE}}}{name}")]
+
+def xml_text(element, name, default=""):
+    children = xml_children(element, name)
+    return children[0].text or default if children else default
+
+class S3Client:
+    """Requests to an S3-compatible service, signed with AWS Signature V4.
+
+    Path-style URLs are used so any endpoint works without DNS for buckets.
+    Every thread keeps its own keep-alive connection.
+    """
+
+    def __init__(self, endpoint, region, access_key, secret_key, timeout=REQUEST_TIMEOUT):
+        parts = urlsplit(endpoint)
+        self.https = parts.scheme == "https"
+        self.host = parts.netloc
+        self.hostname = parts.hostname
+        self.port = parts.port
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = self.local.conn = cls(self.hostname, self.port, timeout=self.timeout)
+        return conn
+
+    def request(self, method, path, params=(), body=b"", headers=None):
+        """Send a signed request and return (status, response headers, body)."""
+        query = canonical_query(params)
+        path = quote(path, safe="/-_.~")
+        amz_date = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        payload_hash = hashlib.sha256(body).hexdigest()
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+        headers.update({"host": self.host, "x-amz-date": amz_date, "x-amz-content-sha256": payload_hash})
+        signed_headers = sorted(headers)
+        scope, signature = signature_v4(self.secret_key, self.region, method, path, query, headers, signed_headers,
+                                        payload_hash, amz_date)
+        headers["authorization"] = (f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+                                    f"SignedHeaders={';'.join(signed_headers)}, Signature={signature}")
+        url = f"{path}?{query}" if query else path
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                response = conn.getresponse()
+                # The body must be read fully before the connection can be reused
+                data = response.read()
+                if response.will_close:
+                    conn.close()
+                    self.local.conn = None
+                return response.status, response.headers, data
+            except (OSError, http.client.HTTPException):
+                # The server may have closed an idle keep-alive connection, retry once on a fresh one
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+
+class S3Target:
+    """Archives as objects under a prefix in an S3-compatible bucket (AWS, MinIO, Backblaze B2, ...).
+
+    Archives are sent as multipart uploads: part_size bytes are collected
+    and up to `workers` parts are uploaded at once, so memory use stays at
+    about part_size * (workers + 1). A failed part is sent again from its
+    buffer, which is only released once the part is stored, and every part
+    carries its MD5 so the service rejects corrupted ones.
+    """
+
+    kind = "s3"
+    random_access = True
+
+    def __init__(self, endpoint, bucket, prefix="", region="us-east-1", access_key="", secret_key="",
+                 part_size=DEFAULT_PART_SIZE_MB * 1024 * 1024, workers=DEFAULT_UPLOAD_WORKERS):
+        self.client = S3Client(endpoint, region, access_key, secret_key)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = part_size
+        self.workers = workers
+
+    def __str__(self):
+        return f"s3://{self.bucket}/{self.prefix}"
+
+    def local_path(self, name):
+        return None
+
+    def location(self, name):
+        return f"s3://{self.bucket}/{self.prefix}{name}"
+
+    def request(self, method, name, params=(), body=b"", headers=None, ok=(200,)):
+        """Send a request for the object name, or for the bucket if name is None; raise OSError unless the status is ok."""
+        path = f"/{self.bucket}" if name is None else f"/{self.bucket}/{self.prefix}{name}"
+        status, response_headers, data = self.client.request(method, path, params, body, headers)
+        # CompleteMultipartUpload can report an error with status 200
+        if status not in ok or data.startswith(b"<?xml") and b"<Error>" in data[:200]:
+            try:
+                code = xml_text(ET.fromstring(data), "Code") or f"HTTP {status}"
+            except ET.ParseError:
+                code = f"HTTP {status}"
+            raise OSError(f"{method} {self if name is None else self.location(name)}: {code}")
+        return status, response_headers, data
+
+    def list(self):
+        entries = []
+        token = None
+        while True:
+            params = [("list-type", "2"), ("prefix", self.prefix)] + ([("continuation-token", token)] if token else [])
+            _, _, data = self.request("GET", None, params)
+            root = ET.fromstring(data)
+            for item in xml_children(root, "Contents"):
+                name = xml_text(item, "Key")[len(self.prefix):]
+                if name and "/" not in name:
+                    modified = datetime.fromisoformat(xml_text(item, "LastModified").replace("Z", "+00:00"))
+                    entries.append((modified, name, int(xml_text(item, "Size", "0"))))
+            token = xml_text(root, "NextContinuationToken")
+            if xml_text(root, "IsTruncated") != "true" or not token:
+                break
+        return [(name, size) for _, name, size in sorted(entries)]
+
+    def open_write(self, name):
+        return S3Writer(self, name)
+
+    def put(self, name, data):
+        self.request("PUT", name, body=data, headers={"Content-MD5": base64.b64encode(hashlib.md5(data).digest()).decode()})
+
+    def get(self, name):
+        status, _, data = self.request("GET", name, ok=(200, 404))
+        return data if status == 200 else None
+
+    def read_range(self, name, offset, length):
+        """Return up to length bytes from offset, b"" past the end."""
+        status, _, data = self.request("GET", name, headers={"Range": f"bytes={offset}-{offset + length - 1}"},
+                                       ok=(200, 206, 416))
+        if status == 416:
+            return b""
+        # A server that ignores Range sends the whole object
+        return data[offset:offset + length] if status == 200 else data
+
+    def open_read(self, name):
+        return S3Reader(self, name)
+
+    @contextmanager
+    def open_ranges(self, name):
+        yield lambda offset, length: self.read_range(name, offset, length)
+
+    def delete(self, name):
+        self.request("DELETE", name, ok=(200, 204, 404))
+
+    def create_upload(self, name):
+        _, _, data = self.request("POST", name, [("uploads", "")])
+        return xml_text(ET.fromstring(data), "UploadId")
+
+    def upload_part(self, name, upload_id, number, data):
+        """Upload one part, sending it again after a failed attempt; return (number, ETag)."""
+        md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+        for attempt in range(PART_RETRIES):
+            try:
+                _, headers, _ = self.request("PUT", name, [("partNumber", number), ("uploadId", upload_id)], data,
+                                             {"Content-MD5": md5})
+                return number, headers.get("ETag", "")
+            except (OSError, http.client.HTTPException) as e:
+                error = e
+            if attempt < PART_RETRIES - 1:
+                PART_RETRY_COUNT.inc()
+                time.sleep(min(2 ** attempt, 30))
+        raise OSError(f"Part {number} of {name} failed {PART_RETRIES} times: {error}")
+
+    def complete_upload(self, name, upload_id, parts):
+        body = "".join(f"<Part><PartNumber>{number}</PartNumber><ETag>{escape(etag)}</ETag></Part>" for number, etag in parts)
+        self.request("POST", name, [("uploadId", upload_id)],
+                     f"<CompleteMultipartUpload>{body}</CompleteMultipartUpload>".encode())
+
+    def abort_upload(self, name, upload_id):
+        self.request("DELETE", name, [("uploadId", upload_id)], ok=(200, 204, 404))
+
+    def cleanup(self):
+        """Abort multipart uploads a crashed run left behind, their parts are stored (and billed) until then."""
+        _, _, data = self.request("GET", None, [("uploads", ""), ("prefix", self.prefix)])
+        for upload in xml_children(ET.fromstring(data), "Upload"):
+            name = xml_text(upload, "Key")[len(self.prefix):]
+            self.abort_upload(name, xml_text(upload, "UploadId"))
+            print(f"Aborted incomplete upload: {name}")
+
+class S3Writer:
+    """Multipart upload fed by write(), with at most `workers` parts in flight.
+
+    Archives smaller than one part are sent with a single PUT on close().
+    """
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self.upload_id = None
+        self.buffer = bytearray()
+        self.parts = []
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=target.workers)
+
+    def write(self, data):
+        self.buffer += data
+        try:
+            while len(self.buffer) >= self.target.part_size:
+                self._submit(bytes(self.buffer[:self.target.part_size]))
+                del self.buffer[:self.target.part_size]
+        except (OSError, http.client.HTTPException) as e:
+            raise TargetError(f"Error uploading {self.target.location(self.name)}: {e}") from e
+        return len(data)
+
+    def _submit(self, part):
+        if self.upload_id is None:
+            self.upload_id = self.target.create_upload(self.name)
+        while len(self.pending) >= self.target.workers:
+            self.parts.append(self.pending.popleft().result())
+        number = len(self.parts) + len(self.pending) + 1
+        self.pending.append(self.executor.submit(self.target.upload_part, self.name, self.upload_id, number, part))
+
+    def close(self):
+        try:
+            if self.upload_id is None:
+                self.target.put(self.name, bytes(self.buffer))
+                return
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self.parts.append(self.pending.popleft().result())
+            self.target.complete_upload(self.name, self.upload_id, self.parts)
+        finally:
+            self.executor.shutdown()
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        if self.upload_id is not None:
+            try:
+                self.target.abort_upload(self.name, self.upload_id)
+            except (OSError, http.client.HTTPException) as e:
+                print(f"Error aborting the upload of {self.name}: {e}")
+
+class S3Reader:
+    """Seekable read-only file object over ranged GETs, fetching READ_AHEAD bytes at a time."""
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self.position = 0
+        self.buffer = b""
+        self.buffer_start = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence != os.SEEK_SET:
+            raise OSError("seeking from the end is not supported")
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, n=-1):
+        if n < 0:
+            chunks = []
+            while chunk := self.read(READ_AHEAD):
+                chunks.append(chunk)
+            return b"".join(chunks)
+        start = self.position - self.buffer_start
+        if start < 0 or start + n > len(self.buffer):
+            self.buffer = self.target.read_range(self.name, self.position, max(n, READ_AHEAD))
+            self.buffer_start, start = self.position, 0
+        data = self.buffer[start:start + n]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.buffer = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_target(config_file=CONFIG_FILE, default_dir=DEFAULT_DIR):
+    """Return the target configured in the [target] section, a LocalTarget on default_dir if there is none."""
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    get = lambda option, fallback="": config.get("target", option, fallback=fallback).strip()
+    kind = get("type", "local").lower() or "local"
+    path = get("path")
+    if kind == "local":
+        return LocalTarget(path or default_dir)
+    if kind == "ssh":
+        if not get("host") or not path:
+            raise ValueError("An ssh backup target needs host and path")
+        return SshTarget(get("host"), path, int(get("port") or 22), get("identity_file") or None)
+    if kind == "s3":
+        if not get("endpoint") or not get("bucket"):
+            raise ValueError("An s3 backup target needs endpoint and bucket")
+        part_size_mb = config.getint("target", "part_size_mb", fallback=DEFAULT_PART_SIZE_MB)
+        if part_size_mb < MIN_PART_SIZE_MB:
+            print(f"part_size_mb must be at least {MIN_PART_SIZE_MB}, using {MIN_PART_SIZE_MB}")
+            part_size_mb = MIN_PART_SIZE_MB
+        prefix = get("prefix")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        return S3Target(get("endpoint"), get("bucket"), prefix, get("region") or "us-east-1", get("access_key"),
+                        get("secret_key"), part_size_mb * 1024 * 1024,
+                        max(config.getint("target", "upload_workers", fallback=DEFAULT_UPLOAD_WORKERS), 1))
+    raise ValueError(f"Unknown backup target type {kind}, use one of {', '.join(TARGET_TYPES)}")
+
+def check_target(target):
+    """Write, read back and remove a small file on the target; return True if that worked."""
+    name = f".tipi-check-{uuid.uuid4().hex[:8]}"
+    data = os.urandom(1024)
+    start = time.monotonic()
+    try:
+        target.put(name, data)
+        if target.get(name) != data:
+            print(f"{target}: the file read back differs from the one written")
+            return False
+        target.delete(name)
+        archives = [entry for entry in target.list() if entry[0].startswith("Tipi_")]
+    except (OSError, ValueError, http.client.HTTPException, ET.ParseError) as e:
+        print(f"{target}: {e}")
+        return False
+    print(f"{target} ({target.kind}) works, {len(archives)} backup files, round trip {time.monotonic() - start:.2f}s")
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the configured backup target.")
+    parser.add_argument("--check", action="store_true", help="Write, read back and remove a small file on the target.")
+    args = parser.parse_args()
+
+    if args.check:
+        try:
+            target = load_target()
+        except ValueError as e:
+            print(e)
+            raise SystemExit(1)
+        raise SystemExit(0 if check_target(target) else 1)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import tipi_paths
+
+RUNTIPI_DIR = tipi_paths.RUNTIPI_DIR
+STATE_DIR = tipi_paths.STATE_DIR
+CACHE_FILE = os.path.join(STATE_DIR, "disk_usage_cache.json")
+SCAN_WORKERS = 8  # Directories listed at the same time
+BIG_FILE_SIZE = 64 * 1024 * 1024  # Files this large are re-checked even in unchanged directories
+GROUPED_DIRS = ("app-data", "media")  # Usage under these is attributed per subdirectory
+
+def scan_dir(path, cached, is_root=False):
+    """List one directory, reusing the cached listing if its mtime is unchanged.
+
+    A directory's mtime only changes when entries are added, removed or
+    renamed, so for an unchanged directory the cached file total is reused
+    and only its big files are stat'ed again to catch files that grew in
+    place (databases, logs, downloads). A scan root may be a symlink, e.g.
+    media pointing to another disk, and is followed.
+    """
+    st = os.stat(path) if is_root else os.lstat(path)
+    if cached and cached["mtime_ns"] == st.st_mtime_ns and cached["dev"] == st.st_dev:
+        record = dict(cached)
+        big = {}
+        own = cached["own"] - sum(cached["big"].values())
+        for name in cached["big"]:
+            try:
+                size = os.lstat(os.path.join(path, name)).st_blocks * 512
+            except OSError:
+                size = 0
+            big[name] = size
+            own += size
+        links = []
+        for dev, ino, size, name in cached["links"]:
+            if size >= BIG_FILE_SIZE:
+                try:
+                    size = os.lstat(os.path.join(path, name)).st_blocks * 512
+                except OSError:
+                    size = 0
+            links.append([dev, ino, size, name])
+        record.update(own=own, big=big, links=links)
+        return path, record, True
+
+    own = 0
+    big = {}
+    links = []
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                est = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISDIR(est.st_mode):
+                # Stay on one filesystem, like du -x; the grouped dirs are roots of their own
+                if est.st_dev == st.st_dev:
+                    subdirs.append(entry.name)
+                continue
+            size = est.st_blocks * 512
+            if est.st_nlink > 1:
+                # Counted once across the whole scan, see scan()
+                links.append([est.st_dev, est.st_ino, size, entry.name])
+                continue
+            own += size
+            if size >= BIG_FILE_SIZE:
+                big[entry.name] = size
+    record = {"mtime_ns": st.st_mtime_ns, "dev": st.st_dev, "own": own, "big": big,
+              "links": links, "subdirs": subdirs}
+    return path, record, False
+
+def load_cache(cache_file=CACHE_FILE):
+    try:
+        with open(cache_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"dirs": {}, "totals": {}, "scanned_at": None}
+
+def save_cache(cache, cache_file=CACHE_FILE):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_path = f"{cache_file}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, separators=(",", ":"))
+    os.replace(tmp_path, cache_file)
+
+def scan(root=RUNTIPI_DIR, cache_file=CACHE_FILE, workers=SCAN_WORKERS):
+    """Scan root in parallel, updating the cache.
+
+    app-data and media are often disks of their own, so they are scanned as
+    roots of their own, and only below each root the scan stays on one
+    filesystem. Returns (totals, previous totals, own, previous own, stats) where totals
+    maps every directory to the bytes used below it and own to the bytes of
+    the files directly in it, counting hard-linked files once.
+    """
+    cache = load_cache(cache_file)
+    cached_dirs = cache["dirs"]
+    dirs = {}
+    stats = {"dirs": 0, "dirs_listed": 0, "seconds": 0.0}
+    start = time.monotonic()
+
+    roots = [root] + [path for path in (os.path.join(root, name) for name in GROUPED_DIRS) if os.path.isdir(path)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan_dir, path, cached_dirs.get(path), True) for path in roots}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    path, record, reused = future.result()
+                except OSError:
+                    continue
+                dirs[path] = record
+                stats["dirs"] += 1
+                stats["dirs_listed"] += not reused
+                for name in record["subdirs"]:
+                    subdir = os.path.join(path, name)
+                    if subdir in roots:
+                        continue
+                    pending.add(executor.submit(scan_dir, subdir, cached_dirs.get(subdir)))
+
+    # Hard links: the first directory in path order owns the inode's blocks
+    seen = set()
+    own = {}
+    for path in sorted(dirs):
+        total = dirs[path]["own"]
+        for dev, ino, size, _ in dirs[path]["links"]:
+            if (dev, ino) not in seen:
+                seen.add((dev, ino))
+                total += size
+        own[path] = total
+
+    # Roll sizes up from the deepest directories
+    totals = dict(own)
+    for path in sorted(dirs, key=lambda p: p.count(os.sep), reverse=True):
+        parent = os.path.dirname(path)
+        if path != root and parent in totals:
+            totals[parent] += totals[path]
+
+    previous = cache.get("totals", {})
+    previous_own = cache.get("own", {})
+    stats["seconds"] = time.monotonic() - start
+    save_cache({"dirs": dirs, "totals": totals, "own": own, "scanned_at": time.time(),
+                "previous_scanned_at": cache.get("scanned_at")}, cache_file)
+    return totals, previous, own, previous_own, stats
+
+def group_name(path, root):
+    """Attribute a path to an app (app-data/<app>), a media folder or a top-level directory."""
+    parts = os.path.relpath(path, root).split(os.sep)
+    if parts[0] == ".":
+        return None
+    if parts[0] in GROUPED_DIRS and len(parts) > 1:
+        return f"{parts[0]}/{parts[1]}"
+    return parts[0]
+
+def summarize(totals, previous, root=RUNTIPI_DIR):
+    """Return [(group, bytes, growth bytes)] for apps, media folders and top-level dirs."""
+    groups = {}
+    for path, total in totals.items():
+        name = group_name(path, root)
+        parts = os.path.relpath(path, root).split(os.sep)
+        # Only the group's own top directory carries its total, app-data and media are split up
+        if name is None or name in GROUPED_DIRS or len(parts) != name.count("/") + 1:
+            continue
+        groups[name] = (total, total - previous.get(path, total))
+    return sorted(((name, total, growth) for name, (total, growth) in groups.items()),
+                  key=lambda g: g[2], reverse=True)
+
+def top_growers(limit=3, root=RUNTIPI_DIR, cache_file=CACHE_FILE):
+    """Rescan incrementally and return the groups that grew the most since the last scan."""
+    totals, previous, _, _, _ = scan(root, cache_file)
+    return [(name, growth) for name, _, growth in summarize(totals, previous, root) if growth > 0][:limit]
+
+def format_size(size, signed=False):
+    sign = "-" if size < 0 else "+" if signed else ""
+    size = abs(size)
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1000:
+            return f"{sign}{size:.0f}{unit}" if unit == "B" else f"{sign}{size:.1f}{unit}"
+        size /= 1000
+    return f"{sign}{size:.1f}TB"
+
+def print_top(limit=10, root=RUNTIPI_DIR, cache_file=CACHE_FILE):
+    """Print usage and growth per app and directory since the last scan."""
+    totals, previous, own, previous_own, stats = scan(root, cache_file)
+    print(f"Scanned {stats['dirs']} directories ({stats['dirs_listed']} changed) in {stats['seconds']:.1f}s")
+    if not previous:
+        print("First scan, growth will be shown from the next scan on.")
+
+    print(f"\n{'App / directory':<40} {'Size':>10} {'Growth':>10}")
+    for name, total, growth in summarize(totals, previous, root)[:limit]:
+        print(f"{name:<40} {format_size(total):>10} {format_size(growth, signed=True):>10}")
+
+    growth = sorted(((size - previous_own.get(path, size), path) for path, size in own.items()), reverse=True)
+    growing = [(delta, path) for delta, path in growth if delta > 0][:limit]
+    if growing:
+        print(f"\n{'Fastest growing directories':<60} {'Growth':>10}")
+        for delta, path in growing:
+            print(f"{os.path.relpath(path, root):<60} {format_size(delta, signed=True):>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Show which apps and directories use and grow disk space.")
+    parser.add_argument("--top", type=int, default=10, help="Number of entries to show (default: 10)")
+    parser.add_argument("--root", default=RUNTIPI_DIR, help=f"Directory to scan (default: {RUNTIPI_DIR})")
+    args = parser.parse_args()
+    print_top(args.top, os.path.abspath(args.root))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+#!/usr/bin/python3
+
+import argparse
+import configparser
+import http.client
+import json
+import os
+import re
+import socket
+import sys
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote, urlencode
+
+from disk_usage import format_size
+from monitor_shares import expand_env, read_env_file
+import tipi_metrics
+import tipi_paths
+
+CONFIG_FILE = os.path.join(tipi_paths.CONFIG_DIR, "docker_prune.conf")
+RUNTIPI_DIR = tipi_paths.RUNTIPI_DIR
+DOCKER_SOCKET = tipi_paths.DOCKER_SOCKET
+API_TIMEOUT = 120  # Seconds per Engine API request, removing a large image can take a while
+DEFAULT_MIN_AGE_HOURS = 24  # Images pulled or tagged more recently are kept, e.g. during an app update
+SIZE_UNITS = {"": 1, "K": 1000, "M": 1000 ** 2, "G": 1000 ** 3, "T": 1000 ** 4}
+IMAGE_PATTERN = re.compile(r'^\s*image\s*:\s*["\']?([^"\'\s#]+)')
+HUB_PREFIXES = ("docker.io/", "index.docker.io/", "registry-1.docker.io/")
+
+PRUNED = tipi_metrics.counter("tipi_docker_pruned_total", "Images and build cache records removed by pruning.", ["kind"])
+PRUNED_BYTES = tipi_metrics.counter("tipi_docker_pruned_bytes_total", "Estimated bytes freed by pruning.", ["kind"])
+DOCKER_USAGE = tipi_metrics.gauge("tipi_docker_usage_bytes", "Bytes used by Docker images and build cache after the last prune.")
+
+class DockerError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Docker API error {status}: {message}")
+        self.status = status
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP over a unix socket, the way the Docker daemon listens by default."""
+
+    def __init__(self, socket_path, timeout=API_TIMEOUT):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class DockerClient:
+    """Minimal Docker Engine API client on one persistent connection."""
+
+    def __init__(self, socket_path=DOCKER_SOCKET):
+        self.socket_path = socket_path
+        self.conn = None
+
+    def request(self, method, path, params=None):
+        if params:
+            path += "?" + urlencode(params)
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = UnixHTTPConnection(self.socket_path)
+            try:
+                self.conn.request(method, path)
+                response = self.conn.getresponse()
+                data = response.read()
+                break
+            except (OSError, http.client.HTTPException):
+                # The daemon may have closed an idle keep-alive connection, retry once on a fresh one
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        if response.will_close:
+            self.conn.close()
+            self.conn = None
+        payload = json.loads(data) if data else None
+        if response.status >= 400:
+            message = payload.get("message") if isinstance(payload, dict) else data.decode(errors="replace")
+            raise DockerError(response.status, message)
+        return payload
+
+    def stream(self, method, path, params=None):
+        """Yield the JSON objects of a streamed response, such as the progress of an image pull."""
+        if params:
+            path += "?" + urlencode(params)
+        # Streams can't be retried halfway, so they get a connection of their own
+        conn = UnixHTTPConnection(self.socket_path)
+        try:
+            conn.request(method, path)
+            response = conn.getresponse()
+            if response.status >= 400:
+                data = response.read()
+                payload = json.loads(data) if data else None
+                message = payload.get("message") if isinstance(payload, dict) else data.decode(errors="replace")
+                raise DockerError(response.status, message)
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            conn.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+def parse_size(value):
+    """Parse a size such as 500M, 20G or 20GB (powers of 1000) into bytes."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+def parse_time(value):
+    """Parse the RFC 3339 timestamps of the Engine API, 0 for missing or zero times."""
+    if not value or value.startswith("0001-"):
+        return 0
+    try:
+        return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return 0
+
+def read_settings():
+    """Return (budget in bytes or None, minimum age in seconds) from the config file."""
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    budget = config.get("prune", "budget", fallback="").strip()
+    min_age_hours = config.getfloat("prune", "min_age_hours", fallback=DEFAULT_MIN_AGE_HOURS)
+    return (parse_size(budget) if budget else None), min_age_hours * 3600
+
+def normalize_reference(reference):
+    """Return the keys an image reference matches in RepoTags / RepoDigests.
+
+    Compose files may spell Docker Hub images in full (docker.io/library/
+    redis) while the daemon lists them short (redis:latest), so the hub
+    prefixes are dropped and a missing tag means latest.
+    """
+    name, _, digest = reference.partition("@")
+    tag = None
+    if ":" in name.rsplit("/", 1)[-1]:
+        name, tag = name.rsplit(":", 1)
+    for prefix in HUB_PREFIXES:
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+    if name.startswith("library/"):
+        name = name[len("library/"):]
+    keys = set()
+    if digest:
+        keys.add(f"{name}@{digest}")
+    if tag or not digest:
+        keys.add(f"{name}:{tag or 'latest'}")
+    return name, keys
+
+def compose_files(runtipi_dir=RUNTIPI_DIR):
+    """Return {app: (compose files, app env file)} for runtipi itself and every installed app."""
+    files = {"runtipi": ([os.path.join(runtipi_dir, "docker-compose.yml")], None)}
+    apps_dir = os.path.join(runtipi_dir, "apps")
+    if os.path.isdir(apps_dir):
+        for app_name in sorted(os.listdir(apps_dir)):
+            if os.path.isdir(os.path.join(apps_dir, app_name)):
+                files[app_name] = ([os.path.join(apps_dir, app_name, "docker-compose.yml"),
+                                    os.path.join(runtipi_dir, "user-config", app_name, "docker-compose.yml")],
+                                   os.path.join(runtipi_dir, "app-data", app_name, "app.env"))
+    return files
+
+def compose_references(path, env):
+    """Return the image references of a docker-compose.yml with env expanded, [] if it can't be read."""
+    try:
+        with open(path, "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return []
+    references = []
+    for line in lines:
+        match = IMAGE_PATTERN.match(line)
+        if match:
+            references.append(expand_env(match.group(1), env))
+    return references
+
+def compose_env(runtipi_dir, app_name, app_env_file=None):
+    """Variables the compose files of an app are expanded with, like runtipi does."""
+    env = {"ROOT_FOLDER_HOST": runtipi_dir, "STORAGE_PATH": runtipi_dir}
+    env.update(read_env_file(os.path.join(runtipi_dir, ".env")))
+    env["APP_ID"] = app_name
+    if app_env_file:
+        env.update(read_env_file(app_env_file))
+    return env
+
+def referenced_images(runtipi_dir=RUNTIPI_DIR):
+    """Return ({reference key: app}, {repository: app}) for the images Tipi's compose files use.
+
+    Apps that are stopped, e.g. by the share monitor, have no containers,
+    so their images can only be protected through their compose files.
+    References whose tag is still a variable after expansion protect every
+    tag of the repository.
+    """
+    keys = {}
+    repositories = {}
+    for app_name, (paths, app_env_file) in compose_files(runtipi_dir).items():
+        env = compose_env(runtipi_dir, app_name, app_env_file)
+        for path in paths:
+            for reference in compose_references(path, env):
+                name, reference_keys = normalize_reference(reference)
+                if "$" in name:
+                    continue
+                if "$" in reference:
+                    repositories.setdefault(name, app_name)
+                for key in reference_keys:
+                    keys.setdefault(key, app_name)
+    return keys, repositories
+
+def image_keys(image):
+    """Return the reference keys of an image's tags and digests."""
+    keys = set()
+    for reference in (image.get("RepoTags") or []) + (image.get("RepoDigests") or []):
+        if not reference.startswith("<none>"):
+            keys |= normalize_reference(reference)[1]
+    return keys
+
+def image_name(image):
+    tags = [tag for tag in image.get("RepoTags") or [] if tag != "<none>:<none>"]
+    return ", ".join(tags) if tags else f"<none> {image['Id'].split(':')[-1][:12]}"
+
+def find_candidates(client, runtipi_dir=RUNTIPI_DIR, min_age=DEFAULT_MIN_AGE_HOURS * 3600, now=None):
+    """Return (bytes used by images and build cache, [candidate], [(image, reason) kept]).
+
+    A candidate is an image or build cache record that no Tipi app and no
+    container (running or stopped) uses and that was not pulled, tagged or
+    used within min_age seconds.
+    """
+    now = now or time.time()
+    df = client.request("GET", "/system/df", [("type", "image"), ("type", "build-cache")])
+    keys, repositories = referenced_images(runtipi_dir)
+    in_use = {container.get("ImageID") for container in client.request("GET", "/containers/json", {"all": 1})}
+
+    candidates = []
+    kept = []
+    for image in df.get("Images") or []:
+        app_name = next((keys[key] for key in image_keys(image) if key in keys), None)
+        if app_name is None:
+            repos = {key.rsplit(":", 1)[0] for key in image_keys(image) if "@" not in key}
+            app_name = next((repositories[repo] for repo in repos if repo in repositories), None)
+        if app_name:
+            kept.append((image, f"used by {app_name}"))
+            continue
+        if image["Id"] in in_use:
+            kept.append((image, "used by a container"))
+            continue
+        details = client.request("GET", f"/images/{quote(image['Id'], safe=':')}/json")
+        last_used = max(parse_time(details.get("Metadata", {}).get("LastTagTime")), image.get("Created", 0))
+        if now - last_used < min_age:
+            kept.append((image, "recently pulled"))
+            continue
+        shared = image.get("SharedSize", -1)
+        candidates.append({
+            "kind": "image",
+            "id": image["Id"],
+            "name": image_name(image),
+            "tags": [tag for tag in image.get("RepoTags") or [] if tag != "<none>:<none>"],
+            "size": image["Size"] - shared if shared > 0 else image["Size"],
+            "last_used": last_used,
+        })
+
+    for record in df.get("BuildCache") or []:
+        last_used = parse_time(record.get("LastUsedAt")) or parse_time(record.get("CreatedAt"))
+        if record.get("InUse") or now - last_used < min_age:
+            continue
+        candidates.append({
+            "kind": "build-cache",
+            "id": record["ID"],
+            "name": f"build cache {record['ID'][:12]} ({record.get('Type', 'unknown')})",
+            # Shared records are also part of images, removing them frees nothing
+            "size": 0 if record.get("Shared") else record.get("Size", 0),
+            "last_used": last_used,
+        })
+
+    used = df.get("LayersSize", 0) + sum(record.get("Size", 0) for record in df.get("BuildCache") or [])
+    return used, candidates, kept
+
+def plan_prune(used, candidates, budget=None, now=None):
+    """Pick the candidates to remove to bring usage down to budget bytes.
+
+    Untagged images go first since nothing can use them again by name,
+    then the rest by size times idle time, so big images that have not
+    been used for a long time go before small or recently used ones.
+    Without a budget every candidate is removed.
+    """
+    now = now or time.time()
+    ranked = sorted(candidates, key=lambda c: (c["kind"] != "image" or bool(c["tags"]),
+                                              -c["size"] * max(now - c["last_used"], 1)))
+    if budget is None:
+        return ranked
+    plan = []
+    to_free = used - budget
+    for candidate in ranked:
+        if to_free <= 0:
+            break
+        if candidate["size"] <= 0:
+            continue
+        plan.append(candidate)
+        to_free -= candidate["size"]
+    return plan
+
+def remove(client, candidate):
+    """Remove one image or build cache record, return False if Docker refused."""
+    try:
+        if candidate["kind"] == "build-cache":
+            client.request("POST", "/build/prune", {"filters": json.dumps({"id": [candidate["id"]]})})
+        elif candidate["tags"]:
+            # Untag one name at a time, Docker removes the image with its last tag
+            for tag in candidate["tags"]:
+                client.request("DELETE", f"/images/{quote(tag, safe='/:@')}")
+        else:
+            client.request("DELETE", f"/images/{quote(candidate['id'], safe=':')}")
+    except DockerError as e:
+        print(f"Kept {candidate['name']}: {e}")
+        return False
+    PRUNED.inc(kind=candidate["kind"])
+    PRUNED_BYTES.inc(candidate["size"], kind=candidate["kind"])
+    return True
+
+def prune(budget=None, min_age=DEFAULT_MIN_AGE_HOURS * 3600, dry_run=False, runtipi_dir=RUNTIPI_DIR,
+          socket_path=DOCKER_SOCKET, verbose=False):
+    """Remove unused images and build cache down to budget bytes, return the bytes freed."""
+    client = DockerClient(socket_path)
+    try:
+        now = time.time()
+        used, candidates, kept = find_candidates(client, runtipi_dir, min_age, now)
+        plan = plan_prune(used, candidates, budget, now)
+        if verbose:
+            for image, reason in kept:
+                print(f"Keeping {image_name(image)} ({reason})")
+        target = "all unused" if budget is None else f"budget {format_size(budget)}"
+        print(f"Docker uses {format_size(used)} ({target}), {len(candidates)} unused entries, "
+              f"removing {len(plan)}{' (dry run)' if dry_run else ''}")
+
+        freed = 0
+        for candidate in plan:
+            idle_days = (now - candidate["last_used"]) / 86400 if candidate["last_used"] else float("inf")
+            print(f"  {candidate['name']:<60} {format_size(candidate['size']):>9}  unused for {idle_days:.0f} days")
+            if dry_run or remove(client, candidate):
+                freed += candidate["size"]
+        if not dry_run:
+            after = client.request("GET", "/system/df", [("type", "image"), ("type", "build-cache")])
+            used = after.get("LayersSize", 0) + sum(record.get("Size", 0) for record in after.get("BuildCache") or [])
+            DOCKER_USAGE.set(used)
+            tipi_metrics.write_textfile("docker_prune")
+        if dry_run:
+            print(f"Would free about {format_size(freed)}")
+        else:
+            print(f"Freed about {format_size(freed)}, Docker now uses {format_size(used)}")
+        return freed
+    finally:
+        client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Remove Docker images and build cache no Tipi app uses.")
+    parser.add_argument("--budget", help="Prune until images and build cache use at most this much, e.g. 20G "
+                                         "(default: from docker_prune.conf, 0 removes everything unused)")
+    parser.add_argument("--min-age-hours", type=float, help="Keep images pulled or used more recently than this")
+    parser.add_argument("--dry-run", action="store_true", help="Only show what would be removed")
+    parser.add_argument("--verbose", action="store_true", help="Also list the images that are kept and why")
+    parser.add_argument("--socket", default=DOCKER_SOCKET, help=f"Docker socket (default: {DOCKER_SOCKET})")
+    args = parser.parse_args()
+
+    budget, min_age = read_settings()
+    if args.budget is not None:
+        budget = parse_size(args.budget)
+    if args.min_age_hours is not None:
+        min_age = args.min_age_hours * 3600
+    try:
+        prune(budget, min_age, args.dry_run, socket_path=args.socket, verbose=args.verbose)
+    except (OSError, http.client.HTTPException, DockerError) as e:
+        print(f"Error talking to Docker on {args.socket}: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
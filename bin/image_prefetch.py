@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+"""Pull the images of pending app updates ahead of the update window.
+
+`runtipi-cli app update` stops an app and only then pulls its new images,
+so on a slow link the app is down for the whole download. Run hours
+earlier, this resolves the images that the updated compose files in repos/
+(and the current ones in apps/) need, pulls the missing ones in parallel
+while the apps keep running, and records per app how many bytes were
+fetched and how long that took, i.e. the downtime the update is spared.
+"""
+
+import argparse
+import collections
+import configparser
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote
+
+from disk_usage import format_size
+from docker_prune import DockerClient, DockerError, compose_env, compose_files, compose_references, normalize_reference, parse_size
+import tipi_metrics
+import tipi_paths
+
+CONFIG_FILE = os.path.join(tipi_paths.CONFIG_DIR, "image_prefetch.conf")
+RUNTIPI_DIR = tipi_paths.RUNTIPI_DIR
+DOCKER_SOCKET = tipi_paths.DOCKER_SOCKET
+REPORT_FILE = os.path.join(tipi_paths.STATE_DIR, "image_prefetch.json")
+DEFAULT_WORKERS = 3  # Images pulled at the same time
+RATE_WINDOW = 5  # Seconds the download rate is averaged over
+
+PREFETCHED_IMAGES = tipi_metrics.gauge("tipi_prefetch_images", "Images handled by the last prefetch run.", ["outcome"])
+PREFETCHED_BYTES = tipi_metrics.gauge("tipi_prefetch_bytes", "Bytes downloaded by the last prefetch run.")
+PREFETCH_DURATION = tipi_metrics.gauge("tipi_prefetch_duration_seconds", "Time taken by the last prefetch run.")
+
+def read_settings():
+    """Return (parallel pulls, download cap in bytes per second or None) from the config file."""
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    workers = config.getint("prefetch", "workers", fallback=DEFAULT_WORKERS)
+    max_rate = config.get("prefetch", "max_rate", fallback="").strip()
+    return max(workers, 1), (parse_size(max_rate) if max_rate else None)
+
+def read_tipi_version(config_path):
+    """Return the tipi_version from an app config.json, or None if unavailable."""
+    try:
+        with open(config_path, "r") as f:
+            return int(json.load(f)["tipi_version"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def pending_updates(runtipi_dir=RUNTIPI_DIR):
+    """Return {app: (installed version, new version, compose file of the new version)}.
+
+    Like the app updates, the newest version any app store repo offers is
+    the one an installed app will be updated to.
+    """
+    apps_dir = os.path.join(runtipi_dir, "apps")
+    repos_dir = os.path.join(runtipi_dir, "repos")
+    repos = sorted(os.listdir(repos_dir)) if os.path.isdir(repos_dir) else []
+    pending = {}
+    for app_name in sorted(os.listdir(apps_dir)) if os.path.isdir(apps_dir) else []:
+        installed = read_tipi_version(os.path.join(apps_dir, app_name, "config.json"))
+        newest = None
+        for repo in repos:
+            app_dir = os.path.join(repos_dir, repo, "apps", app_name)
+            version = read_tipi_version(os.path.join(app_dir, "config.json"))
+            if version is not None and (newest is None or version > newest[0]):
+                newest = (version, os.path.join(app_dir, "docker-compose.yml"))
+        if newest and installed is not None and newest[0] > installed:
+            pending[app_name] = (installed, newest[0], newest[1])
+    return pending
+
+def required_images(runtipi_dir=RUNTIPI_DIR):
+    """Return ({image key: set of apps}, pending updates, [(app, reference)] that can't be resolved).
+
+    Covers the compose files the apps run with now and the ones of their
+    pending updates, so images removed since the last start are fetched too.
+    """
+    pending = pending_updates(runtipi_dir)
+    images = collections.defaultdict(set)
+    unresolved = []
+    for app_name, (paths, app_env_file) in compose_files(runtipi_dir).items():
+        env = compose_env(runtipi_dir, app_name, app_env_file)
+        if app_name in pending:
+            paths = paths + [pending[app_name][2]]
+        for path in paths:
+            for reference in compose_references(path, env):
+                if "$" in reference:
+                    unresolved.append((app_name, reference))
+                    continue
+                name, keys = normalize_reference(reference)
+                # The digest pins the image when there is one, otherwise the tag
+                key = next((key for key in keys if "@" in key), next(iter(keys)))
+                images[key].add(app_name)
+    return images, pending, unresolved
+
+def is_present(client, key):
+    try:
+        client.request("GET", f"/images/{quote(key, safe='/:@')}/json")
+        return True
+    except DockerError as e:
+        if e.status == 404:
+            return False
+        raise
+
+class RateGate:
+    """Download rate of all pulls together; new pulls wait while it is above max_rate.
+
+    The daemon does the downloading and can't be slowed down from here, so
+    the cap is kept by holding back further pulls, not by throttling the
+    running ones. Set workers to 1 for the strictest cap.
+    """
+
+    def __init__(self, max_rate=None):
+        self.max_rate = max_rate
+        self.samples = collections.deque()
+        self.lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self.lock:
+            self.samples.append((time.monotonic(), nbytes))
+
+    def rate(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.samples and self.samples[0][0] < now - RATE_WINDOW:
+                self.samples.popleft()
+            return sum(nbytes for _, nbytes in self.samples) / RATE_WINDOW
+
+    def wait(self):
+        while self.max_rate and self.rate() > self.max_rate:
+            time.sleep(0.5)
+
+def pull(client, key, gate):
+    """Pull one image; return (bytes downloaded, seconds)."""
+    if "@" in key:
+        params = {"fromImage": key}
+    else:
+        name, tag = key.rsplit(":", 1)
+        params = {"fromImage": name, "tag": tag}
+    gate.wait()
+    start = time.monotonic()
+    downloaded = {}  # Layer id -> [bytes so far, total]
+    for event in client.stream("POST", "/images/create", params):
+        if "error" in event:
+            raise DockerError(500, event["error"])
+        layer = downloaded.get(event.get("id"))
+        detail = event.get("progressDetail") or {}
+        if event.get("status") == "Downloading" and detail.get("total"):
+            if layer is None:
+                layer = downloaded[event["id"]] = [0, detail["total"]]
+            gate.add(detail["current"] - layer[0])
+            layer[0] = detail["current"]
+        elif event.get("status") in ("Download complete", "Pull complete") and layer is not None:
+            gate.add(layer[1] - layer[0])
+            layer[0] = layer[1]
+    return sum(total for _, total in downloaded.values()), time.monotonic() - start
+
+def load_report():
+    try:
+        with open(REPORT_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_report(report):
+    try:
+        os.makedirs(os.path.dirname(REPORT_FILE), exist_ok=True)
+        tmp_path = f"{REPORT_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(report, f, indent=1)
+        os.replace(tmp_path, REPORT_FILE)
+    except OSError as e:
+        print(f"Error saving prefetch report: {e}")
+
+def prefetch(workers=DEFAULT_WORKERS, max_rate=None, dry_run=False, runtipi_dir=RUNTIPI_DIR, socket_path=DOCKER_SOCKET):
+    """Pull every missing image of the installed apps and their pending updates; return the report."""
+    start = time.monotonic()
+    images, pending, unresolved = required_images(runtipi_dir)
+    for app_name, reference in unresolved:
+        print(f"Skipping {reference} of {app_name}: its name still contains a variable")
+    for app_name, (installed, version, _) in pending.items():
+        print(f"{app_name}: update from version {installed} to {version} pending")
+
+    client = DockerClient(socket_path)
+    try:
+        missing = [key for key in sorted(images) if not is_present(client, key)]
+        print(f"{len(images)} images needed, {len(missing)} missing"
+              + (f", pulling {min(workers, len(missing))} at a time" if missing and not dry_run else ""))
+        if dry_run:
+            for key in missing:
+                print(f"  {key} for {', '.join(sorted(images[key]))}")
+            return None
+
+        gate = RateGate(max_rate)
+
+        def fetch(key):
+            try:
+                nbytes, seconds = pull(client, key, gate)
+            except (OSError, http.client.HTTPException, DockerError) as e:
+                print(f"  {key}: failed, {e}", flush=True)
+                return key, None, None
+            print(f"  {key}: {format_size(nbytes)} in {seconds:.1f}s", flush=True)
+            return key, nbytes, seconds
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(fetch, missing))
+    finally:
+        client.close()
+
+    # Downloads of earlier runs still count for updates that are still pending
+    previous = load_report().get("apps", {})
+    apps = {app_name: entry for app_name, entry in previous.items()
+            if app_name in pending and entry["version"] == pending[app_name][1]}
+    report = {"time": time.time(), "seconds": round(time.monotonic() - start, 1), "apps": apps, "failed": []}
+    for key, nbytes, seconds in results:
+        if nbytes is None:
+            report["failed"].append(key)
+            continue
+        for app_name in images[key]:
+            # Each app would have waited for the download in its own update
+            entry = report["apps"].setdefault(app_name, {"version": pending.get(app_name, (None, None))[1],
+                                                         "images": 0, "bytes": 0, "seconds": 0.0})
+            entry["images"] += 1
+            entry["bytes"] += nbytes
+            entry["seconds"] = round(entry["seconds"] + seconds, 1)
+    save_report(report)
+
+    PREFETCHED_IMAGES.set(len(missing) - len(report["failed"]), outcome="pulled")
+    PREFETCHED_IMAGES.set(len(report["failed"]), outcome="failed")
+    PREFETCHED_IMAGES.set(len(images) - len(missing), outcome="present")
+    PREFETCHED_BYTES.set(sum(nbytes for _, nbytes, _ in results if nbytes))
+    PREFETCH_DURATION.set(report["seconds"])
+    tipi_metrics.write_textfile("image_prefetch")
+    print_report(report)
+    return report
+
+def print_report(report=None):
+    report = load_report() if report is None else report
+    if not report:
+        print("No prefetch has run yet.")
+        return
+    when = datetime.fromtimestamp(report["time"]).strftime("%Y-%m-%d %H:%M")
+    print(f"Prefetch of {when}, took {report['seconds']:.0f}s:")
+    if report["apps"]:
+        print(f"  {'App':<30} {'Images':>6} {'Downloaded':>11} {'Downtime saved':>15}")
+    for app_name, entry in sorted(report["apps"].items(), key=lambda item: item[1]["seconds"], reverse=True):
+        print(f"  {app_name:<30} {entry['images']:>6} {format_size(entry['bytes']):>11} {entry['seconds']:>14.0f}s")
+    if not report["apps"]:
+        print("  Nothing was missing.")
+    for key in report["failed"]:
+        print(f"  Failed: {key}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Pull the images of pending app updates while the apps keep running.")
+    parser.add_argument("--dry-run", action="store_true", help="Only show the images that would be pulled")
+    parser.add_argument("--report", action="store_true", help="Show what the last prefetch downloaded")
+    parser.add_argument("--workers", type=int, help=f"Images pulled at the same time (default: from image_prefetch.conf, {DEFAULT_WORKERS})")
+    parser.add_argument("--max-rate", help="Hold back further pulls above this many bytes per second, e.g. 5M (default: from image_prefetch.conf)")
+    parser.add_argument("--socket", default=DOCKER_SOCKET, help=f"Docker socket (default: {DOCKER_SOCKET})")
+    args = parser.parse_args()
+
+    if args.report:
+        print_report()
+        return
+    workers, max_rate = read_settings()
+    if args.workers:
+        workers = args.workers
+    if args.max_rate is not None:
+        max_rate = parse_size(args.max_rate) or None
+    try:
+        report = prefetch(workers, max_rate, args.dry_run, socket_path=args.socket)
+    except (OSError, http.client.HTTPException, DockerError) as e:
+        print(f"Error talking to Docker on {args.socket}: {e}")
+        sys.exit(1)
+    if report and report["failed"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
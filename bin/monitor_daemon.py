@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import configparser
+import os
+import signal
+import threading
+import time
+import traceback
+
+import monitor_drive_health
+import monitor_sensor
+import monitor_shares
+import monitor_space
+import tipi_metrics
+import tipi_paths
+
+CONFIG_FILE = os.path.join(tipi_paths.CONFIG_DIR, "monitor_daemon.conf")
+DEFAULT_TIMEOUT = 300  # Seconds a single check may run before it is reported as hung
+METRICS_INTERVAL = 15  # Seconds between metrics textfile updates
+
+CHECK_DURATION = tipi_metrics.histogram("tipi_check_duration_seconds", "Time taken by one tick of a check.", ["check"])
+CHECK_FAILURES = tipi_metrics.counter("tipi_check_failures_total", "Check ticks that failed, timed out or were skipped.", ["check", "reason"])
+CHECK_UP = tipi_metrics.gauge("tipi_check_up", "1 if the last tick of a check succeeded.", ["check"])
+CHECK_LAST_SUCCESS = tipi_metrics.gauge("tipi_check_last_success_timestamp_seconds", "Time of the last successful tick of a check.", ["check"])
+
+# Check name (config section) -> factory returning an object with tick() and interval,
+# or None when the check is not configured. tick() may return the delay until the
+# next tick, and an optional wait_for_event(timeout) replaces the sleep between ticks.
+# On reload or stop an optional wake() ends that wait, and an optional close() releases
+# the check's files once none of its threads use them any more.
+CHECKS = {
+    "mount_points": lambda debug: monitor_shares.MountCheck(),
+    "drive_space": lambda debug: monitor_space.SpaceCheck(debug),
+    "temp_sensor": lambda debug: monitor_sensor.load_check(debug),
+    "drive_health": lambda debug: monitor_drive_health.DriveHealthCheck(),
+}
+
+def log(message):
+    print(message, flush=True)
+
+def read_config():
+    """Return {check name: (interval or None, timeout)} for the enabled checks."""
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    enabled = {}
+    for name in CHECKS:
+        if config.getboolean(name, "enabled", fallback=False):
+            interval = config.getint(name, "interval", fallback=0) or None
+            timeout = config.getint(name, "timeout", fallback=DEFAULT_TIMEOUT)
+            enabled[name] = (interval, timeout)
+    return enabled
+
+def call(func, *args):
+    """Run func in a worker thread, turning sys.exit() into an ordinary error."""
+    try:
+        return func(*args)
+    except SystemExit as e:
+        raise RuntimeError(f"exited with status {e.code}")
+
+def in_thread(func, *args):
+    """Run func(*args) in a daemon thread; return a future for its result.
+
+    Ticks can hang in statvfs on a stale mount or in smartctl. Unlike the
+    default executor's threads, a daemon thread stuck there never holds up
+    the daemon's exit.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def finish(result, error):
+        if not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def run():
+        result, error = None, None
+        try:
+            result = call(func, *args)
+        except Exception as e:
+            error = e
+        try:
+            loop.call_soon_threadsafe(finish, result, error)
+        except RuntimeError:
+            pass  # The loop is closed, nobody waits for the result any more
+
+    threading.Thread(target=run, name=getattr(func, "__name__", "check"), daemon=True).start()
+    return future
+
+def close_check(name, check, busy):
+    """Call check.close() once none of the busy futures (its threads) are running any more."""
+    if not hasattr(check, "close"):
+        return
+    remaining = {future for future in busy if future is not None and not future.done()}
+
+    def done(future=None):
+        remaining.discard(future)
+        if not remaining:
+            try:
+                check.close()
+            except OSError as e:
+                log(f"{name}: failed to close: {e}")
+
+    if not remaining:
+        done()
+    for future in list(remaining):
+        future.add_done_callback(done)
+
+def timed_tick(name, check):
+    with CHECK_DURATION.time(check=name):
+        return check.tick()
+
+async def export_metrics():
+    """Write the metrics textfile for node-exporter every METRICS_INTERVAL seconds."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await in_thread(tipi_metrics.write_textfile, "monitors")
+        await asyncio.sleep(METRICS_INTERVAL)
+
+async def run_check(name, interval, timeout, debug):
+    """Run one check forever on its own interval.
+
+    Every tick runs in a worker thread with a timeout, and any error is
+    logged and contained here so it never affects the other checks. When
+    the task is cancelled on reload or stop, a check waiting for an event
+    is woken and the check is closed once its threads are done.
+    """
+    try:
+        check = await asyncio.wait_for(in_thread(CHECKS[name], debug), timeout)
+    except Exception as e:
+        log(f"{name}: failed to start: {e!r}")
+        return
+    if check is None:
+        log(f"{name}: not configured, skipping")
+        return
+
+    interval = interval or check.interval
+    log(f"{name}: checking every {interval}s")
+    running = waiting = None
+    try:
+        while True:
+            delay = interval
+            if running is not None and not running.done():
+                # A hung tick keeps its thread, never start a second one beside it
+                log(f"{name}: previous check is still running, skipping this tick")
+                CHECK_FAILURES.inc(check=name, reason="skipped")
+            else:
+                running = in_thread(timed_tick, name, check)
+                try:
+                    delay = await asyncio.wait_for(asyncio.shield(running), timeout) or interval
+                    CHECK_UP.set(1, check=name)
+                    CHECK_LAST_SUCCESS.set(time.time(), check=name)
+                except asyncio.TimeoutError:
+                    log(f"{name}: check timed out after {timeout}s")
+                    CHECK_FAILURES.inc(check=name, reason="timeout")
+                    CHECK_UP.set(0, check=name)
+                except Exception:
+                    log(f"{name}: check failed:\n{traceback.format_exc()}")
+                    CHECK_FAILURES.inc(check=name, reason="error")
+                    CHECK_UP.set(0, check=name)
+            if hasattr(check, "wait_for_event"):
+                # Checks that can block on a kernel event wake up early when it fires
+                waiting = in_thread(check.wait_for_event, delay)
+                await asyncio.shield(waiting)
+            else:
+                await asyncio.sleep(delay)
+    finally:
+        if hasattr(check, "wake") and waiting is not None and not waiting.done():
+            check.wake()
+        close_check(name, check, [running, waiting])
+
+async def serve(debug=False):
+    """Run the enabled checks until SIGTERM, reloading the config on SIGHUP."""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    reload = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    loop.add_signal_handler(signal.SIGHUP, reload.set)
+
+    _, address, port = tipi_metrics.read_config()
+    if port:
+        try:
+            tipi_metrics.serve_http(port, address)
+            log(f"Serving metrics on http://{address}:{port}/metrics")
+        except OSError as e:
+            log(f"Failed to serve metrics on {address}:{port}: {e}")
+    exporter = asyncio.create_task(export_metrics())
+
+    while not stop.is_set():
+        enabled = read_config()
+        if not enabled:
+            log("No checks enabled.")
+        tasks = [asyncio.create_task(run_check(name, interval, timeout, debug))
+                 for name, (interval, timeout) in enabled.items()]
+
+        waiters = [asyncio.create_task(stop.wait()), asyncio.create_task(reload.wait())]
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for task in tasks + waiters:
+            task.cancel()
+        await asyncio.gather(*tasks, *waiters, return_exceptions=True)
+        if reload.is_set():
+            log("Reloading configuration.")
+            reload.clear()
+    exporter.cancel()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run all enabled Tipi monitors in one process.")
+    parser.add_argument("--debug", action="store_true", help="Enable debug output")
+    args = parser.parse_args()
+    asyncio.run(serve(args.debug))
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,55 @@
 #!/usr/bin/python3
 import os
+import json
 import subprocess
 import sys
 import argparse
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tipi_notify import notify
+import tipi_metrics
+import tipi_paths
+import tipi_timeseries
 
 SERVICE_NAME = "drive-health-monitor.service"
 SERVICE_FILE_PATH = f"/etc/systemd/system/{SERVICE_NAME}"
 SCRIPT_PATH = os.path.abspath(__file__)
-CHECK_INTERVAL = 86400  # Default: 24 hours (in seconds)
+CHECK_INTERVAL = 21600  # Default: 6 hours (in seconds), sleeping drives are not woken up
+POLL_WORKERS = 8  # Drives queried at the same time
+
+# Per-drive attribute history shared with 'monitor_drive_health.py --status'
+STATE_DIR = tipi_paths.STATE_DIR
+HISTORY_FILE = os.path.join(STATE_DIR, "drive_health_history.json")
+HISTORY_SIZE = 120  # Samples kept per drive, 30 days at the default interval
+TREND_WINDOW = 7 * 86400  # Growth of error counters is reported over this period
+
+# Fields of a history sample, in order. Counters only ever grow on a healthy drive.
+FIELDS = ("time", "reallocated", "pending", "uncorrectable", "crc_errors", "media_errors", "temperature", "wear")
+COUNTERS = {
+    "reallocated": "reallocated sectors",
+    "pending": "pending sectors",
+    "uncorrectable": "uncorrectable sectors",
+    "media_errors": "media errors",
+}
+TEMP_LIMIT = 55  # Celsius
+WEAR_LIMIT = 90  # Percent of rated endurance used
+
+DRIVE_STATUS = tipi_metrics.gauge("tipi_drive_smart_status", "1 if SMART passed, 0 if failing, -1 if unknown.", ["drive"])
+DRIVE_STANDBY = tipi_metrics.gauge("tipi_drive_standby", "1 if the drive was in standby at the last check.", ["drive"])
+DRIVE_ATTRIBUTE = tipi_metrics.gauge("tipi_drive_attribute", "Last value of a tracked SMART attribute.", ["drive", "attribute"])
+DRIVE_WARNINGS = tipi_metrics.counter("tipi_drive_warnings_total", "Drive health warnings sent per drive.", ["drive"])
+
+# ATA attribute id -> history field (raw value)
+ATA_COUNTERS = {5: "reallocated", 197: "pending", 198: "uncorrectable", 199: "crc_errors"}
+# ATA wear indicators, their normalized value counts down from 100
+ATA_WEAR = (177, 231, 233)
 
 def ensure_smartmontools():
     """Ensure smartmontools is installed, install if missing."""
     try:
         subprocess.run(["smartctl", "--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-    except subprocess.CalledProcessError:
+    except (OSError, subprocess.CalledProcessError):
         print("smartmontools is not installed. Attempting to install it...")
         try:
             subprocess.run(["sudo", "apt", "update"], check=True)
@@ -26,57 +61,227 @@ def ensure_smartmontools():
             sys.exit(1)
 
 def get_drives():
-    """Get a list of drives on the system using lsblk."""
+    """Get a list of physical drives on the system using lsblk."""
     try:
-        result = subprocess.run(['lsblk', '-dn', '-o', 'NAME'], stdout=subprocess.PIPE, text=True, check=True)
-        drives = result.stdout.strip().split('\n')
-        drives = [f"/dev/{drive}" for drive in drives]
+        result = subprocess.run(['lsblk', '-dn', '-o', 'NAME,TYPE'], stdout=subprocess.PIPE, text=True, check=True)
+        drives = []
+        for line in result.stdout.splitlines():
+            fields = line.split()
+            # Skip loop devices, optical drives and the like
+            if len(fields) == 2 and fields[1] == "disk":
+                drives.append(f"/dev/{fields[0]}")
         return drives
     except subprocess.CalledProcessError as e:
         print(f"Error getting drives: {e}")
         return []
 
+def read_smart(drive):
+    """Query a drive with smartctl and return its parsed JSON report, or None on error.
+
+    -n standby makes smartctl return without touching a drive that is spun
+    down, so checking never wakes up idle disks.
+    """
+    try:
+        result = tipi_metrics.run(['smartctl', '-j', '-n', 'standby', '-H', '-A', '-i', drive],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=60)
+        # smartctl's exit status is a bit mask that is non-zero for many healthy drives, rely on the JSON
+        return json.loads(result.stdout)
+    except (OSError, ValueError, subprocess.TimeoutExpired):
+        return None
+
+def in_standby(report):
+    messages = report.get("smartctl", {}).get("messages", [])
+    return any("STANDBY" in m.get("string", "") or "SLEEP" in m.get("string", "") for m in messages)
+
+def drive_id(drive, report):
+    """Identify a drive by model and serial so its history survives device renames."""
+    serial = report.get("serial_number")
+    if not serial:
+        return drive
+    return f"{report.get('model_name', 'unknown')} {serial}"
+
+def parse_attributes(report):
+    """Return a history sample (dict of FIELDS) from a smartctl JSON report."""
+    sample = {field: None for field in FIELDS}
+    sample["time"] = time.time()
+    sample["temperature"] = report.get("temperature", {}).get("current")
+
+    for attribute in report.get("ata_smart_attributes", {}).get("table", []):
+        attr_id = attribute.get("id")
+        if attr_id in ATA_COUNTERS:
+            sample[ATA_COUNTERS[attr_id]] = attribute.get("raw", {}).get("value")
+        elif attr_id in ATA_WEAR and sample["wear"] is None:
+            sample["wear"] = 100 - attribute.get("value", 100)
+
+    nvme = report.get("nvme_smart_health_information_log")
+    if nvme:
+        sample["media_errors"] = nvme.get("media_errors")
+        sample["wear"] = nvme.get("percentage_used")
+        if sample["temperature"] is None:
+            sample["temperature"] = nvme.get("temperature")
+    return sample
+
 def check_drive_health(drive):
-    """Check the SMART health of a drive."""
+    """Check the SMART health of a drive.
+
+    Returns (drive, status, report) where status is PASSED, FAILED,
+    STANDBY, UNKNOWN or ERROR.
+    """
+    report = read_smart(drive)
+    if report is None:
+        return drive, "ERROR", None
+    if in_standby(report):
+        return drive, "STANDBY", report
+    passed = report.get("smart_status", {}).get("passed")
+    if passed is True:
+        return drive, "PASSED", report
+    elif passed is False:
+        return drive, "FAILED", report
+    return drive, "UNKNOWN", report
+
+def load_history():
+    """Return {drive id: {"device": path, "samples": [[FIELDS...], ...]}}."""
     try:
-        result = subprocess.run(['smartctl', '-H', drive], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-        if "PASSED" in result.stdout:
-            return "PASSED"
-        elif "FAILED" in result.stdout:
-            return "FAILED"
-        else:
-            return "UNKNOWN"
-    except subprocess.CalledProcessError as e:
-        return "ERROR"
+        with open(HISTORY_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-def send_gotify_notification(title, message):
-    """Send a notification via Gotify."""
+def save_history(history):
     try:
-        subprocess.run(["gotify", "push", f"--title={title}", message], check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to send Gotify notification: {e}")
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp_path = f"{HISTORY_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(history, f, separators=(",", ":"))
+        os.replace(tmp_path, HISTORY_FILE)
+    except OSError as e:
+        print(f"Error saving drive health history: {e}")
 
-def monitor_drives(interval):
-    """Continuously monitor drives in a loop."""
-    ensure_smartmontools()
+def find_trends(samples, sample):
+    """Return warnings for a new sample compared to the drive's earlier samples.
 
-    while True:
+    Any growth of a sector or media error counter since the previous sample
+    is reported together with its growth over the trend window, since a
+    drive that keeps remapping sectors usually fails well before its
+    overall SMART verdict changes.
+    """
+    warnings = []
+    previous = dict(zip(FIELDS, samples[-1])) if samples else None
+    window = [dict(zip(FIELDS, s)) for s in samples if sample["time"] - s[0] <= TREND_WINDOW]
+
+    for field, label in COUNTERS.items():
+        value = sample[field]
+        if value is None:
+            continue
+        if previous is None or previous[field] is None:
+            if value > 0:
+                warnings.append(f"{value} {label}")
+            continue
+        if value > previous[field]:
+            oldest = next((s[field] for s in window if s[field] is not None), previous[field])
+            warnings.append(f"{label} rose from {previous[field]} to {value} "
+                            f"(+{value - oldest} in {TREND_WINDOW // 86400} days)")
+
+    crc = sample["crc_errors"]
+    if crc is not None and previous is not None and previous["crc_errors"] is not None and crc > previous["crc_errors"]:
+        warnings.append(f"CRC errors rose from {previous['crc_errors']} to {crc}, check the cable")
+
+    temperature = sample["temperature"]
+    if temperature is not None and temperature >= TEMP_LIMIT:
+        warnings.append(f"running hot at {temperature}C")
+
+    wear = sample["wear"]
+    if wear is not None and wear >= WEAR_LIMIT and (previous is None or previous["wear"] is None or previous["wear"] < wear):
+        warnings.append(f"{wear}% of rated endurance used")
+    return warnings
+
+class DriveHealthCheck:
+    """Check the SMART health of every drive once per tick.
+
+    Drives are queried in parallel and drives in standby are skipped. Key
+    attributes of every drive are kept in a history so that degrading drives
+    are reported as soon as their error counters start to grow.
+    """
+
+    name = "drive_health"
+    interval = CHECK_INTERVAL
+
+    def __init__(self):
+        ensure_smartmontools()
+
+    def tick(self):
         print("Checking drive health...")
         drives = get_drives()
         if not drives:
             print("No drives found.")
-        else:
-            for drive in drives:
-                health = check_drive_health(drive)
-                if health == "FAILED":
-                    message = f"{drive} is failing! Drive failure expected. Save your data immediately!"
-                    print(message)
-                    send_gotify_notification("Drive Failure Alert", message)
-                elif health != "PASSED":
-                    print(f"{drive}: Status unknown or error occurred.")
+            return
+        history = load_history()
+        with ThreadPoolExecutor(max_workers=min(POLL_WORKERS, len(drives))) as executor:
+            results = list(executor.map(check_drive_health, drives))
+
+        for drive, health, report in results:
+            DRIVE_STANDBY.set(int(health == "STANDBY"), drive=drive)
+            if health == "STANDBY":
+                print(f"{drive}: In standby, skipped.")
+                continue
+            DRIVE_STATUS.set({"PASSED": 1, "FAILED": 0}.get(health, -1), drive=drive)
+            if health == "FAILED":
+                message = f"{drive} is failing! Drive failure expected. Save your data immediately!"
+                print(message)
+                notify("Drive Failure Alert", message)
+            elif health != "PASSED":
+                print(f"{drive}: Status unknown or error occurred.")
+            if report is None:
+                continue
+
+            key = drive_id(drive, report)
+            entry = history.setdefault(key, {"device": drive, "samples": []})
+            entry["device"] = drive
+            sample = parse_attributes(report)
+            warnings = find_trends(entry["samples"], sample)
+            for field in FIELDS[1:]:
+                if sample[field] is not None:
+                    DRIVE_ATTRIBUTE.set(sample[field], drive=drive, attribute=field)
+            tipi_timeseries.record(f"drive_temperature:{drive}", sample["temperature"])
+            bad_sectors = [sample[field] for field in ("reallocated", "pending", "uncorrectable") if sample[field] is not None]
+            if bad_sectors:
+                tipi_timeseries.record(f"drive_bad_sectors:{drive}", sum(bad_sectors))
+            if warnings:
+                message = f"{drive} ({key}): " + "; ".join(warnings)
+                print(message)
+                notify("Drive Health Warning", message)
+                DRIVE_WARNINGS.inc(drive=drive)
+            entry["samples"] = (entry["samples"] + [[sample[field] for field in FIELDS]])[-HISTORY_SIZE:]
+
+        save_history(history)
+
+def monitor_drives(interval):
+    """Continuously monitor drives in a loop."""
+    check = DriveHealthCheck()
+
+    while True:
+        check.tick()
         print(f"Sleeping for {interval} seconds...")
         time.sleep(interval)
 
+def print_status():
+    """Print the latest recorded attributes of every drive."""
+    history = load_history()
+    if not history:
+        print("No drive health history recorded yet.")
+        return
+    print(f"{'Device':<14} {'Checked':<17} {'Realloc':>7} {'Pending':>7} {'Uncorr':>6} {'CRC':>5} "
+          f"{'Media':>5} {'Temp':>5} {'Wear':>5}  Drive")
+    for key, entry in sorted(history.items(), key=lambda item: item[1]["device"]):
+        if not entry["samples"]:
+            continue
+        sample = dict(zip(FIELDS, entry["samples"][-1]))
+        values = ["-" if sample[f] is None else str(sample[f])
+                  for f in ("reallocated", "pending", "uncorrectable", "crc_errors", "media_errors", "temperature", "wear")]
+        checked = time.strftime("%Y-%m-%d %H:%M", time.localtime(sample["time"]))
+        print(f"{entry['device']:<14} {checked:<17} {values[0]:>7} {values[1]:>7} {values[2]:>6} {values[3]:>5} "
+              f"{values[4]:>5} {values[5]:>5} {values[6]:>5}  {key}")
+
 def install_service():
     """Create, enable, and start the systemd service."""
     service_content = f"""[Unit]
@@ -125,10 +330,13 @@ def main():
     parser = argparse.ArgumentParser(description="Check drive health status.")
     parser.add_argument('--install', action='store_true', help="Install and start the systemd service.")
     parser.add_argument('--uninstall', action='store_true', help="Stop and remove the systemd service.")
-    parser.add_argument('--interval', type=int, default=CHECK_INTERVAL, help="Check interval in seconds (default: 24 hours)")
+    parser.add_argument('--interval', type=int, default=CHECK_INTERVAL, help="Check interval in seconds (default: 6 hours)")
+    parser.add_argument('--status', action='store_true', help="Print the latest recorded attributes of every drive.")
     args = parser.parse_args()
 
-    if args.install:
+    if args.status:
+        print_status()
+    elif args.install:
         install_service()
     elif args.uninstall:
         uninstall_service()
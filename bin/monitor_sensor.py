@@ -6,9 +6,29 @@ import time
 import argparse
 import os
 import configparser
+import glob
 
-CONFIG_FILE_PATH = '../etc/monitor_sensor.conf'
+from tipi_notify import notify
+import tipi_metrics
+import tipi_paths
+import tipi_timeseries
+
+CONFIG_FILE_PATH = os.path.join(tipi_paths.CONFIG_DIR, 'monitor_sensor.conf')
 SERVICE_FILE_PATH = '/etc/systemd/system/monitor_sensor.service'
+CHECK_INTERVAL = 10  # seconds, while a sensor is above its threshold or alerted
+# Sampling slows down the further the hottest sensor is below the threshold
+DEFAULT_MIN_INTERVAL = 2  # seconds, at the threshold
+DEFAULT_MAX_INTERVAL = 60  # seconds, SLOW_MARGIN or more below it
+SLOW_MARGIN = 20  # °C
+DEFAULT_HYSTERESIS = 5  # °C a sensor must drop below the threshold before its alert clears
+DEFAULT_SUSTAIN_SECONDS = 30  # A sensor must stay above the threshold this long before anything happens
+HWMON_DIR = tipi_paths.HWMON_DIR
+REDISCOVER_INTERVAL = 300  # seconds between hwmon rescans while a watched input can't be read
+
+TEMPERATURE = tipi_metrics.gauge('tipi_temperature_celsius', 'Last temperature read from a watched sensor.', ['sensor'])
+TEMPERATURE_ALERTS = tipi_metrics.counter('tipi_temperature_alerts_total', 'Temperature alerts sent per sensor.', ['sensor'])
+TEMPERATURE_STATE = tipi_metrics.gauge('tipi_temperature_state', '0 ok, 1 above the threshold but not for long enough yet, 2 alerted.', ['sensor'])
+SAMPLE_INTERVAL = tipi_metrics.gauge('tipi_temperature_sample_interval_seconds', 'Current delay between temperature samples.')
 
 SERVICE_FILE_CONTENT = f"""[Unit]
 Description=Monitor Sensor Service
@@ -40,9 +60,88 @@ def check_and_install_lm_sensors(debug=False):
 def get_sensor_data(debug=False):
     if debug:
         print("Running command: sensors")
-    result = subprocess.run('sensors', shell=True, capture_output=True, text=True)
+    result = tipi_metrics.run('sensors', shell=True, capture_output=True, text=True)
     return result.stdout
 
+class HwmonReader:
+    """Temperature inputs from sysfs hwmon, opened once and sampled with pread.
+
+    Sensors are keyed "<chip>/<label>", e.g. "coretemp/Package id 0". Chips
+    that share a name get a numeric suffix ("nvme", "nvme1", ...).
+    """
+
+    def __init__(self, hwmon_dir=HWMON_DIR, debug=False):
+        self.hwmon_dir = hwmon_dir
+        self.debug = debug
+        self.fds = {}
+        self.chips = {}
+        self.discover()
+
+    def discover(self):
+        """(Re)build the sensor name -> open file descriptor index."""
+        self.close()
+        for chip_dir in sorted(glob.glob(os.path.join(self.hwmon_dir, 'hwmon*')), key=lambda p: int(p.rsplit('hwmon', 1)[1] or 0)):
+            name = read_sysfs(os.path.join(chip_dir, 'name')) or os.path.basename(chip_dir)
+            chip = name
+            suffix = 1
+            while chip in self.chips:
+                chip = f"{name}{suffix}"
+                suffix += 1
+            keys = []
+            inputs = glob.glob(os.path.join(chip_dir, 'temp*_input'))
+            for input_path in sorted(inputs, key=lambda p: int(re.search(r'temp(\d+)_input$', p).group(1))):
+                label = read_sysfs(input_path.replace('_input', '_label')) or os.path.basename(input_path)[:-len('_input')]
+                key = f"{chip}/{label}"
+                try:
+                    self.fds[key] = os.open(input_path, os.O_RDONLY)
+                except OSError:
+                    continue
+                keys.append(key)
+            if keys:
+                self.chips[chip] = keys
+        if self.debug:
+            print(f"Found {len(self.fds)} hwmon temperature inputs")
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+        self.chips = {}
+
+    def resolve(self, sensor):
+        """Map a configured sensor to hwmon keys.
+
+        Accepts a "<chip>/<label>" key, a bare chip name, or a chip header
+        saved from `sensors` output such as "coretemp-isa-0000", which
+        watches every temperature of that chip like the old parser did.
+        """
+        if sensor in self.fds:
+            return [sensor]
+        if sensor in self.chips:
+            return self.chips[sensor]
+        return self.chips.get(sensor.split('-')[0], [])
+
+    def read(self, key):
+        """Return the temperature of a sensor in °C with a single pread."""
+        return int(os.pread(self.fds[key], 32, 0)) / 1000.0
+
+def read_sysfs(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def get_hwmon_choices(reader):
+    """Current hwmon readings in the same shape as parse_sensor_data()."""
+    choices = {}
+    for key in reader.fds:
+        try:
+            choices[key] = [f"+{reader.read(key):.1f}°C"]
+        except (OSError, ValueError):
+            continue
+    return choices
+
 def parse_sensor_data(sensor_data, debug=False):
     sensors = {}
     sensor_lines = sensor_data.splitlines()
@@ -77,10 +176,11 @@ def parse_sensor_data(sensor_data, debug=False):
 def display_and_choose_sensors(sensors, debug=False):
     sensor_names = list(sensors.keys())
     for idx, name in enumerate(sensor_names):
-        print(f"{idx + 1}: {name}")
+        reading = f"  {sensors[name][0]}" if len(sensors[name]) == 1 else ""
+        print(f"{idx + 1}: {name}{reading}")
     
-    chosen_idx = int(input("Enter the number of the sensor you want to monitor: ")) - 1
-    chosen_sensor = sensor_names[chosen_idx]
+    chosen = input("Enter the number of the sensor you want to monitor (separate several with commas): ")
+    chosen_sensor = ', '.join(sensor_names[int(idx) - 1] for idx in chosen.split(','))
     threshold_temp = float(input("Enter the threshold temperature (°C): "))
     optional_command = input("Enter an optional command to run if the threshold is reached (leave blank for none): ").strip()
     
@@ -98,6 +198,9 @@ def save_config(sensor, threshold_temp, optional_command):
         'sensor': sensor,
         'threshold_temp': str(threshold_temp)
     }
+    # Keep tuned sampling and hysteresis settings when the sensor is configured again
+    for key, value in load_settings().items():
+        config['SETTINGS'][key] = f"{value:g}"
     if optional_command:
         config['SETTINGS']['optional_command'] = optional_command
     
@@ -116,11 +219,16 @@ def load_config():
             return sensor, threshold_temp, optional_command
     return None, None, None
 
-def send_gotify_notification(title, message):
-    try:
-        subprocess.run(["gotify", "push", f"--title={title}", message])
-    except Exception as e:
-        print(f"Failed to send Gotify notification: {e}")
+def load_settings():
+    """Return the sampling and hysteresis settings, with defaults for older config files."""
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE_PATH)
+    return {
+        'hysteresis': config.getfloat('SETTINGS', 'hysteresis', fallback=DEFAULT_HYSTERESIS),
+        'sustain_seconds': config.getfloat('SETTINGS', 'sustain_seconds', fallback=DEFAULT_SUSTAIN_SECONDS),
+        'min_interval': config.getfloat('SETTINGS', 'min_interval', fallback=DEFAULT_MIN_INTERVAL),
+        'max_interval': config.getfloat('SETTINGS', 'max_interval', fallback=DEFAULT_MAX_INTERVAL),
+    }
 
 def run_optional_command(command, debug=False):
     if command:
@@ -131,30 +239,156 @@ def run_optional_command(command, debug=False):
         except subprocess.CalledProcessError as e:
             print(f"Failed to run optional command: {e}")
 
-def monitor_sensor(sensor, threshold_temp, sensors, optional_command=None, debug=False):
-    pattern = re.compile(r'\+([\d.]+)°C')
-    check_interval = 10  # seconds
+class SensorCheck:
+    """Read the configured sensors and alert when one stays above the threshold.
+
+    Sensors found in hwmon are sampled directly from sysfs; only sensors
+    that can't be resolved there fall back to parsing `sensors` output.
+    Each tick returns the delay until the next one: long while every sensor
+    is far below the threshold, shorter as the hottest one approaches it or
+    is forecast to reach it. A sensor has to stay above the threshold for
+    sustain_seconds before the alert and the optional command fire, once
+    per episode, and the alert only clears once the sensor has dropped
+    hysteresis degrees below the threshold.
+    """
+
+    name = "temp_sensor"
+    interval = CHECK_INTERVAL
+
+    def __init__(self, sensor, threshold_temp, optional_command=None, debug=False, reader=None, settings=None):
+        self.sensors = [name.strip() for name in sensor.split(',') if name.strip()]
+        self.threshold_temp = threshold_temp
+        self.optional_command = optional_command
+        self.debug = debug
+        self.settings = settings or load_settings()
+        self.pattern = re.compile(r'\+([\d.]+)°C')
+        self.above_since = {}  # Sensor -> time it went above the threshold
+        self.alerted = set()
+        self.last = {}  # Sensor -> (time, temperature) of the previous sample
+        self.reader = reader or HwmonReader(debug=debug)
+        self.keys = {name: self.reader.resolve(name) for name in self.sensors}
+        self.discovered_at = time.monotonic()
+        fallback = [name for name, keys in self.keys.items() if not keys]
+        if fallback:
+            print(f"Not found in hwmon, reading with sensors instead: {', '.join(fallback)}")
+            check_and_install_lm_sensors(debug)
+
+    def close(self):
+        self.reader.close()
+
+    def read_temperatures(self):
+        """Return a list of (sensor, temperature) for every watched input."""
+        temperatures = []
+        parsed_sensors = None
+        unreadable = []
+        for sensor, keys in self.keys.items():
+            for key in keys:
+                try:
+                    temperatures.append((key, self.reader.read(key)))
+                except (OSError, ValueError, KeyError):
+                    unreadable.append(key)
+            if not keys:
+                if parsed_sensors is None:
+                    parsed_sensors = parse_sensor_data(get_sensor_data(self.debug), self.debug)
+                for line in parsed_sensors.get(sensor, []):
+                    match = self.pattern.search(line)
+                    if match:
+                        temperatures.append((sensor, float(match.group(1))))
+        if unreadable and time.monotonic() - self.discovered_at >= REDISCOVER_INTERVAL:
+            # The chip may have been re-registered, rebuild the index for the next tick.
+            # Rate limited so an input that stays broken doesn't rescan hwmon every tick.
+            print(f"Could not read {', '.join(unreadable)}, rescanning hwmon")
+            self.reader.discover()
+            self.keys = {name: self.reader.resolve(name) for name in self.sensors}
+            self.discovered_at = time.monotonic()
+        return temperatures
+
+    def update_state(self, sensor, temp, now):
+        """Apply the sustain time and hysteresis to one sample."""
+        threshold = self.threshold_temp
+        if sensor in self.alerted:
+            if temp < threshold - self.settings['hysteresis']:
+                self.alerted.discard(sensor)
+                self.above_since.pop(sensor, None)
+                message = f"{sensor} cooled down to {temp}°C, below {threshold - self.settings['hysteresis']:g}°C."
+                print(message)
+                notify("Temperature Normal", message)
+        elif temp > threshold:
+            since = self.above_since.setdefault(sensor, now)
+            if now - since >= self.settings['sustain_seconds']:
+                alert_message = (f"{sensor} temperature is {temp}°C, which has been above the threshold of "
+                                 f"{threshold}°C for {now - since:.0f}s.")
+                print(f"Alert! {alert_message}")
+                notify("Temperature Alert", alert_message)
+                TEMPERATURE_ALERTS.inc(sensor=sensor)
+                run_optional_command(self.optional_command, self.debug)
+                self.alerted.add(sensor)
+        elif sensor in self.above_since:
+            # A spike that didn't last
+            del self.above_since[sensor]
+            if self.debug:
+                print(f"{sensor} is back below {threshold}°C before {self.settings['sustain_seconds']:g}s passed")
+        TEMPERATURE_STATE.set(2 if sensor in self.alerted else int(sensor in self.above_since), sensor=sensor)
+
+    def next_interval(self, temperatures, now):
+        """Seconds until the next sample, from how close the hottest sensor is to the threshold."""
+        settings = self.settings
+        if self.above_since.keys() - self.alerted:
+            # Time the sustain period closely
+            return settings['min_interval']
+        interval = settings['max_interval']
+        for sensor, temp in temperatures:
+            if sensor in self.alerted:
+                # Only cooling down is left to notice
+                interval = min(interval, max(CHECK_INTERVAL, settings['min_interval']))
+                continue
+            margin = max(self.threshold_temp - temp, 0)
+            interval = min(interval, settings['min_interval'] +
+                           (settings['max_interval'] - settings['min_interval']) * min(margin / SLOW_MARGIN, 1))
+            previous = self.last.get(sensor)
+            if previous and now > previous[0] and temp > previous[1]:
+                # Rising: sample at least twice before it could reach the threshold
+                rate = (temp - previous[1]) / (now - previous[0])
+                interval = min(interval, margin / rate / 2)
+        return max(interval, settings['min_interval'])
+
+    def tick(self):
+        now = time.monotonic()
+        temperatures = self.read_temperatures()
+        for sensor, temp in temperatures:
+            TEMPERATURE.set(temp, sensor=sensor)
+            tipi_timeseries.record(f"temperature:{sensor}", temp)
+            if self.debug:
+                print(f"Current temperature of {sensor}: {temp}°C")
+            self.update_state(sensor, temp, now)
+        interval = self.next_interval(temperatures, now)
+        self.last = {sensor: (now, temp) for sensor, temp in temperatures}
+        SAMPLE_INTERVAL.set(interval)
+        return interval
+
+def load_check(debug=False):
+    """Build a SensorCheck from the saved configuration, or None if not configured."""
+    sensor, threshold_temp, optional_command = load_config()
+    if sensor is None or threshold_temp is None:
+        return None
+    return SensorCheck(sensor, threshold_temp, optional_command, debug)
+
+def monitor_sensor(sensor, threshold_temp, optional_command=None, debug=False):
+    check = SensorCheck(sensor, threshold_temp, optional_command, debug)
 
     print(f"Monitoring {sensor} for temperatures above {threshold_temp}°C...")
 
+    # Keep watching after an alert, the check clears it once the sensor has cooled down
     while True:
-        sensor_data = get_sensor_data(debug)
-        parsed_sensors = parse_sensor_data(sensor_data, debug)
-        
-        for line in parsed_sensors[sensor]:
-            match = pattern.search(line)
-            if match:
-                temp = float(match.group(1))
-                if debug:
-                    print(f"Current temperature of {sensor}: {temp}°C")
-                if temp > threshold_temp:
-                    alert_message = f"{sensor} temperature is {temp}°C, which is above the threshold of {threshold_temp}°C."
-                    print(f"Alert! {alert_message}")
-                    send_gotify_notification("Temperature Alert", alert_message)
-                    run_optional_command(optional_command, debug)
-                    return  # or handle alert accordingly
-        
-        time.sleep(check_interval)
+        time.sleep(check.tick() or check.interval)
+
+def get_sensor_choices(debug=False):
+    """Sensors to offer during configuration, from hwmon or else from lm-sensors."""
+    choices = get_hwmon_choices(HwmonReader(debug=debug))
+    if choices:
+        return choices
+    check_and_install_lm_sensors(debug)
+    return parse_sensor_data(get_sensor_data(debug), debug)
 
 def install_service(debug=False):
     with open(SERVICE_FILE_PATH, 'w') as service_file:
@@ -188,20 +422,15 @@ if __name__ == "__main__":
     elif args.uninstall:
         uninstall_service(args.debug)
     elif args.config:
-        check_and_install_lm_sensors(args.debug)
-        sensor_data = get_sensor_data(args.debug)
-        sensors = parse_sensor_data(sensor_data, args.debug)
+        sensors = get_sensor_choices(args.debug)
         sensor, threshold_temp, optional_command = display_and_choose_sensors(sensors, args.debug)
         save_config(sensor, threshold_temp, optional_command)
         print("Configuration saved. Exiting.")
     else:
-        check_and_install_lm_sensors(args.debug)
-
         sensor, threshold_temp, optional_command = load_config()
-        sensor_data = get_sensor_data(args.debug)
-        sensors = parse_sensor_data(sensor_data, args.debug)
         
         if sensor is None or threshold_temp is None:
+            sensors = get_sensor_choices(args.debug)
             sensor, threshold_temp, optional_command = display_and_choose_sensors(sensors, args.debug)
             save_config(sensor, threshold_temp, optional_command)
         else:
@@ -209,4 +438,4 @@ if __name__ == "__main__":
             if optional_command:
                 print(f"Optional command: {optional_command}")
 
-        monitor_sensor(sensor, threshold_temp, sensors, optional_command, args.debug)
+        monitor_sensor(sensor, threshold_temp, optional_command, args.debug)
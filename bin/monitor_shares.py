@@ -1,41 +1,194 @@
 #! /usr/bin/python3
 
 import os
+import re
+import json
+import select
+import threading
 import time
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from tipi_notify import notify
+import tipi_metrics
+import tipi_paths
+import tipi_timeseries
 
 MOUNT_CHECK_INTERVAL = 60  # Seconds between mount checks
-GOTIFY_API_URL = "https://example.com/gotify"  # Replace with your Gotify API URL
-CONFIG_FILE = "/root/runtipi/etc/monitor_shares.conf"
+DOWN_CHECK_INTERVAL = 5  # Seconds between checks while a mount is down
+PROBE_TIMEOUT = 5  # Seconds a mount may take to answer statvfs before it is considered stale
+REMOUNT_TIMEOUT = 60  # Seconds a single mount command may take
+REMOUNT_BACKOFF_MIN = 10  # Seconds before the first remount retry, doubled after each failure
+REMOUNT_BACKOFF_MAX = 900
+MOUNTINFO_PATH = tipi_paths.MOUNTINFO_PATH
+FSTAB_PATH = tipi_paths.FSTAB_PATH
+RUNTIPI_DIR = tipi_paths.RUNTIPI_DIR
+CONFIG_FILE = os.path.join(tipi_paths.CONFIG_DIR, "monitor_shares.conf")
+STATE_DIR = tipi_paths.STATE_DIR
+INDEX_CACHE_FILE = os.path.join(STATE_DIR, "app_mount_index.json")
+STOPPED_APPS_FILE = os.path.join(STATE_DIR, "mount_stopped_apps.json")
+APP_WORKERS = 4  # Apps stopped or started at the same time
+
+MOUNT_UP = tipi_metrics.gauge("tipi_mount_up", "1 if an fstab mount is mounted and responding.", ["mount_point"])
+REMOUNTS = tipi_metrics.counter("tipi_remount_attempts_total", "Remount attempts per mount point and result.", ["mount_point", "result"])
+APPS_STOPPED = tipi_metrics.gauge("tipi_mount_stopped_apps", "Apps currently stopped while waiting for a mount.")
 
 def get_mount_points():
-    with open("/etc/fstab", "r") as f:
-        mount_points = [line.split()[1] for line in f.readlines() if line.strip() and not line.startswith("#") and "swap" not in line]
+    with open(FSTAB_PATH, "r") as f:
+        mount_points = [os.path.normpath(line.split()[1]) for line in f.readlines() if line.strip() and not line.startswith("#") and "swap" not in line]
     return mount_points
 
+def unescape_mount_path(path):
+    """Decode the octal escapes (e.g. \\040 for a space) used in mountinfo."""
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), path)
+
+def read_mount_table():
+    """Return the set of mount points from /proc/self/mountinfo, without touching the mounts."""
+    with open(MOUNTINFO_PATH, "r") as f:
+        return {unescape_mount_path(line.split()[4]) for line in f if line.strip()}
+
 def is_mounted(mount_point):
-    return os.path.ismount(mount_point)
+    return mount_point in read_mount_table()
+
+class MountTableWatcher:
+    """Wait for mount table changes, which the kernel signals with POLLPRI on mountinfo.
+
+    wake() ends a wait early from another thread through a pipe in the
+    same poll set, e.g. when the daemon reloads or stops.
+    """
+
+    def __init__(self, path=MOUNTINFO_PATH):
+        self.file = open(path, "r")
+        self.wake_read, self.wake_write = os.pipe()
+        self.poller = select.poll()
+        self.poller.register(self.file, select.POLLPRI | select.POLLERR)
+        self.poller.register(self.wake_read, select.POLLIN)
+        self.file.read()
+
+    def wait(self, timeout):
+        """Block up to timeout seconds; return True if the mount table changed."""
+        events = dict(self.poller.poll(timeout * 1000))
+        if self.wake_read in events:
+            os.read(self.wake_read, 512)
+            return False
+        if events:
+            # Reading to the end re-arms the notification
+            self.file.seek(0)
+            self.file.read()
+        return bool(events)
+
+    def wake(self):
+        os.write(self.wake_write, b"\0")
+
+    def close(self):
+        self.file.close()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+class MountProbe:
+    """Liveness probe for one mount, run in a worker thread with a hard timeout.
+
+    A stale NFS/CIFS mount can block statvfs forever. The stuck thread is
+    left behind, and while it is still blocked the mount counts as stale
+    without starting another probe.
+    """
+
+    def __init__(self, mount_point):
+        self.mount_point = mount_point
+        self.thread = None
+        self.ok = False
+
+    def _run(self):
+        try:
+            os.statvfs(self.mount_point)
+            self.ok = True
+        except OSError:
+            self.ok = False
 
-def send_gotify_notification(title, message):
+    def start(self):
+        """Start a probe unless the previous one is still blocked."""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.ok = False
+        self.thread = threading.Thread(target=self._run, name=f"probe {self.mount_point}", daemon=True)
+        self.thread.start()
+
+    def result(self, deadline):
+        """Wait for the probe until the monotonic deadline; True if the mount answered."""
+        self.thread.join(max(0, deadline - time.monotonic()))
+        return not self.thread.is_alive() and self.ok
+
+def remount(mount_point, stale=False):
+    """Try to mount a single fstab entry, lazily unmounting a stale mount first."""
     try:
-        subprocess.run(["gotify", "push", f"--title={title}", message])
-    except:
-        False
+        if stale:
+            tipi_metrics.run(["umount", "-l", mount_point], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=REMOUNT_TIMEOUT)
+        result = tipi_metrics.run(["mount", mount_point], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=REMOUNT_TIMEOUT)
+        if result.returncode != 0:
+            print(f"Remounting {mount_point} failed: {result.stdout.strip()}")
+            REMOUNTS.inc(mount_point=mount_point, result="failed")
+        else:
+            REMOUNTS.inc(mount_point=mount_point, result="ok")
+    except subprocess.TimeoutExpired:
+        print(f"Remounting {mount_point} timed out after {REMOUNT_TIMEOUT}s")
+        REMOUNTS.inc(mount_point=mount_point, result="timeout")
+
+class Remounter:
+    """Remount attempts for one mount, each in its own thread with exponential backoff."""
+
+    def __init__(self, mount_point):
+        self.mount_point = mount_point
+        self.attempts = 0
+        self.next_attempt = 0
+        self.thread = None
 
-def mount_shares():
-    subprocess.run(["mount", "-a"])
+    def maybe_remount(self, stale):
+        now = time.monotonic()
+        if now < self.next_attempt or (self.thread is not None and self.thread.is_alive()):
+            return
+        self.attempts += 1
+        self.next_attempt = now + min(REMOUNT_BACKOFF_MIN * 2 ** (self.attempts - 1), REMOUNT_BACKOFF_MAX)
+        self.thread = threading.Thread(target=remount, args=(self.mount_point, stale), name=f"remount {self.mount_point}", daemon=True)
+        self.thread.start()
 
 def start_app(app_name):
-    original_dir = os.getcwd()
-    os.chdir("/root/runtipi")
-    subprocess.run(["./runtipi-cli", "app", "start", app_name])
-    os.chdir(original_dir)
+    tipi_metrics.run(["./runtipi-cli", "app", "start", app_name], cwd=RUNTIPI_DIR)
 
 def stop_app(app_name):
-    original_dir = os.getcwd()
-    os.chdir("/root/runtipi")
-    subprocess.run(["./runtipi-cli", "app", "stop", app_name])
-    os.chdir(original_dir)
+    tipi_metrics.run(["./runtipi-cli", "app", "stop", app_name], cwd=RUNTIPI_DIR)
+
+def run_for_apps(action, app_names):
+    """Run start_app or stop_app for several apps in parallel."""
+    if app_names:
+        with ThreadPoolExecutor(max_workers=APP_WORKERS) as executor:
+            list(executor.map(action, sorted(app_names)))
+
+def load_stopped_apps(path=STOPPED_APPS_FILE):
+    """Return {app: set of mount points} for the apps a previous monitor stopped."""
+    try:
+        with open(path, "r") as f:
+            return {app_name: set(mount_points) for app_name, mount_points in json.load(f).items()}
+    except (OSError, ValueError, AttributeError, TypeError):
+        return {}
+
+def save_stopped_apps(stopped, path=STOPPED_APPS_FILE):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({app_name: sorted(mount_points) for app_name, mount_points in stopped.items()}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Error saving stopped apps: {e}")
+
+def get_running_apps():
+    """Return the compose projects with running containers, or None if unknown."""
+    try:
+        result = tipi_metrics.run(["docker", "ps", "--format", '{{.Label "com.docker.compose.project"}}'],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return set(result.stdout.split())
 
 def get_app_names_from_config():
     app_names = []
@@ -44,27 +197,252 @@ def get_app_names_from_config():
             app_names = [line.strip() for line in f.readlines() if line.strip()]
     return app_names
 
-def monitor_mounts():
-    mount_points = get_mount_points()
-    app_names = get_app_names_from_config() or ["sabnzbd", "sonarr", "radarr"]
-    hostname = os.uname().nodename
+def read_env_file(path):
+    """Read KEY=VALUE lines from a .env style file."""
+    env = {}
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#") and "=" in line:
+                    key, value = line.split("=", 1)
+                    env[key.strip()] = value.strip().strip('"\'')
+    except OSError:
+        pass
+    return env
 
-    while True:
-        for mount_point in mount_points:
-            if not is_mounted(mount_point):
-                send_gotify_notification(hostname, f"{mount_point} is disconnected.")
-                for app_name in app_names:
-                    stop_app(app_name)
+ENV_VAR_PATTERN = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)(?::?-([^}]*))?\}|\$([A-Za-z_][A-Za-z0-9_]*)')
+VOLUME_ITEM_PATTERN = re.compile(r'^\s*-\s*["\']?([^"\'\s#]+)')
+VOLUME_SOURCE_PATTERN = re.compile(r'^\s*(?:-\s*)?(?:source|device)\s*:\s*["\']?([^"\'\s#]+)')
+
+def expand_env(value, env):
+    """Expand $VAR, ${VAR} and ${VAR:-default}; unknown variables are left as they are."""
+    def replace(match):
+        name = match.group(1) or match.group(3)
+        if name in env:
+            return env[name]
+        return match.group(2) if match.group(2) is not None else match.group(0)
+    return ENV_VAR_PATTERN.sub(replace, value)
+
+def parse_compose_host_paths(compose_file, env):
+    """Return the host paths bind-mounted by a docker-compose.yml.
+
+    Only the volume forms are recognised (short "host:container" list
+    items and long-syntax source/device keys), which is all we need and
+    avoids depending on a YAML parser.
+    """
+    host_paths = set()
+    base_dir = os.path.dirname(compose_file)
+    with open(compose_file, "r") as f:
+        for line in f:
+            match = VOLUME_SOURCE_PATTERN.match(line)
+            if match:
+                source = expand_env(match.group(1), env)
+            else:
+                match = VOLUME_ITEM_PATTERN.match(line)
+                if not match:
+                    continue
+                item = expand_env(match.group(1), env)
+                if ":" not in item:
+                    continue
+                source = item.split(":", 1)[0]
+            if source.startswith("."):
+                source = os.path.join(base_dir, source)
+            if source.startswith("/"):
+                host_paths.add(os.path.normpath(source))
+    return host_paths
+
+def paths_overlap(host_path, mount_point):
+    """True if a bind mount of host_path is affected when mount_point goes away."""
+    if host_path == mount_point or host_path.startswith(mount_point.rstrip("/") + "/"):
+        return True
+    # A bind of a parent directory (but not of /) also sees the mount disappear
+    return host_path != "/" and mount_point.startswith(host_path.rstrip("/") + "/")
+
+class AppMountIndex:
+    """Which installed apps bind-mount paths under which mount point.
+
+    Built from each app's docker-compose.yml under apps/ and user-config/,
+    and rebuilt only when one of those files or the env files change. The
+    index is cached on disk so a restarted monitor doesn't reparse.
+    """
+
+    def __init__(self, runtipi_dir=RUNTIPI_DIR, cache_file=INDEX_CACHE_FILE):
+        self.runtipi_dir = runtipi_dir
+        self.cache_file = cache_file
+        self.signature = None
+        self.apps = {}
+        try:
+            with open(cache_file, "r") as f:
+                cached = json.load(f)
+            self.signature, self.apps = cached["signature"], cached["apps"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def source_files(self):
+        """Return {app: [files that define its volumes]} for every installed app."""
+        apps_dir = os.path.join(self.runtipi_dir, "apps")
+        files = {}
+        if os.path.isdir(apps_dir):
+            for app_name in sorted(os.listdir(apps_dir)):
+                if os.path.isdir(os.path.join(apps_dir, app_name)):
+                    files[app_name] = [
+                        os.path.join(apps_dir, app_name, "docker-compose.yml"),
+                        os.path.join(self.runtipi_dir, "user-config", app_name, "docker-compose.yml"),
+                        os.path.join(self.runtipi_dir, "app-data", app_name, "app.env"),
+                    ]
+        return files
+
+    def refresh(self):
+        """Rebuild the index if any compose or env file changed since the last build."""
+        files = self.source_files()
+        signature = {}
+        for path in [os.path.join(self.runtipi_dir, ".env")] + [p for paths in files.values() for p in paths]:
+            try:
+                signature[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+        if signature == self.signature:
+            return
+
+        global_env = {"ROOT_FOLDER_HOST": self.runtipi_dir, "STORAGE_PATH": self.runtipi_dir}
+        global_env.update(read_env_file(os.path.join(self.runtipi_dir, ".env")))
+        apps = {}
+        for app_name, (compose_file, user_compose_file, app_env_file) in files.items():
+            env = dict(global_env, APP_ID=app_name,
+                       APP_DATA_DIR=os.path.join(global_env["ROOT_FOLDER_HOST"], "app-data", app_name))
+            env.update(read_env_file(app_env_file))
+            host_paths = set()
+            for path in (compose_file, user_compose_file):
+                if os.path.exists(path):
+                    try:
+                        host_paths |= parse_compose_host_paths(path, env)
+                    except OSError as e:
+                        print(f"Error reading {path}: {e}")
+            apps[app_name] = sorted(host_paths)
+
+        self.signature, self.apps = signature, apps
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(self.cache_file, "w") as f:
+                json.dump({"signature": signature, "apps": apps}, f)
+        except OSError as e:
+            print(f"Error writing app mount index: {e}")
+
+    def dependents(self, mount_point):
+        """Return the installed apps that use anything under mount_point."""
+        return {app_name for app_name, host_paths in self.apps.items()
+                if any(paths_overlap(host_path, mount_point) for host_path in host_paths)}
 
-                while not is_mounted(mount_point):
-                    mount_shares()
-                    time.sleep(MOUNT_CHECK_INTERVAL)
+class MountCheck:
+    """Check every fstab mount point once per tick.
 
-                for app_name in app_names:
-                    start_app(app_name)
-                send_gotify_notification(hostname, f"{mount_point} reconnected.")
+    A mount is up when it is in the mount table and answers a statvfs probe
+    in time. When a mount goes down, only the running apps that bind-mount
+    something under it are stopped, and each is started again once every
+    mount it depends on is back. Missing mounts are remounted on their own
+    backoff schedule, and mount table changes wake the check early. The
+    stopped apps are kept on disk, so a reloaded or restarted monitor still
+    starts them when their mounts come back.
+    """
 
-        time.sleep(MOUNT_CHECK_INTERVAL)
+    name = "mount_points"
+    interval = MOUNT_CHECK_INTERVAL
+
+    def __init__(self):
+        self.mount_points = get_mount_points()
+        # Apps listed in monitor_shares.conf are stopped for every mount, on top of the index
+        self.extra_apps = set(get_app_names_from_config())
+        self.index = AppMountIndex()
+        self.hostname = os.uname().nodename
+        self.probes = {mount_point: MountProbe(mount_point) for mount_point in self.mount_points}
+        # app -> mount points it is waiting for, including those of a previous run
+        self.stopped = {app_name: mount_points & set(self.mount_points)
+                        for app_name, mount_points in load_stopped_apps().items()}
+        # Their mounts count as down already, so coming back starts the apps without a second alert
+        self.down = {mount_point: Remounter(mount_point)
+                     for mount_points in self.stopped.values() for mount_point in mount_points}
+        self.watcher = MountTableWatcher()
+
+    def mount_lost(self, mount_point, state):
+        affected = self.index.dependents(mount_point) | (self.extra_apps & set(self.index.apps))
+        running = get_running_apps()
+        to_stop = set()
+        for app_name in affected:
+            if app_name in self.stopped:
+                self.stopped[app_name].add(mount_point)
+            elif running is None or app_name in running:
+                self.stopped[app_name] = {mount_point}
+                to_stop.add(app_name)
+        apps = f" Stopping {', '.join(sorted(to_stop))}." if to_stop else ""
+        notify(self.hostname, f"{mount_point} {state}.{apps}")
+        save_stopped_apps(self.stopped)
+        run_for_apps(stop_app, to_stop)
+
+    def mount_restored(self, mount_point):
+        to_start = set()
+        for app_name, mount_points in list(self.stopped.items()):
+            mount_points.discard(mount_point)
+            if not mount_points:
+                del self.stopped[app_name]
+                to_start.add(app_name)
+        save_stopped_apps(self.stopped)
+        run_for_apps(start_app, to_start)
+        apps = f" Started {', '.join(sorted(to_start))}." if to_start else ""
+        notify(self.hostname, f"{mount_point} reconnected.{apps}")
+
+    def tick(self):
+        self.index.refresh()
+        # Apps stopped for mounts that have since been removed from fstab
+        orphaned = {app_name for app_name, mount_points in self.stopped.items() if not mount_points}
+        if orphaned:
+            for app_name in orphaned:
+                del self.stopped[app_name]
+            save_stopped_apps(self.stopped)
+            run_for_apps(start_app, orphaned)
+        mounted = read_mount_table()
+        # Probe all mounts at once so stale mounts share one timeout
+        for mount_point in self.mount_points:
+            if mount_point in mounted:
+                self.probes[mount_point].start()
+        deadline = time.monotonic() + PROBE_TIMEOUT
+
+        for mount_point in self.mount_points:
+            in_table = mount_point in mounted
+            if in_table and self.probes[mount_point].result(deadline):
+                MOUNT_UP.set(1, mount_point=mount_point)
+                tipi_timeseries.record(f"mount_up:{mount_point}", 1)
+                if mount_point in self.down:
+                    del self.down[mount_point]
+                    self.mount_restored(mount_point)
+                continue
+
+            MOUNT_UP.set(0, mount_point=mount_point)
+            tipi_timeseries.record(f"mount_up:{mount_point}", 0)
+            if mount_point not in self.down:
+                self.down[mount_point] = Remounter(mount_point)
+                self.mount_lost(mount_point, "is not responding" if in_table else "is disconnected")
+            self.down[mount_point].maybe_remount(stale=in_table)
+        APPS_STOPPED.set(len(self.stopped))
+
+        if self.down:
+            return DOWN_CHECK_INTERVAL
+
+    def wait_for_event(self, timeout):
+        """Sleep until the next tick is due, the mount table changes or wake() is called."""
+        return self.watcher.wait(timeout)
+
+    def wake(self):
+        self.watcher.wake()
+
+    def close(self):
+        self.watcher.close()
+
+def monitor_mounts():
+    check = MountCheck()
+    while True:
+        delay = check.tick() or check.interval
+        check.wait_for_event(delay)
 
 if __name__ == "__main__":
     monitor_mounts()
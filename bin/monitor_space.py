@@ -1,99 +1,345 @@
 #!/usr/bin/python3
 
 import os
-import shutil
-import subprocess
+import json
 import time
 import sys
+import threading
+from array import array
 from configparser import ConfigParser, MissingSectionHeaderError
 import argparse
 
-# Default threshold if no config file is found
+from tipi_notify import notify
+import disk_usage
+import tipi_metrics
+import tipi_paths
+import tipi_timeseries
+
+# Default thresholds if no config file is found
 DEFAULT_THRESHOLD = 95
+DEFAULT_CRITICAL = 99  # Tipi is stopped at this usage
+DEFAULT_HYSTERESIS = 2  # Percentage points usage must drop below a threshold to clear it
+DEFAULT_WARNING_HOURS = 24  # Alert when a filesystem is forecast to fill within this time
+DEFAULT_CRITICAL_HOURS = 1  # Stop Tipi when a filesystem is forecast to fill within this time
 
 # Path to the config file
-CONFIG_FILE = "/root/runtipi/etc/monitor_space.conf"
+CONFIG_FILE = os.path.join(tipi_paths.CONFIG_DIR, "monitor_space.conf")
+RUNTIPI_DIR = tipi_paths.RUNTIPI_DIR
+DEFAULT_PATHS = ["/", RUNTIPI_DIR, os.path.join(RUNTIPI_DIR, "app-data"), os.path.join(RUNTIPI_DIR, "media")]
+
+# Usage history shared with 'monitor_space.py --status'
+STATE_DIR = tipi_paths.STATE_DIR
+HISTORY_FILE = os.path.join(STATE_DIR, "space_history.json")
+HISTORY_SIZE = 120  # Samples kept per filesystem, two hours at the default interval
+MIN_FORECAST_SAMPLES = 5
+MIN_FORECAST_SPAN = 1800  # Seconds of history before a forecast is made, so a short burst can't stop Tipi
+NOTIFY_INTERVAL = 600  # Seconds between repeated alerts for the same filesystem
 
-# Command to send notification
-NOTIFICATION_CMD = "gotify push --title {hostname} drive is {drive_percent_full}"
+FS_SIZE = tipi_metrics.gauge("tipi_filesystem_size_bytes", "Size of a watched filesystem.", ["path"])
+FS_USED = tipi_metrics.gauge("tipi_filesystem_used_bytes", "Used bytes of a watched filesystem.", ["path"])
+FS_AVAILABLE = tipi_metrics.gauge("tipi_filesystem_available_bytes", "Bytes available to non-root users.", ["path"])
+FS_FILL_RATE = tipi_metrics.gauge("tipi_filesystem_fill_rate_bytes_per_second", "Estimated growth rate of used space.", ["path"])
+FS_TIME_TO_FULL = tipi_metrics.gauge("tipi_filesystem_seconds_until_full", "Forecast time until the filesystem is full.", ["path"])
+FS_STATE = tipi_metrics.gauge("tipi_filesystem_state", "0 ok, 1 warning, 2 critical.", ["path"])
+TIPI_STOPPED = tipi_metrics.gauge("tipi_space_stopped", "1 while Tipi is stopped because a filesystem is critical.")
 
 # Commands to stop and start the process
-STOP_CMD = "cd /root/runtipi && ./runtipi-cli stop"
-START_CMD = "cd /root/runtipi && ./runtipi-cli start"
-
-def get_drive_usage(debug=False):
-    disk_usage = shutil.disk_usage("/")
-    total = disk_usage.total
-    used = disk_usage.used
-    free = disk_usage.free
-    drive_percent_full = (used / total) * 100  # Use floating-point division
+STOP_CMD = f"cd {RUNTIPI_DIR} && ./runtipi-cli stop"
+START_CMD = f"cd {RUNTIPI_DIR} && ./runtipi-cli start"
+
+def get_filesystem_usage(path, debug=False):
+    """Return (total bytes, used bytes, available bytes) for the filesystem holding path."""
+    st = os.statvfs(path)
+    total = st.f_blocks * st.f_frsize
+    available = st.f_bavail * st.f_frsize
+    # Like df, used excludes root-reserved blocks and percent full is used / (used + available)
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
     if debug:
-        print(f"Debug: Disk usage - Total: {total}, Used: {used}, Free: {free}, Percent Full: {drive_percent_full:.2f}%")
-    return drive_percent_full
+        print(f"Debug: {path} - Total: {total}, Used: {used}, Available: {available}")
+    return used + available, used, available
+
+def get_filesystems(paths, debug=False):
+    """Map each distinct filesystem to the first configured path on it."""
+    filesystems = {}
+    for path in paths:
+        try:
+            device = os.stat(path).st_dev
+        except OSError:
+            if debug:
+                print(f"Debug: Skipping missing path {path}")
+            continue
+        filesystems.setdefault(device, path)
+    return filesystems
+
+class SampleRing:
+    """Fixed-size ring buffer of (time, used bytes) samples for one filesystem."""
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.times = array("d", bytes(8 * size))
+        self.used = array("d", bytes(8 * size))
+        self.size = size
+        self.count = 0
+        self.head = 0
+
+    def append(self, timestamp, used):
+        self.times[self.head] = timestamp
+        self.used[self.head] = used
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def samples(self):
+        """Return the samples oldest first."""
+        start = (self.head - self.count) % self.size
+        return [(self.times[(start + i) % self.size], self.used[(start + i) % self.size]) for i in range(self.count)]
+
+    def fill_rate(self):
+        """Least-squares growth rate in bytes per second, or None without enough history."""
+        samples = self.samples()
+        if len(samples) < MIN_FORECAST_SAMPLES or samples[-1][0] - samples[0][0] < MIN_FORECAST_SPAN:
+            return None
+        mean_t = sum(t for t, _ in samples) / len(samples)
+        mean_u = sum(u for _, u in samples) / len(samples)
+        variance = sum((t - mean_t) ** 2 for t, _ in samples)
+        if variance == 0:
+            return None
+        return sum((t - mean_t) * (u - mean_u) for t, u in samples) / variance
+
+    @classmethod
+    def from_list(cls, samples, size=HISTORY_SIZE):
+        ring = cls(size)
+        for timestamp, used in samples[-size:]:
+            ring.append(timestamp, used)
+        return ring
+
+def forecast(ring, available):
+    """Return (fill rate in bytes/s, seconds until full or None if not filling)."""
+    rate = ring.fill_rate()
+    if rate is None or rate <= 0:
+        return rate, None
+    return rate, available / rate
+
+def format_duration(seconds):
+    if seconds is None:
+        return "never"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f}m"
+    if seconds < 172800:
+        return f"{seconds / 3600:.1f}h"
+    return f"{seconds / 86400:.1f}d"
 
 def read_config(debug=False):
+    """Return the thresholds and watched paths from the config file."""
+    settings = {
+        "threshold": DEFAULT_THRESHOLD,
+        "critical": DEFAULT_CRITICAL,
+        "hysteresis": DEFAULT_HYSTERESIS,
+        "warning_seconds": DEFAULT_WARNING_HOURS * 3600,
+        "critical_seconds": DEFAULT_CRITICAL_HOURS * 3600,
+        "paths": DEFAULT_PATHS,
+    }
     config = ConfigParser()
     try:
         config.read(CONFIG_FILE)
         if debug:
             print(f"Debug: Reading config file {CONFIG_FILE}")
-        if "thresholds" in config and "drive_usage" in config["thresholds"]:
-            threshold = int(config["thresholds"]["drive_usage"])
-            if debug:
-                print(f"Debug: Found threshold in config file: {threshold}")
-            return threshold
+        if "thresholds" in config:
+            thresholds = config["thresholds"]
+            settings["threshold"] = float(thresholds.get("drive_usage", DEFAULT_THRESHOLD))
+            settings["critical"] = float(thresholds.get("critical_usage", DEFAULT_CRITICAL))
+            settings["hysteresis"] = float(thresholds.get("hysteresis", DEFAULT_HYSTERESIS))
+            settings["warning_seconds"] = float(thresholds.get("forecast_warning_hours", DEFAULT_WARNING_HOURS)) * 3600
+            settings["critical_seconds"] = float(thresholds.get("forecast_critical_hours", DEFAULT_CRITICAL_HOURS)) * 3600
+        if "filesystems" in config and config["filesystems"].get("paths"):
+            settings["paths"] = [p.strip() for p in config["filesystems"]["paths"].split(",") if p.strip()]
     except MissingSectionHeaderError as e:
         print(f"Error: {e}")
     if debug:
-        print(f"Debug: Using default threshold: {DEFAULT_THRESHOLD}")
-    return DEFAULT_THRESHOLD
+        print(f"Debug: Using settings {settings}")
+    return settings
+
+def load_history():
+    """Return {path: SampleRing} saved by the monitor."""
+    try:
+        with open(HISTORY_FILE, "r") as f:
+            return {path: SampleRing.from_list(samples) for path, samples in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+def save_history(rings):
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp_path = f"{HISTORY_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({path: ring.samples() for path, ring in rings.items()}, f)
+        os.replace(tmp_path, HISTORY_FILE)
+    except OSError as e:
+        print(f"Error saving space history: {e}")
 
 def send_notification(hostname, drive_percent_full, debug=False):
-    cmd = NOTIFICATION_CMD.format(hostname=hostname, drive_percent_full=drive_percent_full)
+    message = f"drive is {drive_percent_full}"
     if debug:
-        print(f"Debug: Sending notification with command: {cmd}")
-    try:
-        subprocess.run(cmd, shell=True)
-    except:
-        False
+        print(f"Debug: Sending notification: {message}")
+    notify(hostname, message)
+
+class SpaceCheck:
+    """Sample every watched filesystem once per tick and act on the forecast.
+
+    Each filesystem keeps a ring buffer of recent samples, from which the
+    fill rate and time to full are estimated. A filesystem enters the
+    warning state above the usage threshold or when forecast to fill within
+    the warning horizon, and the critical state (Tipi is stopped) above the
+    critical usage or when forecast to fill within the critical horizon.
+    Each state only clears once usage is `hysteresis` points below its
+    threshold and the forecast is at least twice its horizon away, so a
+    single reading around a threshold never flips it back and forth.
+    Alerts name the apps that grew the most according to the previous
+    disk usage scan; the next scan runs in the background.
+    """
+
+    name = "drive_space"
+    interval = 60
+
+    def __init__(self, debug=False):
+        self.debug = debug
+        self.hostname = os.uname().nodename
+        self.settings = read_config(debug)
+        self.rings = load_history()
+        self.warning = set()
+        self.critical = set()
+        self.last_notification_time = {}
+        self.process_stopped = False
+        self.growers_note = ""
+        self.scan_thread = None
+
+    def scan_growers(self):
+        """Refresh the 'top growers' note attached to alerts; runs in a background thread."""
+        try:
+            growers = disk_usage.top_growers(3)
+        except OSError as e:
+            if self.debug:
+                print(f"Debug: Disk usage scan failed: {e}")
+            return
+        self.growers_note = ", top growers: " + ", ".join(f"{name} {disk_usage.format_size(growth, signed=True)}"
+                                                          for name, growth in growers) if growers else ""
+
+    def refresh_growers(self):
+        """Start a scan unless one is still running; a cold scan of a large tree takes minutes."""
+        if self.scan_thread is None or not self.scan_thread.is_alive():
+            self.scan_thread = threading.Thread(target=self.scan_growers, name="top growers", daemon=True)
+            self.scan_thread.start()
+
+    def send_alerts(self, alerts):
+        """Send the due alerts with the note of the last finished scan, then start the next scan."""
+        current_time = time.time()
+        sent = False
+        for path, message in alerts:
+            if current_time - self.last_notification_time.get(path, 0) >= NOTIFY_INTERVAL:
+                send_notification(self.hostname, message + self.growers_note, self.debug)
+                self.last_notification_time[path] = current_time
+                sent = True
+        if sent:
+            self.refresh_growers()
+
+    def update_state(self, states, path, percent_full, time_to_full, threshold, horizon):
+        """Apply hysteresis to one state set; return True if path is in it afterwards."""
+        forecast_hit = time_to_full is not None and time_to_full <= horizon
+        if percent_full >= threshold or forecast_hit:
+            states.add(path)
+        elif path in states:
+            forecast_clear = time_to_full is None or time_to_full > 2 * horizon
+            if percent_full < threshold - self.settings["hysteresis"] and forecast_clear:
+                states.discard(path)
+        return path in states
+
+    def record_metrics(self, path, total, used, available, rate, time_to_full, state):
+        FS_SIZE.set(total, path=path)
+        FS_USED.set(used, path=path)
+        FS_AVAILABLE.set(available, path=path)
+        FS_STATE.set(state, path=path)
+        if rate is None:
+            FS_FILL_RATE.remove(path=path)
+        else:
+            FS_FILL_RATE.set(rate, path=path)
+        if time_to_full is None:
+            FS_TIME_TO_FULL.remove(path=path)
+        else:
+            FS_TIME_TO_FULL.set(time_to_full, path=path)
+
+    def tick(self):
+        settings = self.settings
+        now = time.time()
+        alerts = []
+        for path in get_filesystems(settings["paths"], self.debug).values():
+            total, used, available = get_filesystem_usage(path, self.debug)
+            ring = self.rings.setdefault(path, SampleRing())
+            ring.append(now, used)
+            percent_full = used / total * 100 if total else 0
+            tipi_timeseries.record(f"filesystem_used_percent:{path}", percent_full, now)
+            rate, time_to_full = forecast(ring, available)
+
+            warning = self.update_state(self.warning, path, percent_full, time_to_full,
+                                        settings["threshold"], settings["warning_seconds"])
+            critical = self.update_state(self.critical, path, percent_full, time_to_full,
+                                         settings["critical"], settings["critical_seconds"])
+            self.record_metrics(path, total, used, available, rate, time_to_full, 2 if critical else 1 if warning else 0)
+            if warning or critical:
+                alert = f"{percent_full:.2f}% ({path})"
+                if time_to_full is not None:
+                    alert += f", full in {format_duration(time_to_full)}"
+                alerts.append((path, alert))
+            if self.debug:
+                print(f"Debug: {path} {percent_full:.2f}% full, full in {format_duration(time_to_full)}, "
+                      f"warning={warning} critical={critical}")
+
+        save_history(self.rings)
+
+        if self.critical and not self.process_stopped:
+            if self.debug:
+                print(f"Debug: Critical filesystems {sorted(self.critical)}, stopping the process")
+            tipi_metrics.run(STOP_CMD, shell=True)
+            self.process_stopped = True
+        elif not self.critical and self.process_stopped:
+            if self.debug:
+                print(f"Debug: No critical filesystems left, restarting the process")
+            tipi_metrics.run(START_CMD, shell=True)
+            self.process_stopped = False
+        TIPI_STOPPED.set(int(self.process_stopped))
+        # Only after the stop, so neither the stop nor the alerts wait for the disk usage scan
+        self.send_alerts(alerts)
+
+def print_status(debug=False):
+    """Print current usage and the forecast for each watched filesystem."""
+    settings = read_config(debug)
+    rings = load_history()
+    print(f"{'Filesystem':<30} {'Size':>9} {'Used':>7} {'Growth/day':>11} {'Full in':>8}")
+    for path in get_filesystems(settings["paths"], debug).values():
+        total, used, available = get_filesystem_usage(path, debug)
+        ring = rings.get(path, SampleRing())
+        rate, time_to_full = forecast(ring, available)
+        growth = f"{rate * 86400 / 1e9:+.2f}GB" if rate is not None else "n/a"
+        percent_full = used / total * 100 if total else 0
+        print(f"{path:<30} {total / 1e9:>7.1f}GB {percent_full:>6.1f}% {growth:>11} {format_duration(time_to_full):>8}")
+
 def main():
     parser = argparse.ArgumentParser(description="Monitor disk space and manage processes")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+    parser.add_argument("--status", action="store_true", help="Print usage and forecast per filesystem and exit")
     args = parser.parse_args()
 
     debug = args.debug
-    hostname = os.uname().nodename
-    if debug:
-        print(f"Debug: Hostname is {hostname}")
+    if args.status:
+        print_status(debug)
+        return
 
-    threshold = read_config(debug)
-    last_notification_time = 0
-    process_stopped = False
+    check = SpaceCheck(debug)
+    if debug:
+        print(f"Debug: Hostname is {check.hostname}")
 
     while True:
-        drive_percent_full = get_drive_usage(debug)
-
-        if drive_percent_full >= threshold:
-            current_time = time.time()
-            if current_time - last_notification_time >= 600:
-                send_notification(hostname, f"{drive_percent_full:.2f}%", debug)
-                last_notification_time = current_time
-
-            if drive_percent_full >= 15:
-                if debug:
-                    print(f"Debug: Drive percent full is {drive_percent_full:.2f}%, stopping the process")
-                subprocess.run(STOP_CMD, shell=True)
-                process_stopped = True
-
-        if drive_percent_full < 15 and process_stopped:
-            if debug:
-                print(f"Debug: Drive percent full is {drive_percent_full:.2f}%, restarting the process")
-            subprocess.run(START_CMD, shell=True)
-            process_stopped = False
-
+        check.tick()
         if debug:
             print(f"Debug: Sleeping for 1 minute")
-        time.sleep(60)  # Wait for 1 minute
+        time.sleep(check.interval)  # Wait for 1 minute
 
 if __name__ == "__main__":
     main()
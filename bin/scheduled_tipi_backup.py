@@ -1,16 +1,59 @@
 #!/usr/bin/python3
 
 import os
-import subprocess
 import time
 import configparser
+import argparse
+import bz2
+import collections
+import gzip
+import hashlib
+import http.client
+import json
+import lzma
+import stat
+import subprocess
+import sys
+import tarfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 
+import backup_targets
+import tipi_metrics
+import tipi_paths
+
 # Define paths and constants
-BASE_DIR = "/root/runtipi"
+BASE_DIR = tipi_paths.RUNTIPI_DIR
 BACKUP_DIR = os.path.join(BASE_DIR, "backup")
-CONFIG_FILE = os.path.join(BASE_DIR, "etc", "scheduled_tipi_backup.conf")
+RUNTIPI_CLI = os.path.join(BASE_DIR, "runtipi-cli")
+CONFIG_FILE = os.path.join(tipi_paths.CONFIG_DIR, "scheduled_tipi_backup.conf")
 DEFAULT_MAX_BACKUPS = 7
+DEFAULT_MODE = "archive"  # "archive" for Tipi_*.tar.gz, "dedup" for the chunk store
+
+# Deduplicating chunk store layout
+STORE_DIR = os.path.join(BACKUP_DIR, "store")
+CHUNKS_DIR = os.path.join(STORE_DIR, "chunks")
+SNAPSHOTS_DIR = os.path.join(STORE_DIR, "snapshots")
+CHUNK_SIZE = 4 * 1024 * 1024  # Fixed chunk size in bytes
+CHUNK_COMPRESSION_LEVEL = 3
+
+# Archive compression: codec name -> archive file extension
+CODECS = {"gzip": "gz", "bzip2": "bz2", "xz": "xz"}
+DEFAULT_CODEC = "gzip"
+DEFAULT_LEVEL = 6
+COMPRESSION_BLOCK_SIZE = 4 * 1024 * 1024  # Uncompressed bytes per compressed block
+# Sidecar index of an archive: its compressed blocks and the byte range of every member,
+# with SHA-256 hashes of the blocks, the whole archive and every file's content
+INDEX_SUFFIX = ".index.json.gz"
+VERIFY_SUFFIX = ".verified.json"  # Result of the last verification of an archive
+VERIFY_MODES = ("quick", "full", "off")
+# The block and archive hashes are taken while the archive streams out, so by default a new
+# archive is not read back; that is left to 'backup verify', which on ssh or S3 downloads it
+DEFAULT_VERIFY = "off"
+RESTORE_WORKERS = 4  # Blocks decompressed ahead while restoring
+# Python 3.12+ warns unless extraction filters are chosen, "tar" keeps permissions like tar does
+EXTRACT_OPTIONS = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
 
 # Directories and files to include in the backup
 ITEMS_TO_BACKUP = [
@@ -27,53 +70,1005 @@ ITEMS_TO_BACKUP = [
     "VERSION"
 ]
 
-def create_backup():
-    # Ensure backup directory exists
+# Staged mode captures everything else live, then each app-data/<app> while that app is stopped
+APP_DATA_ITEM = "app-data"
+DOWNTIME_LOG = os.path.join(BACKUP_DIR, "staged_downtime.jsonl")
+
+BACKUP_DURATION = tipi_metrics.histogram("tipi_backup_duration_seconds", "Time taken by a backup run.", ["mode"])
+BACKUP_SUCCESS = tipi_metrics.gauge("tipi_backup_success", "1 if the last backup run succeeded.", ["mode"])
+BACKUP_LAST_RUN = tipi_metrics.gauge("tipi_backup_last_run_timestamp_seconds", "Time the last backup run finished.", ["mode"])
+BACKUP_BYTES_READ = tipi_metrics.gauge("tipi_backup_read_bytes", "Bytes read by the last backup run.", ["mode"])
+BACKUP_BYTES_WRITTEN = tipi_metrics.gauge("tipi_backup_written_bytes", "Bytes written by the last backup run.", ["mode"])
+BACKUP_VERIFIED = tipi_metrics.gauge("tipi_backup_verify_success", "1 if the archive passed its last verification.", ["archive"])
+APP_DOWNTIME = tipi_metrics.gauge("tipi_backup_app_downtime_seconds", "Seconds each app was stopped by the last staged backup.", ["app"])
+
+def compress_block(codec, level, data):
+    """Compress one block as a complete, independent stream for the codec."""
+    if codec == "gzip":
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if codec == "bzip2":
+        return bz2.compress(data, compresslevel=max(1, level))
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+def compress_and_hash(codec, level, data):
+    """Compress a block and hash the result in the worker process."""
+    compressed = compress_block(codec, level, data)
+    return compressed, hashlib.sha256(compressed).hexdigest()
+
+def decompress_block(codec, data, digest=None):
+    """Decompress one block, first checking it against its SHA-256 if the index has one."""
+    if digest and hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError("compressed block does not match its checksum")
+    if codec == "gzip":
+        return gzip.decompress(data)
+    if codec == "bzip2":
+        return bz2.decompress(data)
+    return lzma.decompress(data, format=lzma.FORMAT_XZ)
+
+class ParallelCompressor:
+    """Write-only file object that compresses fixed-size blocks on a process pool.
+
+    Each block becomes a complete gzip member / bzip2 stream / xz stream, and
+    the blocks are written out in order. Concatenated streams are valid for
+    all three formats, so the result reads with plain tar, gzip, bzip2 or xz.
+    The (offset, length, SHA-256) of every compressed block is kept in
+    `blocks`, so block n, holding uncompressed bytes n * block_size onwards,
+    can be read, checked and decompressed on its own. The blocks are hashed
+    by the workers and the whole output as it is written, so checksums never
+    need a second read of the data.
+    """
+
+    def __init__(self, fileobj, codec=DEFAULT_CODEC, level=DEFAULT_LEVEL, workers=None, block_size=COMPRESSION_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.blocks = []
+        self.sha256 = hashlib.sha256()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        # Bound memory use to a couple of blocks per worker
+        while len(self.pending) >= self.workers * 2:
+            self._write_next()
+        self.bytes_in += len(block)
+        self.pending.append(self.executor.submit(compress_and_hash, self.codec, self.level, block))
+
+    def _write_next(self):
+        compressed, digest = self.pending.popleft().result()
+        self.fileobj.write(compressed)
+        self.sha256.update(compressed)
+        self.blocks.append([self.bytes_out, len(compressed), digest])
+        self.bytes_out += len(compressed)
+
+    def close(self):
+        if self.executor is None:
+            return
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self._write_next()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class FixedSizeReader:
+    """Read exactly `size` bytes from a file, zero-padding if it shrank.
+
+    The tar header is written before the data, so a file that changes while
+    it is archived must not change the number of bytes that follow it. The
+    bytes handed to tar are hashed on the way through.
+    """
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remaining = size
+        self.sha256 = hashlib.sha256()
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.fileobj.read(n)
+        if len(data) < n:
+            data += bytes(n - len(data))
+        self.remaining -= n
+        self.sha256.update(data)
+        return data
+
+class BlockReader:
+    """Read-only file object over bytes start to end of an indexed archive's tar stream.
+
+    Only the compressed blocks covering the range are read, and a few of
+    them are decompressed ahead on a thread pool.
+    """
+
+    def __init__(self, fileobj, index, start, end, workers=RESTORE_WORKERS):
+        self.fileobj = fileobj
+        self.codec = index["codec"]
+        self.blocks = index["blocks"]
+        self.next_block = start // index["block_size"]
+        self.last_block = (end - 1) // index["block_size"]
+        self.skip = start - self.next_block * index["block_size"]
+        self.remaining = end - start
+        self.buffer = bytearray()
+        self.workers = workers
+        self.pending = collections.deque()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _fill(self):
+        while self.next_block <= self.last_block and len(self.pending) < self.workers * 2:
+            offset, length, *digest = self.blocks[self.next_block]
+            self.fileobj.seek(offset)
+            self.pending.append(self.executor.submit(decompress_block, self.codec, self.fileobj.read(length), *digest))
+            self.next_block += 1
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        while len(self.buffer) < n:
+            self._fill()
+            if not self.pending:
+                raise EOFError("Archive ends before the range in its index")
+            block = self.pending.popleft().result()
+            self.buffer += block[self.skip:]
+            self.skip = 0
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        self.remaining -= n
+        return data
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_compression_settings():
+    """Return (codec, level, workers) from the config file."""
+    config = configparser.ConfigParser()
+    if os.path.exists(CONFIG_FILE):
+        config.read(CONFIG_FILE)
+    codec = config.get("compression", "codec", fallback=DEFAULT_CODEC).strip().lower()
+    if codec not in CODECS:
+        print(f"Unknown codec {codec}, using {DEFAULT_CODEC}")
+        codec = DEFAULT_CODEC
+    level = int(config.get("compression", "level", fallback=DEFAULT_LEVEL))
+    workers = int(config.get("compression", "workers", fallback=0)) or os.cpu_count() or 1
+    return codec, level, workers
+
+def read_verify_setting():
+    """Return how new archives are verified: quick (blocks only), full (also file contents) or off."""
+    config = configparser.ConfigParser()
+    if os.path.exists(CONFIG_FILE):
+        config.read(CONFIG_FILE)
+    verify = config.get("settings", "verify", fallback=DEFAULT_VERIFY).strip().lower()
+    if verify not in VERIFY_MODES:
+        print(f"Unknown verify setting {verify}, using {DEFAULT_VERIFY}")
+        verify = DEFAULT_VERIFY
+    return verify
+
+def add_to_archive(tar, base_dir, items, members=None):
+    """Add the backup items to an open tarfile, with tar's path layout.
+
+    If members is a list, [name, type, size, start, end, sha256] is
+    appended for every member, start and end being its offsets in the
+    uncompressed tar and sha256 the hash of a regular file's content.
+    """
+    prefix = base_dir.lstrip("/")
+    for path, arcname, st in walk_items(base_dir, items):
+        try:
+            tarinfo = tar.gettarinfo(path, os.path.join(prefix, arcname))
+        except OSError as e:
+            print(f"Error reading {path}: {e}")
+            continue
+        if tarinfo is None:
+            # Sockets and other special files are skipped, like tar does
+            continue
+        start = tar.offset
+        digest = None
+        if not tarinfo.isreg():
+            tar.addfile(tarinfo)
+        else:
+            try:
+                with open(path, "rb") as f:
+                    reader = FixedSizeReader(f, tarinfo.size)
+                    tar.addfile(tarinfo, reader)
+                digest = reader.sha256.hexdigest()
+            except OSError as e:
+                print(f"Error reading {path}: {e}")
+                continue
+        if members is not None:
+            members.append([tarinfo.name, tarinfo.type.decode(), tarinfo.size, start, tar.offset, digest])
+
+_target = None
+
+def get_target():
+    """Return the backup target configured in the config file, BACKUP_DIR if there is none."""
+    global _target
+    if _target is None:
+        _target = backup_targets.load_target(CONFIG_FILE, BACKUP_DIR)
+    return _target
+
+def index_name(name):
+    return name + INDEX_SUFFIX
+
+def write_index(name, codec, compressor, members, created):
+    """Write the sidecar index of an archive, with a summary for listing."""
+    prefix = BASE_DIR.lstrip("/")
+    apps = {}
+    files = 0
+    for member_name, member_type, size, *_ in members:
+        parts = os.path.relpath(member_name, prefix).split(os.sep)
+        files += member_type in ("0", "7")
+        if parts[0] == APP_DATA_ITEM and len(parts) > 1 and (len(parts) > 2 or member_type == "5"):
+            apps[parts[1]] = apps.get(parts[1], 0) + size
+    index = {"archive": name, "created": created, "base_dir": BASE_DIR,
+             "codec": codec, "block_size": compressor.block_size, "bytes_in": compressor.bytes_in,
+             "bytes_out": compressor.bytes_out, "sha256": compressor.sha256.hexdigest(), "files": files, "apps": apps,
+             "blocks": compressor.blocks, "members": members}
+    get_target().put(index_name(name), gzip.compress(json.dumps(index, separators=(",", ":")).encode(), mtime=0))
+
+def load_index(name):
+    """Return the index of an archive, or None for archives written without one."""
+    try:
+        data = get_target().get(index_name(name))
+        return None if data is None else json.loads(gzip.decompress(data))
+    except (OSError, ValueError, EOFError, http.client.HTTPException) as e:
+        print(f"Error reading index of {name}: {e}")
+        return None
+
+def get_running_apps():
+    """Return the compose projects with running containers, or None if unknown."""
+    try:
+        result = tipi_metrics.run(["docker", "ps", "--format", '{{.Label "com.docker.compose.project"}}'],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Could not list running apps, treating every app as running: {e}")
+        return None
+    return set(result.stdout.split())
+
+def run_app_command(action, app_name):
+    """Run 'runtipi-cli app <action> <app>' and return True on success."""
+    result = tipi_metrics.run([RUNTIPI_CLI, "app", action, app_name], cwd=BASE_DIR,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode != 0:
+        print(f"Error running app {action} for {app_name}: {result.stdout.strip()}")
+    return result.returncode == 0
+
+def run_staged(capture):
+    """Capture shared state live, then each app's data while only that app is stopped.
+
+    Apps are restarted on a background pool so the next app's capture never
+    waits for the previous app to come back up. Returns {app: downtime seconds}.
+    """
+    app_data_dir = os.path.join(BASE_DIR, APP_DATA_ITEM)
+    app_names, loose_files = [], []
+    if os.path.isdir(app_data_dir):
+        for name in sorted(os.listdir(app_data_dir)):
+            if os.path.isdir(os.path.join(app_data_dir, name)):
+                app_names.append(name)
+            else:
+                loose_files.append(os.path.join(APP_DATA_ITEM, name))
+
+    print("Capturing shared state...")
+    capture([item for item in ITEMS_TO_BACKUP if item != APP_DATA_ITEM] + loose_files)
+
+    running = get_running_apps()
+    downtime = {}
+
+    def restart(app_name, stopped_at):
+        run_app_command("start", app_name)
+        downtime[app_name] = time.monotonic() - stopped_at
+
+    with ThreadPoolExecutor(max_workers=4) as restarts:
+        for app_name in app_names:
+            item = os.path.join(APP_DATA_ITEM, app_name)
+            if running is not None and app_name not in running:
+                # Already offline, nothing to stop or start
+                capture([item])
+                continue
+            stopped_at = time.monotonic()
+            if not run_app_command("stop", app_name):
+                print(f"Capturing {app_name} while running, it could not be stopped")
+                capture([item])
+                continue
+            try:
+                capture([item])
+            finally:
+                # Bring the app back even if its capture failed
+                restarts.submit(restart, app_name, stopped_at)
+
+    if downtime:
+        print(f"{'App':<30} {'Downtime (s)':>12}")
+        for app_name, seconds in sorted(downtime.items(), key=lambda d: d[1], reverse=True):
+            print(f"{app_name:<30} {seconds:>12.1f}")
+        print(f"{len(downtime)} apps stopped, longest downtime {max(downtime.values()):.1f}s")
+        for app_name, seconds in downtime.items():
+            APP_DOWNTIME.set(round(seconds, 1), app=app_name)
+        try:
+            with open(DOWNTIME_LOG, "a") as f:
+                f.write(json.dumps({"time": datetime.now().isoformat(timespec="seconds"),
+                                    "downtime": {app: round(seconds, 1) for app, seconds in downtime.items()}}) + "\n")
+        except OSError as e:
+            print(f"Error recording downtime: {e}")
+    return downtime
+
+def create_backup(staged=False):
+    # Ensure backup directory exists, it also holds the downtime log of staged backups
     try:
         if not os.path.exists(BACKUP_DIR):
             os.makedirs(BACKUP_DIR)
     except OSError as e:
         print(f"Error creating backup directory {BACKUP_DIR}: {e}")
-        return
+        return False
 
     # Get the current time for the backup filename
+    codec, level, workers = read_compression_settings()
+    verify = read_verify_setting()
     current_time = datetime.now().strftime("%Y%m%d%H%M%S")
-    backup_filename = f"Tipi_{current_time}.tar.gz"
-    backup_filepath = os.path.join(BACKUP_DIR, backup_filename)
-
-    # Create tarball with --one-file-system option using subprocess
-    cmd = ["tar", "--one-file-system", "-czf", backup_filepath]
-    cmd.extend([os.path.join(BASE_DIR, item) for item in ITEMS_TO_BACKUP])
-    
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if result.returncode != 0:
-        print(f"Error creating backup: {result.stderr.decode('utf-8')}")
-    else:
-        print(f"Backup created: {backup_filepath}")
-        manage_backups()
+    backup_filename = f"Tipi_{current_time}.tar.{CODECS[codec]}"
 
-def manage_backups():
-    # Read the config file to get the maximum number of backups to keep
+    # The archive streams to the target as it is compressed and only appears under
+    # its name once complete, so retention never sees a partial backup
+    start = time.monotonic()
+    members = []
+    out = None
+    try:
+        target = get_target()
+        out = target.open_write(backup_filename)
+        with ParallelCompressor(out, codec, level, workers) as compressor:
+            with tarfile.open(fileobj=compressor, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                def capture(items):
+                    add_to_archive(tar, BASE_DIR, items, members)
+
+                if staged:
+                    run_staged(capture)
+                else:
+                    capture(ITEMS_TO_BACKUP)
+        # The index goes first, an archive without its index would only restore slowly
+        write_index(backup_filename, codec, compressor, members, current_time)
+        out.close()
+    except Exception as e:
+        print(f"Error creating backup: {e}")
+        if out is not None:
+            out.abort()
+            try:
+                target.delete(index_name(backup_filename))
+            except (OSError, http.client.HTTPException):
+                pass
+        return False
+
+    elapsed = max(time.monotonic() - start, 1e-6)
+    print(f"Backup created: {target.location(backup_filename)}")
+    print(f"  {compressor.bytes_in / 1e6:.1f} MB read, {compressor.bytes_out / 1e6:.1f} MB written "
+          f"({codec} level {level}) in {elapsed:.1f}s: {compressor.bytes_in / 1e6 / elapsed:.1f} MB/s "
+          f"using {compressor.workers} cores")
+    BACKUP_BYTES_READ.set(compressor.bytes_in, mode="archive")
+    BACKUP_BYTES_WRITTEN.set(compressor.bytes_out, mode="archive")
+    verified = True
+    if verify != "off":
+        verified = verify_archive(backup_filename, verify == "full", workers)
+    manage_backups()
+    return verified
+
+def read_settings():
+    """Return (max_backups, mode) from the config file."""
     config = configparser.ConfigParser()
     if os.path.exists(CONFIG_FILE):
         config.read(CONFIG_FILE)
-        max_backups = int(config.get("settings", "max_backups", fallback=DEFAULT_MAX_BACKUPS))
+    max_backups = int(config.get("settings", "max_backups", fallback=DEFAULT_MAX_BACKUPS))
+    mode = config.get("settings", "mode", fallback=DEFAULT_MODE).strip().lower()
+    return max_backups, mode
+
+def list_archives(sizes=False):
+    """Return the archive names on the backup target, oldest first, as {name: size} if sizes is set."""
+    extensions = tuple(f".tar.{ext}" for ext in CODECS.values())
+    archives = {name: size for name, size in get_target().list() if name.startswith("Tipi_") and name.endswith(extensions)}
+    return archives if sizes else list(archives)
+
+def verification_name(name):
+    return name + VERIFY_SUFFIX
+
+def load_verification(name):
+    """Return the result of the archive's last verification, or None if it never was verified."""
+    try:
+        data = get_target().get(verification_name(name))
+        return None if data is None else json.loads(data)
+    except (OSError, ValueError, http.client.HTTPException):
+        return None
+
+def is_verified(name):
+    result = load_verification(name)
+    return bool(result and result.get("ok"))
+
+def check_blocks(name, index, workers):
+    """Hash every compressed block against the index, on a thread pool if the target allows random reads; return the errors."""
+    target = get_target()
+    mismatch = lambda offset: f"block at offset {offset} does not match its checksum"
+    if not target.random_access:
+        # One sequential read, the blocks are contiguous
+        errors = []
+        with target.open_read(name) as f:
+            for offset, length, digest in index["blocks"]:
+                if hashlib.sha256(f.read(length)).hexdigest() != digest:
+                    errors.append(mismatch(offset))
+        return errors
+
+    with target.open_ranges(name) as read:
+        def check(block):
+            offset, length, digest = block
+            return mismatch(offset) if hashlib.sha256(read(offset, length)).hexdigest() != digest else None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return [error for error in executor.map(check, index["blocks"]) if error]
+
+def check_contents(name, index, workers):
+    """Decompress the whole archive, checking every block and every file's content hash."""
+    expected = {member[0]: member[5] for member in index["members"] if len(member) > 5 and member[5]}
+    errors = []
+    seen = 0
+    try:
+        with get_target().open_read(name) as f, BlockReader(f, index, 0, index["bytes_in"], workers) as reader:
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                for member in tar:
+                    digest = expected.get(member.name)
+                    if digest is None or not member.isreg():
+                        continue
+                    seen += 1
+                    sha256 = hashlib.sha256()
+                    data = tar.extractfile(member)
+                    while chunk := data.read(1024 * 1024):
+                        sha256.update(chunk)
+                    if sha256.hexdigest() != digest:
+                        errors.append(f"{member.name} does not match its checksum")
+    except (OSError, EOFError, ValueError, zlib.error, lzma.LZMAError, tarfile.TarError, http.client.HTTPException) as e:
+        errors.append(f"unreadable: {e}")
+    if not errors and seen < len(expected):
+        errors.append(f"{len(expected) - seen} files are missing")
+    return errors
+
+def verify_archive(name, full=True, workers=None):
+    """Check an archive against the checksums in its index and record the result.
+
+    A quick check reads the compressed blocks once and hashes them on a
+    thread pool. A full check also decompresses them and compares every
+    file's content, which proves the archive restores. Returns True if the
+    archive is intact, None if it has no checksums to check against.
+    """
+    index = load_index(name)
+    if index is None or "sha256" not in index:
+        print(f"{name} has no checksums, it was written before backups recorded them")
+        return None
+    workers = workers or os.cpu_count() or 1
+    start = time.monotonic()
+    errors = []
+    try:
+        size = list_archives(sizes=True).get(name)
+        if size != index["bytes_out"]:
+            errors.append(f"archive is {size} bytes, {index['bytes_out']} were written")
+        errors += check_contents(name, index, workers) if full else check_blocks(name, index, workers)
+    except (OSError, http.client.HTTPException) as e:
+        errors.append(f"unreadable: {e}")
+
+    result = {"time": datetime.now().isoformat(timespec="seconds"), "ok": not errors,
+              "full": full, "errors": errors[:20]}
+    try:
+        get_target().put(verification_name(name), json.dumps(result).encode())
+    except (OSError, http.client.HTTPException) as e:
+        print(f"Error recording the verification of {name}: {e}")
+    BACKUP_VERIFIED.set(int(not errors), archive=name)
+
+    elapsed = max(time.monotonic() - start, 1e-6)
+    mb = (index["bytes_in"] if full else index["bytes_out"]) / 1e6
+    if errors:
+        print(f"{name} FAILED {'full' if full else 'quick'} verification:")
+        for error in errors[:20]:
+            print(f"  {error}")
     else:
-        max_backups = DEFAULT_MAX_BACKUPS
+        print(f"{name} verified ({'full' if full else 'quick'}): {mb:.1f} MB in {elapsed:.1f}s, {mb / elapsed:.1f} MB/s")
+    return not errors
+
+def manage_backups():
+    """Remove the oldest archives beyond max_backups, going by the target's own listing."""
+    max_backups, _ = read_settings()
+    target = get_target()
+    try:
+        target.cleanup()
+        backup_files = list_archives()
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        print(f"Error listing backups on {target}: {e}")
+        return
+    excess = max(len(backup_files) - max_backups, 0)
+    to_remove, kept = backup_files[:excess], backup_files[excess:]
 
-    # List all backup files and sort them by modification time
-    backup_files = [f for f in os.listdir(BACKUP_DIR) if f.startswith("Tipi_") and f.endswith(".tar.gz")]
-    backup_files.sort(key=lambda f: os.path.getmtime(os.path.join(BACKUP_DIR, f)))
+    # Never trade the last good backup for newer ones that are corrupt or unchecked
+    if to_remove and not any(is_verified(name) for name in kept):
+        verified = [name for name in to_remove if is_verified(name)]
+        if verified:
+            print(f"Keeping {verified[-1]}, none of the newer backups passed verification")
+            to_remove.remove(verified[-1])
 
     # Remove old backups if necessary
-    while len(backup_files) > max_backups:
-        oldest_backup = backup_files.pop(0)
+    for oldest_backup in to_remove:
         try:
-            os.remove(os.path.join(BACKUP_DIR, oldest_backup))
+            target.delete(oldest_backup)
             print(f"Removed old backup: {oldest_backup}")
-        except OSError as e:
+        except (OSError, http.client.HTTPException) as e:
             print(f"Error removing old backup {oldest_backup}: {e}")
 
+    # Indexes and results whose archive is gone, including those of the backups just removed
+    try:
+        names = [name for name, _ in target.list()]
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        print(f"Error listing backups on {target}: {e}")
+        return
+    for name in names:
+        suffix = next((suffix for suffix in (INDEX_SUFFIX, VERIFY_SUFFIX) if name.endswith(suffix)), None)
+        if suffix and name[:-len(suffix)] not in names:
+            try:
+                target.delete(name)
+            except (OSError, http.client.HTTPException) as e:
+                print(f"Error removing index {name}: {e}")
+
+def list_backups():
+    """Print every archive and what it holds, reading only the indexes."""
+    archives = list_archives(sizes=True)
+    if not archives:
+        print(f"No backups in {get_target()}")
+    for name, size in archives.items():
+        index = load_index(name)
+        if index is None:
+            print(f"{name:<32} {size / 1e6:>10.1f} MB  (no index, restores read the whole archive)")
+            continue
+        result = load_verification(name)
+        if result is None:
+            status = "not verified"
+        else:
+            status = f"{'verified' if result['ok'] else 'FAILED verification'} {result['time']}"
+        print(f"{name:<32} {index['bytes_out'] / 1e6:>10.1f} MB  {index['bytes_in'] / 1e6:.1f} MB uncompressed, "
+              f"{index['files']} files, {len(index['apps'])} apps, {status}")
+        if index["apps"]:
+            print("    " + ", ".join(f"{app} ({size / 1e6:.1f} MB)" for app, size in sorted(index["apps"].items())))
+    snapshots = list_snapshots()
+    if snapshots:
+        print(f"{len(snapshots)} snapshots in the chunk store, newest {snapshots[-1]}")
+
+def restore_selection(app_name=None, paths=()):
+    """Return the paths, relative to BASE_DIR, restored for an app and/or explicit paths."""
+    selection = []
+    if app_name:
+        selection += [os.path.join(APP_DATA_ITEM, app_name), os.path.join("apps", app_name),
+                      os.path.join("user-config", app_name)]
+    for path in paths:
+        if os.path.isabs(path):
+            path = os.path.relpath(path, BASE_DIR)
+        selection.append(os.path.normpath(path))
+    return selection
+
+def extract_members(tar, selection, target):
+    """Extract the members under the selected paths, with BASE_DIR's prefix removed.
+
+    A hard link is only restored when the file it links to is restored as
+    well; the archive holds that file's data once, under the other name,
+    so a link into an unselected path (e.g. a download hard-linked into
+    media) is reported and skipped.
+    """
+    prefix = BASE_DIR.lstrip("/")
+    strip = lambda name: os.path.relpath(name, prefix) if name.startswith(prefix + "/") else name
+    selected = lambda name: any(name == path or name.startswith(path + "/") for path in selection)
+    restored = 0
+    dirs = []
+    for member in tar:
+        name = strip(member.name)
+        if not selected(name):
+            continue
+        member.name = name
+        if member.islnk():
+            member.linkname = strip(member.linkname)
+            if not selected(member.linkname):
+                print(f"Skipped {name}: it is a hard link to {member.linkname}, which is not being restored")
+                continue
+        try:
+            tar.extract(member, target, **EXTRACT_OPTIONS)
+        except (OSError, KeyError, tarfile.TarError) as e:
+            print(f"Error restoring {name}: {e}")
+            continue
+        restored += 1
+        if member.isdir():
+            dirs.append(member)
+    # Extracting their contents changed the directory times, set them last
+    for member in reversed(dirs):
+        try:
+            os.utime(os.path.join(target, member.name), (member.mtime, member.mtime))
+        except OSError:
+            pass
+    return restored
+
+def restore_archive(name, selection, target):
+    """Restore the selected paths from an archive into target.
+
+    With an index, only the compressed blocks holding the selected members
+    are read; older archives without one are read from the start.
+    """
+    source = get_target()
+    index = load_index(name)
+    start = time.monotonic()
+    restored = read = 0
+    if index is None:
+        print(f"{name} has no index, reading the whole archive")
+        path = source.local_path(name)
+        if path:
+            with tarfile.open(path, "r:*") as tar:
+                restored = extract_members(tar, selection, target)
+        else:
+            with source.open_read(name) as f, tarfile.open(fileobj=f, mode="r|*") as tar:
+                restored = extract_members(tar, selection, target)
+        read = list_archives(sizes=True).get(name, 0)
+    else:
+        prefix = BASE_DIR.lstrip("/")
+        ranges = []
+        for member_name, _, _, member_start, member_end, *_ in index["members"]:
+            member_name = os.path.relpath(member_name, prefix)
+            if any(member_name == p or member_name.startswith(p + "/") for p in selection):
+                # Members of one directory are contiguous, merge them into one range
+                if ranges and ranges[-1][1] == member_start:
+                    ranges[-1][1] = member_end
+                else:
+                    ranges.append([member_start, member_end])
+        with source.open_read(name) as f:
+            for range_start, range_end in ranges:
+                with BlockReader(f, index, range_start, range_end) as reader:
+                    with tarfile.open(fileobj=reader, mode="r|") as tar:
+                        restored += extract_members(tar, selection, target)
+                first = range_start // index["block_size"]
+                last = (range_end - 1) // index["block_size"]
+                read += sum(block[1] for block in index["blocks"][first:last + 1])
+    if not restored:
+        print(f"Nothing in {name} matches {', '.join(selection)}")
+        return False
+    print(f"Restored {restored} entries from {name} to {target} in {time.monotonic() - start:.1f}s, "
+          f"{read / 1e6:.1f} MB of the archive read")
+    return True
+
+def restore(app_name=None, paths=(), name=None, target=None):
+    """Restore an app and/or paths from an archive, by default the newest, in place by default.
+
+    An app restored in place is stopped first and started again afterwards.
+    """
+    archives = list_archives()
+    if name is None:
+        if not archives:
+            print(f"No backups in {get_target()}")
+            return False
+        name = archives[-1]
+    elif name not in archives:
+        print(f"Backup {name} not found in {get_target()}")
+        return False
+    target = target or BASE_DIR
+    selection = restore_selection(app_name, paths)
+    in_place = app_name and os.path.realpath(target) == os.path.realpath(BASE_DIR)
+    if in_place and not run_app_command("stop", app_name):
+        print(f"Restoring {app_name} while it is running, it could not be stopped")
+    try:
+        return restore_archive(name, selection, target)
+    finally:
+        if in_place:
+            run_app_command("start", app_name)
+
+def walk_items(base_dir, items):
+    """Yield (path, arcname, lstat) for every entry under the backup items.
+
+    Like tar --one-file-system, directories on other filesystems are listed
+    but not descended into.
+    """
+    for item in items:
+        path = os.path.join(base_dir, item)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            print(f"Skipping missing item: {path}")
+            continue
+        yield path, item, st
+        if not stat.S_ISDIR(st.st_mode):
+            continue
+        root_dev = st.st_dev
+        for dirpath, dirnames, filenames in os.walk(path):
+            kept = []
+            for name in sorted(dirnames):
+                full = os.path.join(dirpath, name)
+                try:
+                    dst = os.lstat(full)
+                except OSError:
+                    continue
+                yield full, os.path.relpath(full, base_dir), dst
+                # os.walk does not follow symlinks to directories
+                if stat.S_ISDIR(dst.st_mode) and dst.st_dev == root_dev:
+                    kept.append(name)
+            dirnames[:] = kept
+            for name in sorted(filenames):
+                full = os.path.join(dirpath, name)
+                try:
+                    yield full, os.path.relpath(full, base_dir), os.lstat(full)
+                except OSError:
+                    continue
+
+def chunk_path(digest):
+    return os.path.join(CHUNKS_DIR, digest[:2], digest)
+
+def store_chunk(data, stats):
+    """Store a chunk under its SHA-256 unless it is already present."""
+    digest = hashlib.sha256(data).hexdigest()
+    path = chunk_path(digest)
+    if os.path.exists(path):
+        stats["chunks_reused"] += 1
+        return digest
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    compressed = zlib.compress(data, CHUNK_COMPRESSION_LEVEL)
+    with open(tmp_path, "wb") as f:
+        f.write(compressed)
+    os.replace(tmp_path, path)
+    stats["chunks_written"] += 1
+    stats["bytes_written"] += len(compressed)
+    return digest
+
+def store_file(path, stats):
+    """Split a file into fixed-size chunks and return their digests."""
+    digests = []
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            stats["bytes_hashed"] += len(data)
+            digests.append(store_chunk(data, stats))
+    return digests
+
+def list_snapshots():
+    """Return snapshot manifest names, oldest first."""
+    if not os.path.isdir(SNAPSHOTS_DIR):
+        return []
+    return sorted(f for f in os.listdir(SNAPSHOTS_DIR) if f.startswith("Tipi_") and f.endswith(".json.gz"))
+
+def load_snapshot(name):
+    with gzip.open(os.path.join(SNAPSHOTS_DIR, name), "rt") as f:
+        return json.load(f)
+
+def create_snapshot(staged=False):
+    """Create a deduplicated snapshot of the backup items.
+
+    Files whose size, mtime and inode match the previous snapshot reuse its
+    chunk list without being read again; everything else is chunked and only
+    chunks not already in the store are written.
+    """
+    os.makedirs(SNAPSHOTS_DIR, exist_ok=True)
+    os.makedirs(CHUNKS_DIR, exist_ok=True)
+
+    previous = {}
+    snapshots = list_snapshots()
+    if snapshots:
+        try:
+            previous = {e["path"]: e for e in load_snapshot(snapshots[-1])["entries"] if e["type"] == "file"}
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not read previous snapshot {snapshots[-1]}, hashing everything: {e}")
+
+    stats = {"files": 0, "files_unchanged": 0, "bytes_hashed": 0, "bytes_written": 0,
+             "chunks_written": 0, "chunks_reused": 0}
+    entries = []
+    start = time.monotonic()
+
+    def capture(items):
+        for path, arcname, st in walk_items(BASE_DIR, items):
+            entry = {"path": arcname, "mode": stat.S_IMODE(st.st_mode), "uid": st.st_uid,
+                     "gid": st.st_gid, "mtime_ns": st.st_mtime_ns}
+            if stat.S_ISDIR(st.st_mode):
+                entry["type"] = "dir"
+            elif stat.S_ISLNK(st.st_mode):
+                entry["type"] = "symlink"
+                entry["target"] = os.readlink(path)
+            elif stat.S_ISREG(st.st_mode):
+                entry.update(type="file", size=st.st_size, ino=st.st_ino)
+                stats["files"] += 1
+                prev = previous.get(arcname)
+                if prev and prev["size"] == st.st_size and prev["mtime_ns"] == st.st_mtime_ns and prev.get("ino") == st.st_ino:
+                    entry["chunks"] = prev["chunks"]
+                    stats["files_unchanged"] += 1
+                else:
+                    try:
+                        entry["chunks"] = store_file(path, stats)
+                    except OSError as e:
+                        print(f"Error reading {path}: {e}")
+                        continue
+            else:
+                # Sockets, fifos and device nodes are not backed up
+                continue
+            entries.append(entry)
+
+    if staged:
+        run_staged(capture)
+    else:
+        capture(ITEMS_TO_BACKUP)
+
+    current_time = datetime.now().strftime("%Y%m%d%H%M%S")
+    name = f"Tipi_{current_time}.json.gz"
+    manifest = {"created": current_time, "base_dir": BASE_DIR, "chunk_size": CHUNK_SIZE,
+                "entries": entries, "stats": stats}
+    tmp_path = os.path.join(SNAPSHOTS_DIR, f"{name}.tmp")
+    with gzip.open(tmp_path, "wt") as f:
+        json.dump(manifest, f, separators=(",", ":"))
+    os.replace(tmp_path, os.path.join(SNAPSHOTS_DIR, name))
+
+    elapsed = time.monotonic() - start
+    print(f"Snapshot created: {name} in {elapsed:.1f}s")
+    print(f"  {stats['files']} files, {stats['files_unchanged']} unchanged, "
+          f"{stats['bytes_hashed'] / 1e6:.1f} MB hashed, {stats['chunks_written']} new chunks "
+          f"({stats['bytes_written'] / 1e6:.1f} MB written), {stats['chunks_reused']} chunks reused")
+    BACKUP_BYTES_READ.set(stats["bytes_hashed"], mode="dedup")
+    BACKUP_BYTES_WRITTEN.set(stats["bytes_written"], mode="dedup")
+    return name
+
+def manage_snapshots():
+    """Keep the newest snapshots and delete chunks no snapshot references."""
+    max_backups, _ = read_settings()
+    snapshots = list_snapshots()
+    while len(snapshots) > max_backups:
+        oldest = snapshots.pop(0)
+        try:
+            os.remove(os.path.join(SNAPSHOTS_DIR, oldest))
+            print(f"Removed old snapshot: {oldest}")
+        except OSError as e:
+            print(f"Error removing old snapshot {oldest}: {e}")
+
+    referenced = set()
+    for name in snapshots:
+        try:
+            for entry in load_snapshot(name)["entries"]:
+                referenced.update(entry.get("chunks", ()))
+        except (OSError, ValueError, KeyError) as e:
+            # Never collect chunks while a manifest can't be read
+            print(f"Error reading snapshot {name}, skipping chunk cleanup: {e}")
+            return
+
+    if not os.path.isdir(CHUNKS_DIR):
+        return
+    removed = freed = 0
+    for prefix in os.listdir(CHUNKS_DIR):
+        prefix_dir = os.path.join(CHUNKS_DIR, prefix)
+        for digest in os.listdir(prefix_dir):
+            if digest not in referenced:
+                path = os.path.join(prefix_dir, digest)
+                freed += os.path.getsize(path)
+                os.remove(path)
+                removed += 1
+    if removed:
+        print(f"Removed {removed} unreferenced chunks ({freed / 1e6:.1f} MB)")
+
+def restore_snapshot(name, target_dir):
+    """Restore a snapshot into target_dir."""
+    manifest = load_snapshot(name)
+    dirs = []
+    for entry in manifest["entries"]:
+        dest = os.path.join(target_dir, entry["path"])
+        if entry["type"] == "dir":
+            os.makedirs(dest, exist_ok=True)
+            dirs.append((dest, entry))
+            continue
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if entry["type"] == "symlink":
+            if os.path.lexists(dest):
+                os.remove(dest)
+            os.symlink(entry["target"], dest)
+            continue
+        with open(dest, "wb") as f:
+            for digest in entry["chunks"]:
+                with open(chunk_path(digest), "rb") as chunk:
+                    f.write(zlib.decompress(chunk.read()))
+        os.chmod(dest, entry["mode"])
+        os.utime(dest, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+        try:
+            os.chown(dest, entry["uid"], entry["gid"])
+        except PermissionError:
+            pass
+    # Directory times last, after their contents were written
+    for dest, entry in reversed(dirs):
+        os.chmod(dest, entry["mode"])
+        os.utime(dest, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+    print(f"Restored {name} to {target_dir}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Back up the Tipi install directory.")
+    parser.add_argument("--staged", action="store_true", help="Stop and back up one app at a time instead of requiring Tipi to be stopped.")
+    parser.add_argument("--list-snapshots", action="store_true", help="List snapshots in the chunk store.")
+    parser.add_argument("--restore-snapshot", metavar="NAME", help="Restore a snapshot from the chunk store.")
+    parser.add_argument("--target", help="Directory to restore into (default: the Tipi directory for --restore, "
+                                          "the current directory for --restore-snapshot).")
+    parser.add_argument("--list", action="store_true", help="List the archives and the apps they contain.")
+    parser.add_argument("--restore", action="store_true", help="Restore --app and/or --path from an archive.")
+    parser.add_argument("--app", help="App whose app-data, apps and user-config directories are restored.")
+    parser.add_argument("--path", action="append", default=[], help="Path to restore, relative to the Tipi directory (repeatable).")
+    parser.add_argument("--backup", metavar="NAME", help="Archive to restore from or verify (default: the newest).")
+    parser.add_argument("--verify", action="store_true", help="Check an archive against its checksums.")
+    parser.add_argument("--all", action="store_true", help="Verify every archive.")
+    parser.add_argument("--quick", action="store_true", help="Only check the compressed blocks, don't decompress.")
+    args = parser.parse_args()
+
+    try:
+        get_target()
+    except ValueError as e:
+        print(f"Error in {CONFIG_FILE}: {e}")
+        sys.exit(1)
+    if args.list:
+        list_backups()
+        return
+    if args.restore:
+        if not args.app and not args.path:
+            parser.error("--restore needs --app or --path")
+        sys.exit(0 if restore(args.app, args.path, args.backup, args.target) else 1)
+    if args.verify:
+        archives = list_archives()
+        names = archives if args.all else [args.backup] if args.backup else archives[-1:]
+        if not names:
+            print(f"No backups in {get_target()}")
+        results = []
+        for name in names:
+            if name not in archives:
+                print(f"Backup {name} not found in {get_target()}")
+                results.append(False)
+            else:
+                results.append(verify_archive(name, not args.quick))
+        tipi_metrics.write_textfile("backup_verify")
+        sys.exit(1 if False in results or not names else 0)
+    if args.list_snapshots:
+        for name in list_snapshots():
+            print(name)
+        return
+    if args.restore_snapshot:
+        restore_snapshot(args.restore_snapshot, args.target or ".")
+        return
+
+    _, mode = read_settings()
+    success = False
+    try:
+        with BACKUP_DURATION.time(mode=mode):
+            if mode == "dedup":
+                try:
+                    create_snapshot(args.staged)
+                    manage_snapshots()
+                    success = True
+                except (OSError, ValueError) as e:
+                    print(f"Error creating snapshot: {e}")
+            else:
+                manage_backups()
+                success = create_backup(args.staged)
+    finally:
+        BACKUP_SUCCESS.set(int(success), mode=mode)
+        BACKUP_LAST_RUN.set(time.time(), mode=mode)
+        tipi_metrics.write_textfile("backup")
+    # The nightly job chain records and reports a failed backup by its exit status
+    sys.exit(0 if success else 1)
+
 if __name__ == "__main__":
-    manage_backups()
-    create_backup()
+    main()
@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+"""Nightly maintenance jobs, run one after another under a single lock.
+
+One cron entry starts the chain: Tipi update, app updates, system update and
+backup. Each enabled job starts as soon as the previous one finished and the
+machine has room for it (load, I/O pressure, free space, temperature), and
+every run is kept in a history with per-job durations.
+"""
+
+import argparse
+import configparser
+import fcntl
+import json
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
+
+from tipi_notify import notify
+import monitor_sensor
+import tipi_metrics
+import tipi_paths
+
+CONFIG_FILE = os.path.join(tipi_paths.CONFIG_DIR, "tipi_jobs.conf")
+STATE_DIR = tipi_paths.STATE_DIR
+LOCK_FILE = os.path.join(STATE_DIR, "jobs.lock")
+HISTORY_FILE = os.path.join(STATE_DIR, "jobs_history.json")
+HISTORY_SIZE = 60  # Runs kept, two months of nightly runs
+TIPI_DIR = tipi_paths.RUNTIPI_DIR
+TIPI_TRICKS = os.path.join(tipi_paths.SCRIPT_DIR, "..", "tipi-tricks")
+BACKUP_SCRIPT = os.path.join(tipi_paths.SCRIPT_DIR, "scheduled_tipi_backup.py")
+REBOOT_REQUIRED = "/var/run/reboot-required"
+
+# Job name (config section) -> (description, jobs that must have succeeded if they ran earlier in the chain).
+# Jobs run in this order.
+JOBS = {
+    "tipi_update": ("Tipi update", ()),
+    "app_update": ("App updates", ("tipi_update",)),
+    "system_update": ("System update", ()),
+    "backup": ("Backup", ()),
+}
+
+# Admission limits, see etc/tipi_jobs.conf
+DEFAULT_ADMISSION = {
+    "max_load": 1.5,  # 1-minute load average per CPU core
+    "max_io_pressure": 40.0,  # Percent of the last 10 seconds some task waited for I/O
+    "min_free_percent": 5.0,  # On every filesystem in paths
+    "max_temperature": 85.0,  # Hottest hwmon sensor in °C
+    "max_wait_minutes": 120,  # A job still not admitted after this long is deferred to the next run
+    "poll_seconds": 30,
+}
+
+JOB_DURATION = tipi_metrics.histogram("tipi_job_duration_seconds", "Time taken by one maintenance job.", ["job"])
+JOB_WAIT = tipi_metrics.histogram("tipi_job_wait_seconds", "Time a maintenance job waited for admission.", ["job"])
+JOB_SUCCESS = tipi_metrics.gauge("tipi_job_success", "1 if the last run of a maintenance job succeeded.", ["job"])
+RUN_DURATION = tipi_metrics.gauge("tipi_jobs_run_seconds", "Length of the last maintenance run, waits included.")
+RUN_TIMESTAMP = tipi_metrics.gauge("tipi_jobs_last_run_timestamp_seconds", "Time the last maintenance run finished.")
+
+def read_settings(config_file=CONFIG_FILE):
+    """Return ({job: {option: value}} for the enabled jobs, admission limits, admission paths)."""
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    jobs = {name: dict(config[name]) for name in JOBS if config.getboolean(name, "enabled", fallback=False)}
+    admission = {key: config.getfloat("admission", key, fallback=default) for key, default in DEFAULT_ADMISSION.items()}
+    paths = config.get("admission", "paths", fallback="").split(",")
+    paths = [path.strip() for path in paths if path.strip()] or ["/", TIPI_DIR]
+    return jobs, admission, paths
+
+def job_command(name, options):
+    """Shell command of a job, run in the Tipi directory like the cron entries it replaces."""
+    if name == "tipi_update":
+        return "./runtipi-cli update latest"
+    if name == "app_update":
+        return f"{sys.executable} {TIPI_TRICKS} --update-apps"
+    if name == "system_update":
+        return "apt update -y && apt upgrade -y && apt autoremove -y && apt clean -y"
+    if name == "backup":
+        if options.get("staged", "false").lower() in ("true", "yes", "1", "on"):
+            return f"{sys.executable} {BACKUP_SCRIPT} --staged"
+        # Start Tipi again even if the backup failed
+        return f"./runtipi-cli stop && {sys.executable} {BACKUP_SCRIPT}; status=$?; ./runtipi-cli start; exit $status"
+    raise ValueError(f"Unknown job {name}")
+
+def read_io_pressure():
+    """Percent of the last 10 seconds some task stalled on I/O, or None without PSI support."""
+    try:
+        with open(os.path.join(tipi_paths.PRESSURE_DIR, "io")) as f:
+            for line in f:
+                if line.startswith("some "):
+                    fields = dict(field.split("=") for field in line.split()[1:])
+                    return float(fields["avg10"])
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def read_max_temperature():
+    """Hottest hwmon temperature in °C, or None without sensors."""
+    reader = monitor_sensor.HwmonReader()
+    temperatures = []
+    try:
+        for key in reader.fds:
+            try:
+                temperatures.append(reader.read(key))
+            except (OSError, ValueError):
+                continue
+    finally:
+        reader.close()
+    return max(temperatures, default=None)
+
+def read_resources(paths):
+    """Current readings the admission limits are compared with."""
+    free = {}
+    for path in paths:
+        try:
+            usage = shutil.disk_usage(path)
+        except OSError:
+            continue
+        free[path] = usage.free / usage.total * 100 if usage.total else 100.0
+    return {
+        "load": os.getloadavg()[0] / (os.cpu_count() or 1),
+        "io_pressure": read_io_pressure(),
+        "free_percent": free,
+        "temperature": read_max_temperature(),
+    }
+
+def admission_problems(resources, admission):
+    """Return the reasons a job can't start now, empty when it can."""
+    problems = []
+    if resources["load"] > admission["max_load"]:
+        problems.append(f"load {resources['load']:.2f} per core > {admission['max_load']:g}")
+    if resources["io_pressure"] is not None and resources["io_pressure"] > admission["max_io_pressure"]:
+        problems.append(f"I/O pressure {resources['io_pressure']:.1f}% > {admission['max_io_pressure']:g}%")
+    for path, free in resources["free_percent"].items():
+        if free < admission["min_free_percent"]:
+            problems.append(f"{path} has {free:.1f}% free < {admission['min_free_percent']:g}%")
+    if resources["temperature"] is not None and resources["temperature"] > admission["max_temperature"]:
+        problems.append(f"temperature {resources['temperature']:.1f}°C > {admission['max_temperature']:g}°C")
+    return problems
+
+def wait_for_admission(name, admission, paths):
+    """Wait until the machine has room for a job; return (admitted, seconds waited, last problems)."""
+    start = time.monotonic()
+    deadline = start + admission["max_wait_minutes"] * 60
+    reported = None
+    while True:
+        problems = admission_problems(read_resources(paths), admission)
+        if not problems:
+            return True, time.monotonic() - start, []
+        if time.monotonic() >= deadline:
+            return False, time.monotonic() - start, problems
+        if problems != reported:
+            print(f"{name}: waiting, {'; '.join(problems)}", flush=True)
+            reported = problems
+        time.sleep(min(admission["poll_seconds"], max(deadline - time.monotonic(), 0)))
+
+def load_history():
+    try:
+        with open(HISTORY_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def save_history(history):
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp_path = f"{HISTORY_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(history[-HISTORY_SIZE:], f, separators=(",", ":"))
+        os.replace(tmp_path, HISTORY_FILE)
+    except OSError as e:
+        print(f"Error saving job history: {e}")
+
+def run_job(name, options):
+    """Run one job with its output passed through; return (outcome, return code)."""
+    command = job_command(name, options)
+    print(f"== {JOBS[name][0]}: {command}", flush=True)
+    try:
+        result = tipi_metrics.run(command, shell=True, cwd=TIPI_DIR)
+    except OSError as e:
+        print(f"{name}: {e}")
+        return "failed", None
+    return ("succeeded" if result.returncode == 0 else "failed"), result.returncode
+
+def run_chain(only=None, force=False, config_file=CONFIG_FILE):
+    """Run the enabled jobs (or only the given ones) in order; return the run record, or None if busy.
+
+    A job whose required job failed or was deferred is skipped, the others
+    still run. With force the admission limits are ignored.
+    """
+    jobs, admission, paths = read_settings(config_file)
+    if only:
+        jobs = {name: jobs.get(name, {}) for name in JOBS if name in only}
+
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(LOCK_FILE, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("Another maintenance run is in progress.")
+            return None
+
+        run = {"started": time.time(), "jobs": []}
+        outcomes = {}
+        for name, options in jobs.items():
+            entry = {"name": name, "outcome": None, "seconds": 0.0, "waited": 0.0}
+            blocking = [required for required in JOBS[name][1] if outcomes.get(required, "succeeded") != "succeeded"]
+            if blocking:
+                entry.update(outcome="skipped", reason=f"{', '.join(blocking)} did not succeed")
+            else:
+                admitted, waited, problems = (True, 0.0, []) if force else wait_for_admission(name, admission, paths)
+                entry["waited"] = round(waited, 1)
+                JOB_WAIT.observe(waited, job=name)
+                if not admitted:
+                    entry.update(outcome="deferred", reason="; ".join(problems))
+                else:
+                    start = time.monotonic()
+                    with JOB_DURATION.time(job=name):
+                        entry["outcome"], entry["returncode"] = run_job(name, options)
+                    entry["seconds"] = round(time.monotonic() - start, 1)
+            outcomes[name] = entry["outcome"]
+            JOB_SUCCESS.set(int(entry["outcome"] == "succeeded"), job=name)
+            print(f"{name}: {entry['outcome']}" + (f" ({entry['reason']})" if entry.get("reason") else "")
+                  + f" after {entry['seconds']:.1f}s", flush=True)
+            run["jobs"].append(entry)
+
+        run["finished"] = time.time()
+        history = load_history()
+        history.append(run)
+        save_history(history)
+    RUN_DURATION.set(run["finished"] - run["started"])
+    RUN_TIMESTAMP.set(run["finished"])
+    tipi_metrics.write_textfile("jobs")
+
+    problems = [f"{entry['name']} {entry['outcome']}" + (f" ({entry['reason']})" if entry.get("reason") else "")
+                for entry in run["jobs"] if entry["outcome"] != "succeeded"]
+    if problems:
+        notify("Maintenance Problems", "; ".join(problems))
+    # A reboot waits until the whole chain, including the backup, is done
+    reboot = jobs.get("system_update", {}).get("reboot", "true").lower() in ("true", "yes", "1", "on")
+    if outcomes.get("system_update") == "succeeded" and reboot and os.path.exists(REBOOT_REQUIRED):
+        print("Rebooting to finish the system update.", flush=True)
+        tipi_metrics.run(["reboot"])
+    return run
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+
+def print_history(runs=10):
+    history = load_history()[-runs:]
+    if not history:
+        print("No maintenance runs recorded yet.")
+        return
+    for run in history:
+        waited = sum(entry["waited"] for entry in run["jobs"])
+        print(f"{format_time(run['started'])}  {run['finished'] - run['started']:.0f}s, {waited:.0f}s waiting")
+        for entry in run["jobs"]:
+            reason = f"  {entry['reason']}" if entry.get("reason") else ""
+            print(f"  {JOBS.get(entry['name'], (entry['name'],))[0]:<16} {entry['outcome']:<10} "
+                  f"{entry['seconds']:>8.1f}s {entry['waited']:>8.1f}s waited{reason}")
+
+def print_status(config_file=CONFIG_FILE):
+    jobs, admission, paths = read_settings(config_file)
+    print("Enabled jobs, in order: " + (", ".join(JOBS[name][0] for name in jobs) or "none"))
+    resources = read_resources(paths)
+    print(f"Load per core: {resources['load']:.2f} (max {admission['max_load']:g})")
+    if resources["io_pressure"] is not None:
+        print(f"I/O pressure: {resources['io_pressure']:.1f}% (max {admission['max_io_pressure']:g}%)")
+    for path, free in resources["free_percent"].items():
+        print(f"Free on {path}: {free:.1f}% (min {admission['min_free_percent']:g}%)")
+    if resources["temperature"] is not None:
+        print(f"Temperature: {resources['temperature']:.1f}°C (max {admission['max_temperature']:g}°C)")
+    problems = admission_problems(resources, admission)
+    print("A job could start now." if not problems else "Jobs would wait: " + "; ".join(problems))
+    try:
+        with open(LOCK_FILE, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print("A maintenance run is in progress.")
+    except OSError:
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the nightly maintenance jobs one after another.")
+    parser.add_argument("--run", action="store_true", help="Run the enabled jobs")
+    parser.add_argument("--job", action="append", choices=list(JOBS), help="Run only this job, even if it is disabled. Can be repeated.")
+    parser.add_argument("--force", action="store_true", help="Start jobs without waiting for the admission limits")
+    parser.add_argument("--history", type=int, nargs="?", const=10, metavar="RUNS", help="Show the last runs (default: 10)")
+    args = parser.parse_args()
+
+    if args.history:
+        print_history(args.history)
+    elif args.run or args.job:
+        run = run_chain(args.job, args.force)
+        sys.exit(1 if run is None or any(entry["outcome"] != "succeeded" for entry in run["jobs"]) else 0)
+    else:
+        print_status()
+
+if __name__ == "__main__":
+    main()
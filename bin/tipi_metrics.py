@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+
+import argparse
+import configparser
+import http.server
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import tipi_paths
+
+CONFIG_FILE = os.path.join(tipi_paths.CONFIG_DIR, "metrics.conf")
+DEFAULT_TEXTFILE_DIR = "/var/lib/prometheus/node-exporter"  # node-exporter's textfile collector on Debian
+DEFAULT_HTTP_ADDRESS = "127.0.0.1"
+# Latency buckets in seconds, from a sysfs read up to a long backup
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """A metric family: one value per combination of label values."""
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """Yield (suffix, label values, extra labels, value) for the exposition format."""
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield "", key, (), value
+
+    def render(self, constant=()):
+        """Return the family in the exposition format, with the (name, value) pairs of constant on every sample."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labels, key, tuple(constant) + extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def remove(self, **labels):
+        """Drop a series, e.g. for a drive or mount that no longer exists."""
+        key = self.key(labels)
+        with self.lock:
+            self.values.pop(key, None)
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with block, also when it raises."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for key, (counts, total) in items:
+            for bound, count in zip(self.buckets, counts):
+                yield "_bucket", key, (("le", format_value(float(bound))),), count
+            yield "_sum", key, (), total
+            yield "_count", key, (), counts[-1]
+
+class Registry:
+    """All metrics of one process. Asking twice for the same name returns the same metric."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+                raise ValueError(f"Metric {name} is already registered with a different type or labels")
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self, constant=()):
+        """Return every metric in the Prometheus text exposition format."""
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        return "".join(metric.render(constant) + "\n" for metric in metrics)
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+def command_name(args):
+    """Short label for a command: the program's base name, without its arguments."""
+    if isinstance(args, str):
+        args = args.replace("&&", ";").split(";")[-1].split() or [args]
+    return os.path.basename(str(args[0]))
+
+def run(args, **kwargs):
+    """subprocess.run() that records how long the command took and whether it failed."""
+    command = command_name(args)
+    duration = histogram("tipi_subprocess_duration_seconds", "Time spent in external commands.", ["command"])
+    failures = counter("tipi_subprocess_failures_total", "External commands that failed or timed out.", ["command"])
+    start = time.monotonic()
+    try:
+        result = subprocess.run(args, **kwargs)
+    except (OSError, subprocess.SubprocessError):
+        failures.inc(command=command)
+        raise
+    finally:
+        duration.observe(time.monotonic() - start, command=command)
+    if result.returncode != 0:
+        failures.inc(command=command)
+    return result
+
+def read_config(config_file=CONFIG_FILE):
+    """Return (textfile dir or None, HTTP address, HTTP port or 0) from metrics.conf."""
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    textfile_dir = config.get("textfile", "directory", fallback=DEFAULT_TEXTFILE_DIR).strip() or None
+    address = config.get("http", "address", fallback=DEFAULT_HTTP_ADDRESS).strip() or DEFAULT_HTTP_ADDRESS
+    port = config.getint("http", "port", fallback=0)
+    return textfile_dir, address, port
+
+def write_textfile(job, registry=REGISTRY, textfile_dir=None):
+    """Write the registry to <textfile dir>/tipi_<job>.prom for node-exporter.
+
+    The file is replaced atomically so the collector never reads a partial
+    file. Nothing is written when the directory does not exist, i.e. when
+    node-exporter is not installed. Every sample gets a tipi_job="<job>"
+    label: families such as the subprocess timings are recorded by every
+    job, and the collector rejects a series that two files both contain.
+    """
+    if textfile_dir is None:
+        textfile_dir = read_config()[0]
+    if not textfile_dir or not os.path.isdir(textfile_dir):
+        return None
+    path = os.path.join(textfile_dir, f"tipi_{job}.prom")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            f.write(registry.render(constant=[("tipi_job", job)]))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Error writing metrics to {path}: {e}")
+        return None
+    return path
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] in ("/metrics", "/"):
+            body = self.registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        else:
+            body = b"Not Found\n"
+            self.send_response(404)
+            self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_http(port, address=DEFAULT_HTTP_ADDRESS, registry=REGISTRY):
+    """Serve the registry on http://address:port/metrics from a background thread."""
+    handler = type("Handler", (MetricsHandler,), {"registry": registry})
+    server = http.server.ThreadingHTTPServer((address, port), handler)
+    threading.Thread(target=server.serve_forever, name="metrics http", daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the metrics files written by Tipi Tricks.")
+    parser.parse_args()
+    textfile_dir, address, port = read_config()
+    if port:
+        print(f"HTTP endpoint: http://{address}:{port}/metrics (served by the monitor daemon)")
+    if not textfile_dir or not os.path.isdir(textfile_dir):
+        print(f"Textfile directory {textfile_dir} does not exist, no metrics files are written.")
+        return
+    for name in sorted(os.listdir(textfile_dir)):
+        if name.startswith("tipi_") and name.endswith(".prom"):
+            path = os.path.join(textfile_dir, name)
+            age = time.time() - os.path.getmtime(path)
+            print(f"{path} (updated {age:.0f}s ago)")
+
+if __name__ == "__main__":
+    main()
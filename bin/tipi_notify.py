@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+
+import argparse
+import atexit
+import configparser
+import http.client
+import http.server
+import json
+import os
+import queue
+import subprocess
+import threading
+import time
+from urllib.parse import urlsplit
+
+import tipi_metrics
+import tipi_paths
+
+CONFIG_FILE = os.path.join(tipi_paths.CONFIG_DIR, "notify.conf")
+DEFAULT_PRIORITY = 5
+DEDUP_WINDOW = 300  # Seconds during which an identical notification is only counted
+BATCH_DELAY = 2  # Seconds to wait for more notifications with the same title before sending
+SEND_TIMEOUT = 10  # Seconds per HTTP request
+
+NOTIFICATIONS = tipi_metrics.counter("tipi_notifications_total", "Notifications by result: sent, failed or suppressed.", ["result"])
+SEND_DURATION = tipi_metrics.histogram("tipi_notification_send_seconds", "Time taken to deliver one notification.")
+
+class KeepAliveConnection:
+    """One persistent HTTP(S) connection to a server, reopened when it drops.
+
+    Only the notifier's sender thread uses it, so it needs no lock.
+    """
+
+    def __init__(self, url, timeout=SEND_TIMEOUT):
+        parts = urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path.rstrip("/")
+        self.timeout = timeout
+        self.conn = None
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        """Send a request and return (status, body)."""
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = self._connect()
+            reused = self.conn.sock is not None
+            response = None
+            try:
+                self.conn.request(method, self.base_path + path, body=body, headers=headers or {})
+                response = self.conn.getresponse()
+                # The body must be read fully before the connection can be reused
+                data = response.read()
+                if response.will_close:
+                    self.conn.close()
+                    self.conn = None
+                return response.status, data
+            except (BrokenPipeError, ConnectionResetError):
+                # The server may have closed an idle keep-alive connection before reading the
+                # request, retry once on a fresh one. RemoteDisconnected is a ConnectionResetError.
+                self.conn.close()
+                self.conn = None
+                if attempt or not reused or response is not None:
+                    raise
+            except (OSError, http.client.HTTPException):
+                # Anything else, a timeout included, may come after the server acted on the
+                # request, so sending it again could deliver it twice
+                self.conn.close()
+                self.conn = None
+                raise
+
+class Notifier:
+    """Background notification dispatcher shared by all monitors.
+
+    notify() only queues the message. A sender thread drops repeats of the
+    same title and message within the dedup window (the next one sent says
+    how many were suppressed), coalesces messages with the same title that
+    arrive together into one, and delivers them over a keep-alive
+    connection to the Gotify API, or with the gotify CLI when no API is
+    configured.
+    """
+
+    def __init__(self, url=None, token=None, priority=DEFAULT_PRIORITY, window=DEDUP_WINDOW, batch_delay=BATCH_DELAY):
+        self.token = token
+        self.priority = priority
+        self.window = window
+        self.batch_delay = batch_delay
+        self.connection = KeepAliveConnection(url) if url and token else None
+        self.queue = queue.Queue()
+        self.last_sent = {}  # (title, message) -> monotonic time last sent
+        self.suppressed = {}  # (title, message) -> repeats dropped since then
+        self.sent = 0
+        self.thread = threading.Thread(target=self._run, name="notifier", daemon=True)
+        self.thread.start()
+
+    def notify(self, title, message):
+        self.queue.put((title, message))
+
+    def flush(self, timeout=None):
+        """Wait until every queued notification has been handled."""
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch, waiters = [], []
+            item = self.queue.get()
+            deadline = time.monotonic() + self.batch_delay
+            while True:
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            try:
+                self._send_batch(batch)
+            except Exception as e:
+                print(f"Failed to send notifications: {e}")
+            for waiter in waiters:
+                waiter.set()
+
+    def _send_batch(self, batch):
+        grouped = {}
+        now = time.monotonic()
+        for title, message in batch:
+            key = (title, message)
+            if now - self.last_sent.get(key, -self.window) < self.window:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                NOTIFICATIONS.inc(result="suppressed")
+                continue
+            self.last_sent[key] = now
+            repeats = self.suppressed.pop(key, 0)
+            if repeats:
+                message = f"{message} (repeated {repeats} more times)"
+            lines = grouped.setdefault(title, [])
+            if message not in lines:
+                lines.append(message)
+        for title, lines in grouped.items():
+            self._deliver(title, "\n".join(lines))
+        # Messages carry changing numbers, so forget the ones outside the window or the dicts grow forever.
+        # Only after the batch, so a repeat arriving just after the window still reports the count.
+        for key, sent_at in list(self.last_sent.items()):
+            if now - sent_at >= self.window:
+                del self.last_sent[key]
+                self.suppressed.pop(key, None)
+
+    def _deliver(self, title, message):
+        try:
+            with SEND_DURATION.time():
+                self._send(title, message)
+            self.sent += 1
+            NOTIFICATIONS.inc(result="sent")
+        except Exception as e:
+            print(f"Failed to send Gotify notification: {e}")
+            NOTIFICATIONS.inc(result="failed")
+
+    def _send(self, title, message):
+        if self.connection is None:
+            tipi_metrics.run(["gotify", "push", f"--title={title}", message], check=True,
+                             stdout=subprocess.DEVNULL, timeout=SEND_TIMEOUT)
+        else:
+            # Bytes, so http.client sends headers and body in one segment instead of stalling on delayed ACKs
+            body = json.dumps({"title": title, "message": message, "priority": self.priority}).encode()
+            status, data = self.connection.request("POST", "/message", body,
+                                                   {"Content-Type": "application/json", "X-Gotify-Key": self.token})
+            if status >= 300:
+                raise RuntimeError(f"HTTP {status}: {data[:200]!r}")
+
+def read_config(config_file=CONFIG_FILE):
+    """Return the Notifier keyword arguments from notify.conf."""
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    return {
+        "url": config.get("gotify", "url", fallback="").strip() or None,
+        "token": config.get("gotify", "token", fallback="").strip() or None,
+        "priority": config.getint("gotify", "priority", fallback=DEFAULT_PRIORITY),
+        "window": config.getint("dispatch", "dedup_window", fallback=DEDUP_WINDOW),
+        "batch_delay": config.getfloat("dispatch", "batch_delay", fallback=BATCH_DELAY),
+    }
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+def get_notifier():
+    """Return the process-wide Notifier, creating it on first use."""
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            _notifier = Notifier(**read_config())
+            # Short-lived scripts must not exit with notifications still queued
+            atexit.register(_notifier.flush, SEND_TIMEOUT)
+        return _notifier
+
+def notify(title, message):
+    """Queue a notification; never blocks on delivery."""
+    get_notifier().notify(title, message)
+
+class StubGotifyHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for the Gotify message API that prints what it receives."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.split("?")[0].rstrip("/").endswith("/message"):
+            message = json.loads(body or b"{}")
+            self.received.append(message)
+            print(f"[{message.get('title')}] {message.get('message')}", flush=True)
+            reply = json.dumps({"id": len(self.received)}).encode()
+            self.send_response(200)
+        else:
+            reply = b'{"error":"Not Found"}'
+            self.send_response(404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_stub(port=0):
+    """Start a stand-in Gotify server in a background thread and return it."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), StubGotifyHandler)
+    threading.Thread(target=server.serve_forever, name="gotify stub", daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Send notifications or run a stand-in Gotify server.")
+    parser.add_argument("--send", nargs=2, metavar=("TITLE", "MESSAGE"), help="Send one notification.")
+    parser.add_argument("--stub-server", action="store_true", help="Run a local stand-in Gotify server.")
+    parser.add_argument("--port", type=int, default=8080, help="Port for --stub-server (default: 8080).")
+    args = parser.parse_args()
+
+    if args.stub_server:
+        server = serve_stub(args.port)
+        print(f"Stand-in Gotify server listening on http://127.0.0.1:{server.server_port}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif args.send:
+        notify(*args.send)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+#!/usr/bin/python3
+"""Filesystem locations used by the Tipi Tricks scripts.
+
+Each can be overridden with an environment variable, so the scripts can run
+against a copy of a runtipi install, e.g. the synthetic trees used by
+bench/run_bench.py. Without overrides these are the usual locations.
+"""
+
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+RUNTIPI_DIR = os.environ.get("TIPI_ROOT", "/root/runtipi")
+# Config files installed next to bin/, i.e. runtipi/etc
+CONFIG_DIR = os.environ.get("TIPI_CONFIG_DIR", os.path.join(SCRIPT_DIR, "..", "etc"))
+STATE_DIR = os.environ.get("TIPI_STATE_DIR", "/var/lib/tipi-tricks")
+FSTAB_PATH = os.environ.get("TIPI_FSTAB", "/etc/fstab")
+MOUNTINFO_PATH = os.environ.get("TIPI_MOUNTINFO", "/proc/self/mountinfo")
+HWMON_DIR = os.environ.get("TIPI_HWMON_DIR", "/sys/class/hwmon")
+DOCKER_SOCKET = os.environ.get("TIPI_DOCKER_SOCKET", "/var/run/docker.sock")
+PRESSURE_DIR = os.environ.get("TIPI_PRESSURE_DIR", "/proc/pressure")
+
+if __name__ == "__main__":
+    for name in ("RUNTIPI_DIR", "CONFIG_DIR", "STATE_DIR", "FSTAB_PATH", "MOUNTINFO_PATH", "HWMON_DIR", "DOCKER_SOCKET", "PRESSURE_DIR"):
+        print(f"{name}={globals()[name]}")
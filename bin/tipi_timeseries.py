@@ -0,0 +1,324 @@
+#!/usr/bin/python3
+"""Sample history of the monitors in one fixed-size, memory-mapped file.
+
+Every series has three ring buffers: the raw samples, 5-minute and hourly
+aggregates (start time, min, max, mean). The file is preallocated for
+SERIES_CHUNK series and only grows, by another chunk up to MAX_SERIES, when
+a new series finds no free slot; a sample is written in place with
+struct.pack_into. Each series carries a sequence number that is odd while it
+is being written; readers copy a series and retry if the number changed, so
+they never take a lock and never hold up a writer.
+"""
+
+import argparse
+import fcntl
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import tipi_paths
+
+STORE_FILE = os.path.join(tipi_paths.STATE_DIR, "timeseries.db")
+MAGIC = b"TIPITS01"
+SERIES_CHUNK = 32  # Series the file is preallocated for, and added each time it grows
+MAX_SERIES = 256  # About 23 MB
+NAME_SIZE = 64  # Bytes of a series name, longer names are cut off
+# (bucket seconds, slots) per tier, bucket 0 keeps every sample. At the monitors'
+# one-minute interval: a day of raw samples, a week of 5-minute and 92 days of hourly ones.
+TIERS = ((0, 1440), (300, 2016), (3600, 2208))
+TIER_NAMES = ("raw", "5-minute", "hourly")
+DEFAULT_POINTS = 60  # Rows printed by a query
+READ_RETRIES = 100
+
+HEADER = struct.Struct("<8sI" + "II" * len(TIERS))  # magic, series capacity, (bucket, slots) per tier
+CAPACITY = struct.Struct("<I")
+CAPACITY_OFFSET = len(MAGIC)
+# Sequence number, then (head, count, samples in the newest bucket) per tier
+COUNTERS = struct.Struct("<I" + "III" * len(TIERS))
+SEQUENCE = struct.Struct("<I")
+RECORD = struct.Struct("<Ifff")  # Bucket start (or sample time), min, max, mean
+HEADER_SIZE = 64
+SERIES_HEADER_SIZE = 128
+TIER_OFFSETS = [SERIES_HEADER_SIZE + RECORD.size * sum(slots for _, slots in TIERS[:i]) for i in range(len(TIERS))]
+SERIES_SIZE = TIER_OFFSETS[-1] + RECORD.size * TIERS[-1][1]
+
+def file_size(capacity):
+    return HEADER_SIZE + capacity * SERIES_SIZE
+
+class TimeSeriesStore:
+    """The store file, opened for recording samples or read-only for queries."""
+
+    def __init__(self, path=STORE_FILE, writable=True):
+        self.path = path
+        self.writable = writable
+        self.slots = {}
+        self.capacity = 0
+        self.mm = None
+        self.lock = threading.Lock()
+        if writable:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        else:
+            self.fd = os.open(path, os.O_RDONLY)
+        try:
+            if writable:
+                with self.locked():
+                    if os.fstat(self.fd).st_size == 0:
+                        os.ftruncate(self.fd, file_size(SERIES_CHUNK))
+                        os.pwrite(self.fd, self.header(SERIES_CHUNK), 0)
+            header = os.pread(self.fd, HEADER.size, 0)
+            capacity = CAPACITY.unpack_from(header, CAPACITY_OFFSET)[0] if len(header) == HEADER.size else 0
+            if not capacity or header != self.header(capacity) or os.fstat(self.fd).st_size < file_size(capacity):
+                raise ValueError(f"{path} is not a store with this layout, move it away to start a new one")
+            self.remap()
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    @staticmethod
+    def header(capacity):
+        return HEADER.pack(MAGIC, capacity, *[value for tier in TIERS for value in tier])
+
+    def remap(self):
+        """Map the file again if another process (or thread) has grown it since it was mapped.
+
+        The old map is not closed: a thread still writing through it writes
+        to the same shared pages, and it is unmapped once nothing uses it.
+        """
+        capacity = CAPACITY.unpack(os.pread(self.fd, CAPACITY.size, CAPACITY_OFFSET))[0]
+        if capacity != self.capacity:
+            self.mm = mmap.mmap(self.fd, file_size(capacity), access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ)
+            self.capacity = capacity
+
+    @contextmanager
+    def locked(self):
+        """Hold the file lock for changes other processes must not interleave with, like adding a series."""
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+    def scan(self):
+        """Refresh the name -> slot map, other processes may have added series."""
+        self.remap()
+        for slot in range(self.capacity):
+            offset = HEADER_SIZE + slot * SERIES_SIZE
+            name = self.mm[offset:offset + NAME_SIZE].rstrip(b"\0").decode(errors="replace")
+            if name:
+                self.slots[name] = slot
+        return self.slots
+
+    def slot(self, name, create=False):
+        """Return the slot of a series, adding it if create is set and there is room."""
+        slot = self.slots.get(name)
+        if slot is not None or name in self.scan() or not create:
+            return self.slots.get(name)
+        with self.lock, self.locked():
+            if name in self.scan():
+                return self.slots[name]
+            used = set(self.slots.values())
+            free = next((slot for slot in range(self.capacity) if slot not in used), None)
+            if free is None:
+                if self.capacity >= MAX_SERIES:
+                    return None
+                # Grow before announcing the new capacity, so no reader maps past the end of the file
+                free = self.capacity
+                capacity = min(self.capacity + SERIES_CHUNK, MAX_SERIES)
+                os.ftruncate(self.fd, file_size(capacity))
+                os.pwrite(self.fd, CAPACITY.pack(capacity), CAPACITY_OFFSET)
+                self.remap()
+            offset = HEADER_SIZE + free * SERIES_SIZE
+            self.mm[offset:offset + SERIES_SIZE] = bytes(SERIES_SIZE)
+            self.mm[offset:offset + NAME_SIZE] = name.encode().ljust(NAME_SIZE, b"\0")
+            self.slots[name] = free
+            return free
+
+    def record(self, name, value, timestamp=None):
+        """Add a sample to every tier of a series, return False if the store is full."""
+        name = normalize_name(name)
+        slot = self.slot(name, create=True)
+        if slot is None:
+            return False
+        timestamp = int(timestamp or time.time())
+        base = HEADER_SIZE + slot * SERIES_SIZE
+        counters = list(COUNTERS.unpack_from(self.mm, base + NAME_SIZE))
+        sequence = counters[0]
+        SEQUENCE.pack_into(self.mm, base + NAME_SIZE, sequence + 1)
+        for tier, (bucket, slots) in enumerate(TIERS):
+            head, count, samples = counters[1 + 3 * tier:4 + 3 * tier]
+            offset = base + TIER_OFFSETS[tier]
+            start = timestamp - timestamp % bucket if bucket else timestamp
+            if bucket and count:
+                last = offset + RECORD.size * ((head - 1) % slots)
+                last_start, low, high, mean = RECORD.unpack_from(self.mm, last)
+                if last_start == start:
+                    RECORD.pack_into(self.mm, last, start, min(low, value), max(high, value),
+                                     mean + (value - mean) / (samples + 1))
+                    counters[3 + 3 * tier] = samples + 1
+                    continue
+            RECORD.pack_into(self.mm, offset + RECORD.size * head, start, value, value, value)
+            counters[1 + 3 * tier:4 + 3 * tier] = [(head + 1) % slots, min(count + 1, slots), 1]
+        counters[0] = sequence + 2
+        COUNTERS.pack_into(self.mm, base + NAME_SIZE, *counters)
+        return True
+
+    def read(self, name):
+        """Return [(bucket seconds, [(time, min, max, mean)] oldest first)] per tier, or None."""
+        slot = self.slot(normalize_name(name))
+        if slot is None:
+            return None
+        base = HEADER_SIZE + slot * SERIES_SIZE
+        for _ in range(READ_RETRIES):
+            counters = COUNTERS.unpack_from(self.mm, base + NAME_SIZE)
+            if counters[0] % 2:
+                time.sleep(0.001)
+                continue
+            data = self.mm[base:base + SERIES_SIZE]
+            if SEQUENCE.unpack_from(self.mm, base + NAME_SIZE)[0] == counters[0]:
+                break
+        else:
+            raise RuntimeError(f"{name} kept changing while it was read")
+
+        tiers = []
+        for tier, (bucket, slots) in enumerate(TIERS):
+            head, count, _ = counters[1 + 3 * tier:4 + 3 * tier]
+            first = (head - count) % slots
+            records = [RECORD.unpack_from(data, TIER_OFFSETS[tier] + RECORD.size * ((first + i) % slots))
+                       for i in range(count)]
+            tiers.append((bucket, records))
+        return tiers
+
+    def query(self, name, since, until=None, points=DEFAULT_POINTS):
+        """Return (tier index, [(time, min, max, mean)]) between since and until in at most points rows.
+
+        The finest tier that still reaches back to since is used and its
+        records are merged into evenly sized steps, each row carrying the
+        time of its first record.
+        """
+        tiers = self.read(name)
+        if tiers is None:
+            return None, []
+        until = until or time.time()
+        chosen = len(tiers) - 1
+        for tier, (bucket, records) in enumerate(tiers):
+            # A tier that hasn't wrapped around yet still holds everything ever recorded
+            if records and (records[0][0] <= since or len(records) < TIERS[tier][1]):
+                chosen = tier
+                break
+        bucket, records = tiers[chosen]
+        records = [r for r in records if r[0] + bucket > since and r[0] <= until]
+        step = max(bucket, math.ceil((until - since) / max(points, 1)), 1)
+        rows = []
+        for start, low, high, mean in records:
+            index = (max(start, since) - since) // step
+            if rows and rows[-1][0] == index:
+                row = rows[-1]
+                row[2], row[3] = min(row[2], low), max(row[3], high)
+                row[4].append(mean)
+            else:
+                rows.append([index, start, low, high, [mean]])
+        return chosen, [(start, low, high, sum(means) / len(means)) for _, start, low, high, means in rows]
+
+def normalize_name(name):
+    return name.encode()[:NAME_SIZE].decode(errors="ignore")
+
+_store = None
+_store_lock = threading.Lock()
+_store_error = None
+_store_full = set()  # Series that found the store full, reported once each
+
+def record(name, value, timestamp=None):
+    """Record a sample in the shared store.
+
+    Monitors must keep working without a history, so a store that can't be
+    opened is reported once and recording is skipped from then on.
+    """
+    global _store, _store_error
+    if value is None or _store_error is not None:
+        return
+    try:
+        with _store_lock:
+            if _store is None:
+                _store = TimeSeriesStore()
+        if not _store.record(name, value, timestamp) and name not in _store_full:
+            _store_full.add(name)
+            print(f"Not recording {name}: the history store already holds {MAX_SERIES} series")
+    except (OSError, ValueError) as e:
+        _store_error = e
+        print(f"Not recording history: {e}")
+
+def parse_since(value):
+    """Parse 30m, 6h, 7d, 2w or an ISO date into a timestamp."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smhdw])", value.strip())
+    if match:
+        seconds = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}[match.group(2)]
+        return time.time() - float(match.group(1)) * seconds
+    return datetime.fromisoformat(value).timestamp()
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+
+def print_series_list(store):
+    names = sorted(store.scan())
+    if not names:
+        print("No history recorded yet.")
+        return
+    print(f"{'Series':<50} {'Last value':>12}  Recorded")
+    for name in names:
+        records = store.read(name)[0][1]
+        if records:
+            print(f"{name:<50} {records[-1][3]:>12.2f}  {format_time(records[-1][0])}")
+
+def print_history(store, metric, since, until=None, points=DEFAULT_POINTS):
+    """Print every series named metric, or metric:<label>, downsampled to points rows."""
+    names = [name for name in sorted(store.scan()) if name == metric or name.startswith(metric + ":")]
+    if not names:
+        print(f"No history for {metric}. Recorded series:")
+        print_series_list(store)
+        return False
+    for name in names:
+        tier, rows = store.query(name, since, until, points)
+        print(f"{name} ({TIER_NAMES[tier]} samples)")
+        if not rows:
+            print("  No samples in this period.")
+            continue
+        print(f"  {'Time':<16} {'Min':>10} {'Mean':>10} {'Max':>10}")
+        for start, low, high, mean in rows:
+            print(f"  {format_time(start):<16} {low:>10.2f} {mean:>10.2f} {high:>10.2f}")
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the sample history recorded by the monitors.")
+    parser.add_argument("metric", nargs="?", help="Series to show, e.g. temperature or temperature:Package id 0 "
+                                                  "(default: list the recorded series)")
+    parser.add_argument("--since", default="24h", help="Start of the period: 30m, 6h, 7d, 2w or a date (default: 24h)")
+    parser.add_argument("--until", help="End of the period, like --since (default: now)")
+    parser.add_argument("--points", type=int, default=DEFAULT_POINTS, help=f"Rows per series (default: {DEFAULT_POINTS})")
+    args = parser.parse_args()
+
+    if not os.path.exists(STORE_FILE):
+        print("No history recorded yet.")
+        return
+    store = TimeSeriesStore(writable=False)
+    try:
+        if args.metric:
+            until = parse_since(args.until) if args.until else None
+            print_history(store, args.metric, parse_since(args.since), until, args.points)
+        else:
+            print_series_list(store)
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()